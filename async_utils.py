@@ -0,0 +1,114 @@
+"""This file contains an asyncio counterpart of main_functions.useLLM_back_and_forth, which maps many keywords at once.
+The functions in main_functions.py are synchronous (the OpenAI and Groq clients, as well as the Wikidata searches, block),
+so each stage is executed in a thread pool, while asyncio schedules the stages of many keywords concurrently.
+The LLM stages (candidate generation and entity selection) and the Wikidata stage have separate concurrency limits,
+so that the number of parallel LLM calls can follow the provider rate limits independently of the Wikidata searches.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import data_utils
+import main_functions
+import tools_utils
+
+
+"""
+The following function is the async version of useLLM_back_and_forth for a single keyword. It takes the same arguments, plus:
+- llm_semaphore and wikidata_semaphore: asyncio semaphores that bound the number of concurrent LLM calls and Wikidata searches
+(they are shared between all the keywords processed at the same time)
+- executor: the thread pool in which the blocking calls are executed (None means the default executor of the event loop)
+The Wikidata searches of the generated names are sent concurrently (within the limit of wikidata_semaphore).
+It returns the same value as useLLM_back_and_forth (the list of selected URIs, or None if an answer cannot be parsed).
+"""
+
+async def useLLM_back_and_forth_async(original_language, title, abstract, keyword, client, model_name, llm_semaphore, wikidata_semaphore, num_entities=1, NUM_NAMES=10, executor=None):
+    loop = asyncio.get_running_loop()
+
+    async with llm_semaphore:
+        llm_generated_entities = await loop.run_in_executor(
+            executor, main_functions.generate_potential_entities,
+            original_language, title, abstract, keyword, client, model_name, NUM_NAMES
+        )
+    if llm_generated_entities is None:
+        return None
+
+    async def search(generated_entity):
+        async with wikidata_semaphore:
+            return await loop.run_in_executor(executor, tools_utils.query_best_matches_wikidata, generated_entity)
+
+    #  gather keeps the order of the generated names, so the candidates are the same as in the synchronous function
+    searches = await asyncio.gather(*[search(generated_entity) for generated_entity in llm_generated_entities])
+    wikidata_entities = [entity for entities in searches for entity in entities]
+
+    async with llm_semaphore:
+        return await loop.run_in_executor(
+            executor, main_functions.select_entities,
+            original_language, title, abstract, keyword, wikidata_entities, client, model_name, num_entities
+        )
+
+
+"""
+The following function maps all the keywords of a dataset. records is a list of records, either items produced by
+data_utils.get_sample / data_utils.get_item_by_id or records produced by eval_utils.parse_excel_file (see data_utils.normalize_record).
+- llm_concurrency: maximum number of LLM calls running at the same time
+- wikidata_concurrency: maximum number of Wikidata searches running at the same time
+- num_entities and NUM_NAMES: same as in useLLM_back_and_forth
+The function returns a list with one dictionary per keyword, in the same order as the records and their keywords.
+Each dictionary has the keys 'record_index', 'keyword_index', 'Id', 'Language', 'Keyword', 'URIs' (the value returned by
+useLLM_back_and_forth) and 'Error' (None, or the message of the exception raised for that keyword: errors do not stop the run).
+"""
+
+async def run_back_and_forth_on_dataset_async(records, client, model_name, llm_concurrency=8, wikidata_concurrency=16, num_entities=1, NUM_NAMES=10):
+    llm_semaphore = asyncio.Semaphore(llm_concurrency)
+    wikidata_semaphore = asyncio.Semaphore(wikidata_concurrency)
+
+    async def process(record_index, keyword_index, record, keyword, executor):
+        result = {
+            'record_index': record_index,
+            'keyword_index': keyword_index,
+            'Id': record['Id'],
+            'Language': record['Language'],
+            'Keyword': keyword,
+            'URIs': None,
+            'Error': None
+        }
+        try:
+            result['URIs'] = await useLLM_back_and_forth_async(
+                record['Language'], record['Title_or'], record['Abstract_or'], keyword, client, model_name,
+                llm_semaphore, wikidata_semaphore, num_entities, NUM_NAMES, executor
+            )
+        except Exception as e:
+            result['Error'] = "{}: {}".format(type(e).__name__, e)
+        return result
+
+    #  the blocking calls never exceed the sum of the two limits, so the thread pool is sized accordingly
+    with ThreadPoolExecutor(max_workers=llm_concurrency + wikidata_concurrency) as executor:
+        tasks = []
+        for record_index, record in enumerate(records):
+            record = data_utils.normalize_record(record)
+            for keyword_index, keyword in enumerate(record['Keywords']):
+                tasks.append(process(record_index, keyword_index, record, keyword, executor))
+        return await asyncio.gather(*tasks)
+
+
+"""
+The following function is a synchronous wrapper of run_back_and_forth_on_dataset_async (it can be called from scripts).
+In a Jupyter notebook, where an event loop is already running, use instead:
+results = await async_utils.run_back_and_forth_on_dataset_async(records, client, model_name)
+"""
+
+def run_back_and_forth_on_dataset(records, client, model_name, llm_concurrency=8, wikidata_concurrency=16, num_entities=1, NUM_NAMES=10):
+    return asyncio.run(run_back_and_forth_on_dataset_async(records, client, model_name, llm_concurrency, wikidata_concurrency, num_entities, NUM_NAMES))
+
+
+"""
+The following function writes the results of run_back_and_forth_on_dataset back into records produced by eval_utils.parse_excel_file,
+in the same way as the evaluation notebook (each keyword gets an 'llm_uris' key, an empty list if the keyword failed).
+"""
+
+def attach_results_to_records(records, results):
+    for result in results:
+        kw = records[result['record_index']]['kws'][result['keyword_index']]
+        kw['llm_uris'] = result['URIs'] if result['Error'] is None else []
+    return records
@@ -0,0 +1,397 @@
+"""This file contains an offline version of main_functions.useLLM_back_and_forth based on the OpenAI Batch API
+(https://platform.openai.com/docs/guides/batch), which is cheaper than the interactive API and is not subject to its rate limits.
+The keywords of a dataset are mapped in two phases:
+- phase one writes the candidate generation requests of all the keywords to a JSONL file, submits it as a batch job,
+waits for the job to finish and reads the results; then the generated names are searched on Wikidata;
+- phase two does the same for the entity selection requests.
+Answers that cannot be parsed are repaired as in main_functions.parsed_stage_completion: the failed requests are sent again in a
+repair batch ('<phase>_repair1', ...) with the unparsable answer and a message that explains what is wrong, up to
+main_functions.REPAIR_ATTEMPTS times. Every answer is counted in metrics_utils as 'parse_results'.
+Every request has a custom_id (e.g. 'generation-3-1' for the second keyword of the fourth record). All the files are kept in a
+working directory: if the run is interrupted, calling the function again with the same working directory resumes it
+(requests whose result is already stored are not submitted again, and batch jobs already submitted are polled instead of resubmitted).
+Two backends are available: OpenAIBatchBackend, which uses the real Batch API, and LocalBatchBackend, a file-based stand-in
+that answers requests locally, so that the whole flow can be tested offline.
+"""
+
+import json
+import os
+import time
+import uuid
+
+import data_utils
+import main_functions
+import metrics_utils
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_REQUESTS_PER_BATCH = 50000  # limit of the OpenAI Batch API
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+"""
+The following class submits batch jobs to the OpenAI Batch API. It takes as input the client created with tools_utils.openAI_authentication.
+"""
+
+class OpenAIBatchBackend:
+    def __init__(self, client, completion_window="24h"):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = self.client.files.content(file_id).text
+                lines.extend(json.loads(line) for line in content.splitlines() if line.strip())
+        return lines
+
+
+"""
+The following class is a local stand-in for the Batch API. Batch jobs are stored in directory (one sub-directory per job,
+with the input and output JSONL files), so they survive a restart like real jobs.
+Requests are answered by responder, a function that takes the body of a request (a dictionary with 'model' and 'messages')
+and returns the content of the answer. If responder is None, client (any OpenAI-compatible client, e.g. Groq) is called instead.
+Jobs are processed when their status is checked for the polls_before_completion-th time (by default, the first time).
+"""
+
+class LocalBatchBackend:
+    def __init__(self, directory, responder=None, client=None, polls_before_completion=1):
+        if responder is None and client is None:
+            raise ValueError("LocalBatchBackend needs either a responder function or a client")
+        self.directory = directory
+        self.responder = responder
+        self.client = client
+        self.polls_before_completion = polls_before_completion
+        self._polls = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _batch_dir(self, batch_id):
+        return os.path.join(self.directory, batch_id)
+
+    def submit(self, input_path):
+        batch_id = "batch_local_{}".format(uuid.uuid4().hex)
+        os.makedirs(self._batch_dir(batch_id))
+        with open(input_path, 'r', encoding='utf-8') as source, open(os.path.join(self._batch_dir(batch_id), 'input.jsonl'), 'w', encoding='utf-8') as target:
+            target.write(source.read())
+        return batch_id
+
+    def status(self, batch_id):
+        if os.path.exists(os.path.join(self._batch_dir(batch_id), 'output.jsonl')):
+            return 'completed'
+        self._polls[batch_id] = self._polls.get(batch_id, 0) + 1
+        if self._polls[batch_id] < self.polls_before_completion:
+            return 'in_progress'
+        self._process(batch_id)
+        return 'completed'
+
+    def _answer(self, body):
+        if self.responder is not None:
+            content = self.responder(body)
+            return {
+                'object': 'chat.completion',
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}]
+            }
+        completion = self.client.chat.completions.create(**body)
+        return completion.model_dump() if hasattr(completion, 'model_dump') else completion
+
+    def _process(self, batch_id):
+        output_lines = []
+        with open(os.path.join(self._batch_dir(batch_id), 'input.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                output = {'id': "batch_req_{}".format(uuid.uuid4().hex), 'custom_id': request['custom_id'], 'response': None, 'error': None}
+                try:
+                    output['response'] = {'status_code': 200, 'body': self._answer(request['body'])}
+                except Exception as e:
+                    output['error'] = {'code': type(e).__name__, 'message': str(e)}
+                output_lines.append(output)
+        #  the output file is written at the end, so a job interrupted during processing is processed again
+        output_path = os.path.join(self._batch_dir(batch_id), 'output.jsonl')
+        with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+            for output in output_lines:
+                f.write(json.dumps(output, ensure_ascii=False) + "\n")
+        os.replace(output_path + '.tmp', output_path)
+
+    def results(self, batch_id):
+        with open(os.path.join(self._batch_dir(batch_id), 'output.jsonl'), 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def _read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _append_jsonl(path, lines):
+    with open(path, 'a', encoding='utf-8') as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+#  extracts the content of the answer from a line of the output file of a batch (None if the request failed)
+def _output_content(output):
+    response = output.get('response')
+    if output.get('error') or not response or response.get('status_code') != 200:
+        return None
+    try:
+        return response['body']['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+"""
+The following function runs one phase: it submits the requests (a dictionary custom_id -> request body) that have no result yet
+in work_dir, waits for the batch jobs to finish (checking their status every poll_interval seconds) and returns a dictionary
+custom_id -> content of the answer. Results are appended to '<phase>_results.jsonl' as soon as a job finishes, and the ids of
+the submitted jobs are saved in '<phase>_state.json', so that an interrupted phase is resumed without submitting requests twice.
+Requests that failed in the batch are not stored, so they are submitted again in the next run; they are missing from the returned dictionary.
+"""
+
+def run_batch_phase(phase, requests, backend, work_dir, poll_interval=60, max_requests_per_batch=MAX_REQUESTS_PER_BATCH):
+    results_path = os.path.join(work_dir, "{}_results.jsonl".format(phase))
+    state_path = os.path.join(work_dir, "{}_state.json".format(phase))
+
+    contents = {line['custom_id']: line['content'] for line in _read_jsonl(results_path)}
+    state = {'pending_batches': []}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+
+    #  submit the requests that have no result and are not part of a pending job
+    pending_ids = set(custom_id for batch in state['pending_batches'] for custom_id in batch['custom_ids'])
+    missing = [custom_id for custom_id in requests if custom_id not in contents and custom_id not in pending_ids]
+    for start in range(0, len(missing), max_requests_per_batch):
+        chunk = missing[start:start + max_requests_per_batch]
+        input_path = os.path.join(work_dir, "{}_input_{}_{}.jsonl".format(phase, int(time.time()), start // max_requests_per_batch))
+        _append_jsonl(input_path, [
+            {'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': requests[custom_id]}
+            for custom_id in chunk
+        ])
+        batch_id = backend.submit(input_path)
+        state['pending_batches'].append({'batch_id': batch_id, 'custom_ids': chunk})
+        _write_json(state_path, state)
+        print("Submitted batch {} ({} requests, phase {})".format(batch_id, len(chunk), phase))
+
+    #  wait for the pending jobs and ingest their results
+    while state['pending_batches']:
+        for batch in list(state['pending_batches']):
+            status = backend.status(batch['batch_id'])
+            if status not in TERMINAL_STATUSES:
+                continue
+            if status == 'completed':
+                new_lines = []
+                for output in backend.results(batch['batch_id']):
+                    content = _output_content(output)
+                    if content is not None and output['custom_id'] not in contents:
+                        contents[output['custom_id']] = content
+                        new_lines.append({'custom_id': output['custom_id'], 'content': content})
+                _append_jsonl(results_path, new_lines)
+            else:
+                print("Batch {} ended with status {}, its requests will be submitted again in the next run".format(batch['batch_id'], status))
+            state['pending_batches'].remove(batch)
+            _write_json(state_path, state)
+        if state['pending_batches']:
+            time.sleep(poll_interval)
+
+    return {custom_id: contents[custom_id] for custom_id in requests if custom_id in contents}
+
+
+#  request body of a prompt object, with the structured outputs mode of main_functions (see main_functions.set_structured_outputs)
+def _request_body(model_name, prompt_object):
+    mode = main_functions.STRUCTURED_OUTPUTS
+    prompt_object.output_format = 'json' if mode else 'text'
+    body = {
+        'model': model_name,
+        'messages': [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt_object.generate_prompt()}
+        ]
+    }
+    if mode:
+        body['response_format'] = prompt_object.response_format(mode)
+    return body
+
+
+def _parse_answer(prompt_object, answer):
+    try:
+        return prompt_object.checking_schema_function(answer)
+    except Exception:
+        return None
+
+
+"""
+The following function parses the answers of a phase (contents: key -> content of the answer) with the prompt objects of the requests
+(prompts: key -> prompt object, requests: key -> request body) and repairs the answers that cannot be parsed: each repair round is
+a batch phase ('<phase>_repair<n>', resumed like the other phases) with the request, the unparsable answer and the repair message of
+the prompt object, so only the failed requests are repeated. Each answer is counted in metrics_utils as 'parse_results' for stage
+(attempt 'first' or 'repair', result 'ok' or 'failed').
+It returns a dictionary key -> parsed answer, None for the answers that still cannot be parsed after main_functions.REPAIR_ATTEMPTS rounds.
+"""
+
+def parse_with_repair(phase, stage, prompts, requests, contents, backend, work_dir, model_name, poll_interval=60):
+    parsed = {}
+    unparsed = {}
+    for key, content in contents.items():
+        parsed[key] = _parse_answer(prompts[key], content)
+        metrics_utils.count('parse_results', 1, stage=stage, model=model_name, attempt='first', result='failed' if parsed[key] is None else 'ok')
+        if parsed[key] is None:
+            unparsed[key] = content
+
+    histories = {key: [] for key in unparsed}
+    for attempt in range(1, main_functions.REPAIR_ATTEMPTS + 1):
+        if not unparsed:
+            break
+        repair_phase = "{}_repair{}".format(phase, attempt)
+        repair_requests = {}
+        for key, answer in unparsed.items():
+            histories[key] = histories[key] + [
+                {"role": "assistant", "content": answer or ""},
+                {"role": "user", "content": prompts[key].repair_prompt(answer)},
+            ]
+            repair_requests[repair_phase + '-' + key] = dict(requests[key], messages=requests[key]['messages'] + histories[key])
+        repair_contents = run_batch_phase(repair_phase, repair_requests, backend, work_dir, poll_interval)
+
+        still_unparsed = {}
+        for key in unparsed:
+            content = repair_contents.get(repair_phase + '-' + key)
+            if content is None:
+                continue  # failed repair request: it is submitted again in the next run
+            parsed[key] = _parse_answer(prompts[key], content)
+            metrics_utils.count('parse_results', 1, stage=stage, model=model_name, attempt='repair', result='failed' if parsed[key] is None else 'ok')
+            if parsed[key] is None:
+                still_unparsed[key] = content
+        unparsed = still_unparsed
+    return parsed
+
+
+"""
+The following function maps all the keywords of a dataset with the two-phase batch flow described at the top of the file.
+- records: items from data_utils.get_sample / get_item_by_id or records from eval_utils.parse_excel_file
+- backend: OpenAIBatchBackend or LocalBatchBackend
+- work_dir: directory where requests, results and job states are stored (use the same directory to resume a run)
+- poll_interval: seconds between two checks of the status of the batch jobs
+- num_entities and NUM_NAMES: same as in useLLM_back_and_forth
+It returns a list with one dictionary per keyword, in the same format as async_utils.run_back_and_forth_on_dataset
+(keys 'record_index', 'keyword_index', 'Id', 'Language', 'Keyword', 'URIs', 'Error').
+"""
+
+def run_back_and_forth_batch(records, backend, model_name, work_dir, num_entities=1, NUM_NAMES=10, poll_interval=60):
+    os.makedirs(work_dir, exist_ok=True)
+
+    tasks = []
+    for record_index, record in enumerate(records):
+        record = data_utils.normalize_record(record)
+        for keyword_index, keyword in enumerate(record['Keywords']):
+            tasks.append({
+                'key': "{}-{}".format(record_index, keyword_index),
+                'record_index': record_index,
+                'keyword_index': keyword_index,
+                'record': record,
+                'Keyword': keyword
+            })
+
+    #  phase one: candidate generation
+    generation_prompts = {}
+    generation_requests = {}
+    for task in tasks:
+        record = task['record']
+        prompt_object = main_functions.generation_prompt_object(NUM_NAMES, record['Language'], record['Title_or'], record['Abstract_or'], task['Keyword'])
+        generation_prompts[task['key']] = prompt_object
+        generation_requests['generation-' + task['key']] = _request_body(model_name, prompt_object)
+    generation_contents = run_batch_phase('generation', generation_requests, backend, work_dir, poll_interval)
+    #  answers of the keywords whose candidates are not stored yet are parsed (and repaired if needed)
+    candidates_path = os.path.join(work_dir, 'candidates.jsonl')
+    candidates = {line['key']: line['candidates'] for line in _read_jsonl(candidates_path)}
+    generation_answers = {task['key']: generation_contents['generation-' + task['key']] for task in tasks
+                          if task['key'] not in candidates and 'generation-' + task['key'] in generation_contents}
+    generated_entities = parse_with_repair('generation', 'candidate_generation', generation_prompts,
+                                           {key: generation_requests['generation-' + key] for key in generation_answers},
+                                           generation_answers, backend, work_dir, model_name, poll_interval)
+
+    #  Wikidata lookups (stored in candidates.jsonl, so they are not repeated when the run is resumed)
+    errors = {}
+    for task in tasks:
+        key = task['key']
+        if key in candidates:
+            continue
+        if key not in generated_entities:
+            errors[key] = "Candidate generation request failed"
+            continue
+        llm_generated_entities = generated_entities[key]
+        if llm_generated_entities is None:
+            errors[key] = "Generated potential entities cannot be parsed"
+            continue
+        candidates[key] = main_functions.find_candidate_entities(llm_generated_entities)
+        _append_jsonl(candidates_path, [{'key': key, 'candidates': candidates[key]}])
+
+    #  phase two: entity selection
+    selection_prompts = {}
+    selection_requests = {}
+    short_circuited = {}
+    for task in tasks:
+        key = task['key']
+        if key not in candidates:
+            continue
+        #  keywords with at most one candidate are resolved without a selection request (see main_functions.short_circuit_selection)
+        key_candidates = main_functions.selection_candidates(candidates[key])
+        selected_entities = main_functions.short_circuit_selection(key_candidates)
+        if selected_entities is not None:
+            short_circuited[key] = selected_entities
+            continue
+        record = task['record']
+        prompt_object = main_functions.selection_prompt_object(num_entities, record['Language'], record['Title_or'], record['Abstract_or'], task['Keyword'], main_functions.format_candidate_entities(key_candidates))
+        selection_prompts[key] = prompt_object
+        selection_requests['selection-' + key] = _request_body(model_name, prompt_object)
+    selection_contents = run_batch_phase('selection', selection_requests, backend, work_dir, poll_interval)
+    selection_answers = {key: selection_contents['selection-' + key] for key in selection_prompts if 'selection-' + key in selection_contents}
+    selected_entities = parse_with_repair('selection', 'entity_selection', selection_prompts,
+                                          {key: selection_requests['selection-' + key] for key in selection_answers},
+                                          selection_answers, backend, work_dir, model_name, poll_interval)
+
+    results = []
+    for task in tasks:
+        key = task['key']
+        result = {
+            'record_index': task['record_index'],
+            'keyword_index': task['keyword_index'],
+            'Id': task['record']['Id'],
+            'Language': task['record']['Language'],
+            'Keyword': task['Keyword'],
+            'URIs': None,
+            'Error': errors.get(key)
+        }
+        if key in short_circuited:
+            result['URIs'] = short_circuited[key]
+        elif key in selection_prompts:
+            if key not in selected_entities:
+                result['Error'] = "Entity selection request failed"
+            elif selected_entities[key] is None:
+                result['Error'] = "Selected entities cannot be parsed"
+            else:
+                result['URIs'] = selected_entities[key]
+        results.append(result)
+    return results
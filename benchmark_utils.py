@@ -0,0 +1,404 @@
+"""This file contains benchmarks for the mapping pipelines.
+The benchmarks wrap the LLM client in UsageTrackingClient, which counts the calls and the tokens reported by the API
+(completion.usage), and measure the wall-clock time of each flow on the same records.
+
+Usage from the command line (the API key is read from the environment variable OPENAI_API_KEY or GROQ_API_KEY):
+python benchmark_utils.py prompting --input evaluation_files/Dset_Eval_KW_Alignment_Eval_def.xlsx --model gpt-4o-mini --records 10
+python benchmark_utils.py similarity --labels 5000
+
+The pipeline benchmark measures every mapping pipeline of main_functions.py on recorded responses (see replay_utils.py):
+first the responses are recorded once from the live services, then they are replayed locally as many times as needed,
+with a configurable injected latency, so that results can be compared across commits:
+python benchmark_utils.py record --input evaluation_files/Dset_Eval_KW_Alignment_Eval_def.xlsx --records 20 --fixtures bench_fixtures.json
+python benchmark_utils.py replay --fixtures bench_fixtures.json --latency 0.05 --llm-latency 0.5 --output bench_pipelines.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import threading
+import time
+
+import data_utils
+import main_functions
+import replay_utils
+import tools_utils
+
+
+"""
+The following class wraps an OpenAI-compatible client (OpenAI, Groq) and records, for each call to chat.completions.create,
+the number of prompt and completion tokens and the latency. It can be used everywhere a client is expected.
+"""
+
+class UsageTrackingClient:
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        self.chat = _TrackingChat(self)
+
+    def _create(self, **kwargs):
+        start = time.perf_counter()
+        completion = self.client.chat.completions.create(**kwargs)
+        latency = time.perf_counter() - start
+        usage = getattr(completion, 'usage', None)
+        with self._lock:
+            self.calls += 1
+            self.latencies.append(latency)
+            if usage is not None:
+                self.prompt_tokens += usage.prompt_tokens or 0
+                self.completion_tokens += usage.completion_tokens or 0
+        return completion
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.latencies = []
+
+    def stats(self):
+        return {
+            'llm_calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens,
+            'llm_seconds': sum(self.latencies)
+        }
+
+
+class _TrackingChat:
+    def __init__(self, tracker):
+        self.completions = _TrackingCompletions(tracker)
+
+
+class _TrackingCompletions:
+    def __init__(self, tracker):
+        self._tracker = tracker
+
+    def create(self, **kwargs):
+        return self._tracker._create(**kwargs)
+
+
+"""
+The following function compares the per-keyword flow (useLLM_back_and_forth, called once for each keyword) with the
+article-level flow (useLLM_back_and_forth_article, called once for each article) on the same records.
+records can be items from data_utils.get_sample or records from eval_utils.parse_excel_file.
+It returns a dictionary with, for each flow, the number of LLM calls, the prompt/completion tokens, the wall-clock time
+and the throughput (keywords per second), and the ratio between the two flows for tokens and time.
+Note that the Wikidata searches are part of the measured time: enable the Wikidata cache (tools_utils.enable_wikidata_cache)
+and run the benchmark twice if you want to compare only the LLM part.
+"""
+
+def benchmark_prompting_modes(records, client, model_name, num_entities=1, NUM_NAMES=10):
+    tracker = UsageTrackingClient(client)
+    records = [data_utils.normalize_record(record) for record in records]
+    number_of_keywords = sum(len(record['Keywords']) for record in records)
+
+    def run_per_keyword():
+        for record in records:
+            for keyword in record['Keywords']:
+                main_functions.useLLM_back_and_forth(record['Language'], record['Title_or'], record['Abstract_or'], keyword, tracker, model_name, num_entities, NUM_NAMES)
+
+    def run_article():
+        for record in records:
+            main_functions.useLLM_back_and_forth_article(record['Language'], record['Title_or'], record['Abstract_or'], record['Keywords'], tracker, model_name, num_entities, NUM_NAMES)
+
+    results = {'model': model_name, 'records': len(records), 'keywords': number_of_keywords}
+    for name, run in [('per_keyword', run_per_keyword), ('article', run_article)]:
+        tracker.reset()
+        start = time.perf_counter()
+        run()
+        wall_clock = time.perf_counter() - start
+        stats = tracker.stats()
+        stats['wall_clock_seconds'] = wall_clock
+        stats['keywords_per_second'] = number_of_keywords / wall_clock if wall_clock > 0 else 0
+        results[name] = stats
+
+    per_keyword, article = results['per_keyword'], results['article']
+    results['article_vs_per_keyword'] = {
+        'llm_calls': article['llm_calls'] / per_keyword['llm_calls'] if per_keyword['llm_calls'] else None,
+        'total_tokens': article['total_tokens'] / per_keyword['total_tokens'] if per_keyword['total_tokens'] else None,
+        'wall_clock_seconds': article['wall_clock_seconds'] / per_keyword['wall_clock_seconds'] if per_keyword['wall_clock_seconds'] else None
+    }
+    return results
+
+
+"""
+The following function compares the similarity methods of similarity_utils.top_k on the same queries and labels.
+For each method it reports the mean time per query (in milliseconds) and the speedup with respect to the per-pair
+SequenceMatcher loop ('sequence', the method originally used in tools_utils). It also reports how often the top-k of each method
+is identical to the SequenceMatcher top-k and the mean overlap between the two (the 'compat' method should always be identical).
+"""
+
+def benchmark_similarity(queries, labels, k=3, repeats=3):
+    import similarity_utils
+
+    reference = {query: similarity_utils.top_k(query, labels, k, method='sequence') for query in queries}
+    results = {'queries': len(queries), 'labels': len(labels), 'k': k}
+    for method in ['sequence', 'compat', 'ngram']:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            rankings = {query: similarity_utils.top_k(query, labels, k, method=method) for query in queries}
+        elapsed = (time.perf_counter() - start) / (repeats * len(queries))
+
+        identical = 0
+        overlap = 0
+        for query in queries:
+            expected = [index for index, _ in reference[query]]
+            got = [index for index, _ in rankings[query]]
+            identical += int(got == expected)
+            overlap += len(set(got) & set(expected)) / len(expected) if expected else 1
+        results[method] = {
+            'ms_per_query': elapsed * 1000,
+            'identical_top_k': identical / len(queries),
+            'mean_top_k_overlap': overlap / len(queries)
+        }
+    for method in ['compat', 'ngram']:
+        results[method]['speedup_vs_sequence'] = results['sequence']['ms_per_query'] / results[method]['ms_per_query']
+    return results
+
+
+#  labels for the similarity benchmark: the multilingual terms of query_terms.json and their pairwise combinations
+def _synthetic_labels(number_of_labels):
+    with open("query_terms.json", "r", encoding='utf-8') as file:
+        query_terms = json.load(file)
+    terms = sorted(set(term for entry in query_terms for term in entry.values()))
+    labels = list(terms)
+    for first in terms:
+        for second in terms:
+            if len(labels) >= number_of_labels:
+                return labels[:number_of_labels]
+            labels.append(first + " " + second)
+    return labels[:number_of_labels]
+
+
+PIPELINES = ['gotriple', 'spotlight', 'llm', 'openai', 'groq', 'back_and_forth']
+
+
+"""
+The following function runs the mapping pipelines on the same items and measures them. Pipelines are:
+- 'gotriple': data_utils.get_item_by_id for each item;
+- 'spotlight': main_functions.useDBPediaSpotlight (with context if context is set);
+- 'llm': main_functions.useLLM with local_model (a llama.cpp model, or replay_utils.ReplayLLMClient);
+- 'openai' and 'groq': main_functions.useOpenAILLM and main_functions.useGroqLLM with client;
+- 'back_and_forth': main_functions.useLLM_back_and_forth with client, for each keyword.
+items are in the item format (see data_utils.normalize_record) and context is the context given to the LLM pipelines ("Title", "All" or None).
+stats is the replay_utils.ReplayStats shared by the HTTP adapter and the LLM client, used to report the latency and the number of requests
+of each stage (GoTriple, Spotlight, SPARQL, Wikidata, LLM). The Wikidata search cache, the Spotlight cache and the
+DBPedia-to-Wikidata caches (SPARQL and sitelinks) are disabled/cleared before each pipeline, so every pipeline sends all its requests.
+For each pipeline it returns the number of keywords, the wall-clock time, the keywords per second, the latency of each call
+to the pipeline function ('call_latency'), and for each stage its latency percentiles, its number of requests and its misses.
+"""
+
+def benchmark_pipelines(items, pipelines, stats, client=None, model_name=None, local_model=None, context="All", num_entities=1, NUM_NAMES=10):
+    number_of_keywords = sum(len(item['Keywords']) for item in items)
+    calls = {
+        'gotriple': lambda item: data_utils.get_item_by_id(item['Id']),
+        'spotlight': lambda item: main_functions.useDBPediaSpotlight(item, context),
+        'llm': lambda item: main_functions.useLLM(item, local_model, context),
+        'openai': lambda item: main_functions.useOpenAILLM(item, model_name, context, client),
+        'groq': lambda item: main_functions.useGroqLLM(item, model_name, context, client)
+    }
+
+    results = {}
+    for pipeline in pipelines:
+        tools_utils.disable_wikidata_cache()
+        tools_utils.disable_spotlight_cache()
+        tools_utils.DBPEDIA_TO_WIKIDATA_CACHE.clear()
+        tools_utils.SITELINK_TO_WIKIDATA_CACHE.clear()
+        stats.reset()
+        call_latencies = []
+        errors = 0
+        start = time.perf_counter()
+        for item in items:
+            if pipeline == 'back_and_forth':
+                units = [lambda keyword=keyword: main_functions.useLLM_back_and_forth(item['Language'], item['Title_or'], item['Abstract_or'], keyword, client, model_name, num_entities, NUM_NAMES) for keyword in item['Keywords']]
+            else:
+                units = [lambda: calls[pipeline](item)]
+            for unit in units:
+                call_start = time.perf_counter()
+                try:
+                    unit()
+                except Exception as e:
+                    print("{} failed for item {}: {}".format(pipeline, item.get('Id'), e))
+                    errors += 1
+                call_latencies.append(time.perf_counter() - call_start)
+        wall_clock = time.perf_counter() - start
+
+        stages = stats.summary()
+        for service, count in stats.misses.items():
+            stages.setdefault(service, {'count': 0})['misses'] = count
+        results[pipeline] = {
+            'keywords': number_of_keywords,
+            'errors': errors,
+            'wall_clock_seconds': wall_clock,
+            'keywords_per_second': number_of_keywords / wall_clock if wall_clock > 0 else 0,
+            'call_latency': replay_utils.latency_summary(call_latencies),
+            'stages': stages,
+            'request_counts': stats.request_counts()
+        }
+    return results
+
+
+"""
+The following function records the responses of the live services for the given pipelines and saves them in fixtures_path
+(see replay_utils.FixtureStore), with the items, the model and the settings needed to replay them.
+client is the OpenAI or Groq client (provider is 'openai' or 'groq') and local_model an optional llama.cpp model for the 'llm' pipeline.
+It returns the measures of the live run (see benchmark_pipelines).
+"""
+
+def record_pipelines(records, fixtures_path, pipelines, client=None, provider='openai', model_name=None, local_model=None, context="All"):
+    store = replay_utils.FixtureStore()
+    stats = replay_utils.ReplayStats()
+    items = [data_utils.normalize_record(record) for record in records]
+    store.meta = {'items': items, 'pipelines': pipelines, 'provider': provider, 'model': model_name, 'context': context}
+    replay_utils.record_http(store, stats)
+    try:
+        results = benchmark_pipelines(
+            items, pipelines, stats,
+            client=replay_utils.RecordingLLMClient(client, store, stats) if client is not None else None,
+            model_name=model_name,
+            local_model=replay_utils.RecordingLLMClient(local_model, store, stats) if local_model is not None else None,
+            context=context
+        )
+    finally:
+        replay_utils.stop_http()
+        store.save(fixtures_path)
+    return results
+
+
+"""
+The following function replays the responses recorded with record_pipelines, without network.
+latency is the latency injected before each HTTP response, either in seconds or as a dictionary service -> seconds
+(services are 'gotriple', 'spotlight', 'sparql' and 'wikidata'), and llm_latency the latency injected before each LLM answer.
+Requests without a recorded response get a 404 (or an empty LLM answer) and are reported as misses of their stage.
+The results include the settings of the run and the current git commit, so that saved results can be compared across commits.
+"""
+
+def replay_pipelines(fixtures_path, pipelines=None, latency=0.0, llm_latency=0.0):
+    store = replay_utils.FixtureStore(fixtures_path)
+    stats = replay_utils.ReplayStats()
+    meta = store.meta
+    pipelines = pipelines or meta.get('pipelines', PIPELINES)
+    llm_client = replay_utils.ReplayLLMClient(store, llm_latency, stats, strict=False)
+    replay_utils.replay_http(store, latency, stats, strict=False)
+    try:
+        results = benchmark_pipelines(meta['items'], pipelines, stats, client=llm_client, model_name=meta.get('model'), local_model=llm_client, context=meta.get('context', "All"))
+    finally:
+        replay_utils.stop_http()
+    return {
+        'commit': _git_commit(),
+        'fixtures': os.path.basename(fixtures_path),
+        'records': len(meta['items']),
+        'model': meta.get('model'),
+        'latency': latency,
+        'llm_latency': llm_latency,
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'pipelines': results
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def _make_client(provider):
+    if provider == 'groq':
+        return tools_utils.groq_authentication(os.environ.get('GROQ_API_KEY'))
+    return tools_utils.openAI_authentication(os.environ.get('OPENAI_API_KEY'))
+
+
+def _load_records(path, limit):
+    if path.endswith('.xlsx'):
+        import eval_utils
+        records = eval_utils.parse_excel_file(path)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return records[:limit] if limit else records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the keyword mapping pipelines")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    prompting = subparsers.add_parser('prompting', help="per-keyword vs article-level prompting in useLLM_back_and_forth")
+    prompting.add_argument('--input', required=True, help="Excel file (parse_excel_file format) or JSONL file of items")
+    prompting.add_argument('--records', type=int, default=10, help="number of records to use (0 for all)")
+    prompting.add_argument('--model', default='gpt-4o-mini')
+    prompting.add_argument('--provider', choices=['openai', 'groq'], default='openai')
+    prompting.add_argument('--output', default=None, help="JSON file where the results are saved")
+
+    similarity = subparsers.add_parser('similarity', help="SequenceMatcher vs vectorized candidate scoring (offline)")
+    similarity.add_argument('--labels', type=int, default=5000, help="number of labels to score for each query")
+    similarity.add_argument('--labels-file', default=None, help="text file with one label per line (default: labels built from query_terms.json)")
+    similarity.add_argument('--k', type=int, default=3)
+    similarity.add_argument('--repeats', type=int, default=3)
+    similarity.add_argument('--output', default=None, help="JSON file where the results are saved")
+
+    record = subparsers.add_parser('record', help="record the responses of the live services for the pipeline benchmark")
+    record.add_argument('--input', required=True, help="Excel file (parse_excel_file format) or JSONL file of items")
+    record.add_argument('--records', type=int, default=20, help="number of records to use (0 for all)")
+    record.add_argument('--fixtures', required=True, help="JSON file where the responses are saved")
+    record.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=None, help="default: all the pipelines available with the given options")
+    record.add_argument('--model', default='gpt-4o-mini')
+    record.add_argument('--provider', choices=['openai', 'groq'], default='openai')
+    record.add_argument('--local-model', action='store_true', help="also record the 'llm' pipeline with the model loaded by tools_utils.loadLLM")
+    record.add_argument('--context', default="All", help="context given to the LLM pipelines (Title, All or None)")
+    record.add_argument('--output', default=None, help="JSON file where the measures of the live run are saved")
+
+    replay = subparsers.add_parser('replay', help="run the pipeline benchmark on recorded responses (offline)")
+    replay.add_argument('--fixtures', required=True, help="JSON file written by the record command")
+    replay.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=None, help="default: the recorded pipelines")
+    replay.add_argument('--latency', type=float, default=0.0, help="latency injected before each HTTP response (seconds)")
+    replay.add_argument('--service-latency', nargs=2, action='append', metavar=('SERVICE', 'SECONDS'), default=[], help="latency of a single service (gotriple, spotlight, sparql, wikidata), overrides --latency")
+    replay.add_argument('--llm-latency', type=float, default=0.0, help="latency injected before each LLM answer (seconds)")
+    replay.add_argument('--output', default=None, help="JSON file where the results are saved")
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'record':
+        records = _load_records(args.input, args.records)
+        pipelines = args.pipelines or ['gotriple', 'spotlight', args.provider, 'back_and_forth'] + (['llm'] if args.local_model else [])
+        local_model = tools_utils.loadLLM() if 'llm' in pipelines else None
+        context = None if args.context == 'None' else args.context
+        results = record_pipelines(records, args.fixtures, pipelines, _make_client(args.provider), args.provider, args.model, local_model, context)
+    elif args.benchmark == 'replay':
+        latency = args.latency
+        if args.service_latency:
+            latency = {service: args.latency for service in replay_utils.SERVICES}
+            latency.update({service: float(seconds) for service, seconds in args.service_latency})
+        results = replay_pipelines(args.fixtures, args.pipelines, latency, args.llm_latency)
+    elif args.benchmark == 'prompting':
+        records = _load_records(args.input, args.records)
+        results = benchmark_prompting_modes(records, _make_client(args.provider), args.model)
+    elif args.benchmark == 'similarity':
+        if args.labels_file:
+            with open(args.labels_file, 'r', encoding='utf-8') as f:
+                labels = [line.strip() for line in f if line.strip()][:args.labels]
+        else:
+            labels = _synthetic_labels(args.labels)
+        with open("query_terms.json", "r", encoding='utf-8') as file:
+            queries = [entry['en'] for entry in json.load(file)]
+        results = benchmark_similarity(queries, labels, args.k, args.repeats)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
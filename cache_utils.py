@@ -0,0 +1,407 @@
+"""This file contains the caches used by the tool to avoid repeating identical calls to external services
+(for example, the Wikidata API). Values are stored as JSON, so anything that can be serialized with json.dumps
+can be cached.
+Two tiers are available: an in-process memory tier (MemoryCache) and an on-disk tier backed by SQLite (SQLiteCache).
+TieredCache puts the memory tier in front of the disk tier, which is what the other modules normally use.
+CachingLLMClient uses them to cache the answers of LLM clients (OpenAI, Groq, llama_engine).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import metrics_utils
+
+
+"""
+The following class is a size-bounded LRU cache kept in memory, with an optional TTL (in seconds).
+When the cache is full, the least recently used entry is evicted. Expired entries are dropped when they are read.
+"""
+
+class MemoryCache:
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, created=None):
+        with self._lock:
+            self._data[key] = (value, created if created is not None else time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+"""
+The following class is a persistent cache stored in a SQLite file.
+- path is the location of the SQLite file (it is created if it does not exist).
+- ttl is the time to live of an entry in seconds (None means that entries never expire). An expired entry is dropped when it is read,
+and all the expired entries are deleted every EXPIRE_EVERY writes or EXPIRE_INTERVAL seconds (with an index on the creation time).
+- max_entries bounds the size of the cache: when it is exceeded, the least recently accessed entries are deleted.
+- max_bytes (optional) bounds the total size of the stored values in bytes, with the same eviction order.
+The number of entries and their total size are tracked in memory, so that a write does not scan the table; they are recomputed
+from the file every BYTES_REFRESH_EVERY writes, since other processes can write to the same file.
+Keys are strings, values are serialized as JSON. The connection can be shared by different threads.
+Reads do not write to the file: access times of the entries read are kept in memory and written in one transaction every
+ACCESS_FLUSH_EVERY reads, before the next write or eviction, and when the cache is closed (the file uses WAL with synchronous=NORMAL).
+A process that ends without closing the cache loses at most ACCESS_FLUSH_EVERY access times, which only changes the eviction order.
+"""
+
+class SQLiteCache:
+    BYTES_REFRESH_EVERY = 1000
+    ACCESS_FLUSH_EVERY = 100
+    EXPIRE_EVERY = 100
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, path, ttl=None, max_entries=100000, max_bytes=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+        #  files created before the size bound was introduced have no size column
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(cache)")]
+        if 'size' not in columns:
+            self._connection.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            self._connection.execute("UPDATE cache SET size = LENGTH(CAST(value AS BLOB))")
+        self._connection.commit()
+        self._writes = 0
+        self._expired_at = 0
+        self._accessed = {}
+        self._entries, self._bytes = self._stored_totals()
+
+    #  writes the access times kept in memory (the caller commits)
+    def _flush_accessed(self):
+        if self._accessed:
+            self._connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    #  number of entries and total size of the values in the file
+    def _stored_totals(self):
+        return self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+
+    def get(self, key):
+        """Returns the pair (value, creation time) stored for key, or None if the key is missing or expired"""
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created, size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created, size = row
+            if self.ttl is not None and now - created > self.ttl:
+                self._accessed.pop(key, None)
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._connection.commit()
+                self._entries -= 1
+                self._bytes -= size
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= SQLiteCache.ACCESS_FLUSH_EVERY:
+                self._flush_accessed()
+                self._connection.commit()
+        return json.loads(value), created
+
+    def set(self, key, value):
+        now = time.time()
+        serialized = json.dumps(value, ensure_ascii=False)
+        size = len(serialized.encode('utf-8'))
+        with self._lock:
+            self._accessed.pop(key, None)
+            self._flush_accessed()
+            previous = self._connection.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, now, now, size)
+            )
+            self._entries += 0 if previous else 1
+            self._bytes += size - (previous[0] if previous else 0)
+            self._writes += 1
+            if self._writes % SQLiteCache.BYTES_REFRESH_EVERY == 0:
+                self._entries, self._bytes = self._stored_totals()
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now):
+        #  expired entries go first (periodically), then the least recently accessed ones until the size bounds are respected
+        if self.ttl is not None and (self._writes % SQLiteCache.EXPIRE_EVERY == 0 or now - self._expired_at >= SQLiteCache.EXPIRE_INTERVAL):
+            self._expired_at = now
+            expiration = now - self.ttl
+            self._bytes -= self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache WHERE created < ?", (expiration,)).fetchone()[0]
+            self._entries -= self._connection.execute("DELETE FROM cache WHERE created < ?", (expiration,)).rowcount
+        if self._entries > self.max_entries:
+            self._bytes -= self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT size FROM cache ORDER BY accessed ASC LIMIT ?)", (self._entries - self.max_entries,)
+            ).fetchone()[0]
+            self._entries -= self._connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed ASC LIMIT ?)",
+                (self._entries - self.max_entries,)
+            ).rowcount
+        while self.max_bytes is not None and self._bytes > self.max_bytes:
+            rows = self._connection.execute("SELECT key, size FROM cache ORDER BY accessed ASC LIMIT 100").fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, entry_size in rows:
+                if self._bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                self._bytes -= entry_size
+            self._entries -= self._connection.executemany("DELETE FROM cache WHERE key = ?", evicted).rowcount
+
+    def clear(self):
+        with self._lock:
+            self._accessed.clear()
+            self._connection.execute("DELETE FROM cache")
+            self._connection.commit()
+            self._entries = 0
+            self._bytes = 0
+
+    def size_in_bytes(self):
+        with self._lock:
+            return self._bytes
+
+    def flush(self):
+        with self._lock:
+            self._flush_accessed()
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._flush_accessed()
+            self._connection.commit()
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+"""
+The following class combines a MemoryCache and (optionally) a SQLiteCache. Reads look in memory first, then on disk
+(entries found on disk are promoted to memory), and writes go to both tiers.
+The cache counts hits for each tier and misses (under a lock, since the cache is shared by threads), see the method stats.
+"""
+
+class TieredCache:
+    def __init__(self, path=None, ttl=None, max_entries=100000, memory_max_entries=10000, max_bytes=None):
+        self.memory = MemoryCache(max_entries=memory_max_entries, ttl=ttl)
+        self.disk = SQLiteCache(path, ttl=ttl, max_entries=max_entries, max_bytes=max_bytes) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            with self._lock:
+                self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                value, created = entry
+                self.memory.set(key, value, created=created)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def stats(self):
+        with self._lock:
+            memory_hits, disk_hits, misses = self.memory_hits, self.disk_hits, self.misses
+        lookups = memory_hits + disk_hits + misses
+        return {
+            'memory_hits': memory_hits,
+            'disk_hits': disk_hits,
+            'misses': misses,
+            'hit_rate': (memory_hits + disk_hits) / lookups if lookups else 0,
+            'memory_entries': len(self.memory),
+            'disk_entries': len(self.disk) if self.disk is not None else 0
+        }
+
+
+#  raised by CachingLLMClient in strict read-only mode (it is not retried by main_functions.completion_with_backoff)
+class CacheMissError(KeyError):
+    pass
+
+
+#  sampling parameters that do not change the answer, so they are not part of the key
+LLM_KEY_IGNORED_PARAMETERS = ('stream', 'timeout', 'user', 'extra_headers', 'extra_query', 'extra_body')
+LLM_CACHE_MODES = ('read-write', 'read-only', 'bypass')
+
+
+def _to_namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _to_namespace(v) for key, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+#  JSON-serializable copy of a completion (pydantic objects of the OpenAI and Groq clients, or SimpleNamespace objects)
+def _to_json_value(value):
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode='json')  # None values are kept (e.g. message.content of a tool call)
+    if isinstance(value, SimpleNamespace):
+        return {key: _to_json_value(v) for key, v in vars(value).items()}
+    if isinstance(value, dict):
+        return {key: _to_json_value(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(v) for v in value]
+    return value
+
+
+"""
+The following function returns the key of a chat completion request: a SHA-256 hash of the namespace (by default the provider,
+see CachingLLMClient), the model, the messages and the sampling parameters (temperature, top_p, max_tokens, seed, ...).
+"""
+
+def llm_request_key(namespace, kwargs):
+    parameters = {key: value for key, value in kwargs.items() if key not in LLM_KEY_IGNORED_PARAMETERS}
+    payload = json.dumps({'namespace': namespace, 'request': parameters}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+"""
+The following class wraps an OpenAI-compatible client (OpenAI, Groq, llama_engine.LocalLLMEngine) and caches its chat completions
+(content-addressed, see llm_request_key), in memory and in the SQLite file at path. It can be used everywhere the client is expected
+(attributes other than chat.completions are taken from the wrapped client). Parameters are:
+- mode: 'read-write' (answers are read from the cache and new answers are stored), 'read-only' (answers are read from the cache
+but nothing is stored: use it to re-run an evaluation on the answers of a previous run), or 'bypass' (the cache is not used)
+- strict: in 'read-only' mode, raise CacheMissError for a request that is not in the cache instead of calling the client
+- max_bytes: maximum size of the stored answers on disk (least recently used answers are evicted first), None for no limit
+- namespace: part of the key that separates providers (by default, the module of the client class, e.g. 'openai' or 'groq')
+Answers taken from the cache are objects with the same attributes as the completions of the client
+(choices[i].message.content, usage, model, ...). Note that with a sampling temperature greater than 0 the cache returns the first
+answer obtained for a prompt.
+stats() returns hits, misses, hit rate and the tokens saved by the hits.
+"""
+
+class CachingLLMClient:
+    def __init__(self, client, path="llm_completion_cache.sqlite", mode='read-write', strict=False, max_bytes=1 << 30,
+                 max_entries=1000000, memory_max_entries=10000, namespace=None):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError("Unknown cache mode: {} (expected one of {})".format(mode, ", ".join(LLM_CACHE_MODES)))
+        self.client = client
+        self.mode = mode
+        self.strict = strict
+        self.namespace = namespace if namespace is not None else type(client).__module__.split('.')[0]
+        self.cache = TieredCache(path, max_entries=max_entries, memory_max_entries=memory_max_entries, max_bytes=max_bytes) if mode != 'bypass' else None
+        self.hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create, with_raw_response=SimpleNamespace(create=self._create_raw)))
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['client'], name)
+
+    def _create(self, **kwargs):
+        return self._complete(kwargs)[0]
+
+    #  same as chat.completions.with_raw_response.create of the OpenAI client (the result has parse() and headers), so that
+    #  router_utils.LLMRouter sees the rate-limit headers of the wrapped client; headers are None for cached completions
+    def _create_raw(self, **kwargs):
+        completion, headers = self._complete(kwargs, raw=True)
+        return SimpleNamespace(parse=lambda: completion, headers=headers)
+
+    def _send(self, kwargs, raw):
+        completions = self.client.chat.completions
+        raw_create = getattr(getattr(completions, 'with_raw_response', None), 'create', None) if raw else None
+        if raw_create is None:
+            return completions.create(**kwargs), None
+        response = raw_create(**kwargs)
+        return response.parse(), response.headers
+
+    def _complete(self, kwargs, raw=False):
+        if self.cache is None:
+            return self._send(kwargs, raw)
+
+        key = llm_request_key(self.namespace, kwargs)
+        cached = self.cache.get(key)
+        metrics_utils.cache_lookup('llm_completion', cached is not None)
+        if cached is not None:
+            usage = cached.get('usage') or {}
+            with self._lock:
+                self.hits += 1
+                self.saved_prompt_tokens += usage.get('prompt_tokens') or 0
+                self.saved_completion_tokens += usage.get('completion_tokens') or 0
+            return _to_namespace(cached), None
+
+        with self._lock:
+            self.misses += 1
+        if self.mode == 'read-only' and self.strict:
+            raise CacheMissError("No cached completion for the request (model {})".format(kwargs.get('model')))
+        completion, headers = self._send(kwargs, raw)
+        if self.mode == 'read-write':
+            self.cache.set(key, _to_json_value(completion))
+        return completion, headers
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'mode': self.mode,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'saved_prompt_tokens': self.saved_prompt_tokens,
+            'saved_completion_tokens': self.saved_completion_tokens,
+            'disk_bytes': self.cache.disk.size_in_bytes() if self.cache is not None and self.cache.disk is not None else 0
+        }
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,265 @@
+"""This file contains a resumable runner for the mapping functions of main_functions.py.
+Instead of rewriting the whole list of records every few records (as in the evaluation notebook), the runner appends one JSON line
+per finished task to a journal file (a task is a (record, keyword) pair for useLLM_back_and_forth, or a whole record for the functions
+that map all the keywords of an item at once, such as useDBPediaSpotlight or useOpenAILLM). Lines are fsynced in batches,
+so a crash loses at most the last fsync_every tasks.
+When the runner is started again with the same journal, tasks already in the journal are skipped.
+At the end, compact_journal merges the journal with the records and writes the final JSON file, in the same format produced by the notebook.
+"""
+
+import json
+import os
+import threading
+from collections.abc import Mapping
+
+import data_utils
+import main_functions
+
+
+"""
+The following class is an append-only journal of finished tasks, stored as JSON lines.
+Each line has the keys 'record_id', 'record_index', 'keyword_index' (None for record-level tasks), 'keyword', 'result' and 'error'.
+When the journal is opened, the existing lines are read to know which tasks are done, and a truncated last line left by a crash
+is removed (see repair_tail), so that the next line is not appended to it.
+Lines are written immediately but fsynced every fsync_every lines (and when the journal is closed).
+"""
+
+class CheckpointJournal:
+    def __init__(self, path, fsync_every=20):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.done = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+        for entry in read_journal(path):
+            if entry.get('error') is None:
+                self.done.add(task_key(entry['record_id'], entry['keyword_index']))
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        repair_tail(path)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, record_id, keyword_index=None):
+        return task_key(record_id, keyword_index) in self.done
+
+    def append(self, record_id, record_index, keyword_index, keyword, result, error=None):
+        entry = {
+            'record_id': record_id,
+            'record_index': record_index,
+            'keyword_index': keyword_index,
+            'keyword': keyword,
+            'result': result,
+            'error': error
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            if error is None:
+                self.done.add(task_key(record_id, keyword_index))
+            self._pending += 1
+            if self._pending >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def task_key(record_id, keyword_index):
+    return "{}|{}".format(record_id, '' if keyword_index is None else keyword_index)
+
+
+"""
+The following function returns the identifiers used in the journal for the records of a dataset: the id of the record ('Id' or 'id'),
+followed by '#2', '#3', ... for the following records with the same id (the evaluation dataset contains duplicated ids).
+Records without an id are identified by their position in the dataset ('#' followed by the index).
+"""
+
+def record_identifiers(records):
+    identifiers = []
+    occurrences = {}
+    for record_index, record in enumerate(records):
+        record_id = record.get('Id', record.get('id'))
+        if record_id is None or record_id != record_id:  # NaN read from Excel
+            identifiers.append("#{}".format(record_index))
+            continue
+        record_id = str(record_id)
+        occurrences[record_id] = occurrences.get(record_id, 0) + 1
+        identifiers.append(record_id if occurrences[record_id] == 1 else "{}#{}".format(record_id, occurrences[record_id]))
+    return identifiers
+
+
+"""
+The following function removes the truncated last line that a crash can leave at the end of a JSON lines file (everything after
+the last newline), so that the lines appended afterwards start on a new line. It returns the number of bytes removed.
+"""
+
+def repair_tail(path, block_size=1 << 16):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = 0
+        position = size
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            position = start
+        if end < size:
+            f.truncate(end)
+    return size - end
+
+
+def read_journal(path):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                #  truncated line written during a crash
+                continue
+    return entries
+
+
+"""
+The following functions create the tasks for the mapping functions of main_functions.py, to be given to run_with_checkpoint.
+A keyword task is called with (record, keyword) and a record task with (record), where record is in the item format
+(see data_utils.normalize_record).
+"""
+
+def back_and_forth_task(client, model_name, num_entities=1, NUM_NAMES=10):
+    def task(record, keyword):
+        return main_functions.useLLM_back_and_forth(record['Language'], record['Title_or'], record['Abstract_or'], keyword, client, model_name, num_entities, NUM_NAMES)
+    return task
+
+
+def spotlight_task(context):
+    return lambda record: main_functions.useDBPediaSpotlight(record, context)
+
+
+def local_llm_task(model, context):
+    return lambda record: main_functions.useLLM(record, model, context)
+
+
+def openai_task(model, context, client):
+    return lambda record: main_functions.useOpenAILLM(record, model, context, client)
+
+
+def groq_task(model_name, context, client):
+    return lambda record: main_functions.useGroqLLM(record, model_name, context, client)
+
+
+"""
+The following function runs a task over all the records (items from get_sample / get_item_by_id, or records from eval_utils.parse_excel_file),
+appending each result to the journal at journal_path, and skipping the tasks already in the journal.
+- per_keyword: True if task is a keyword task (e.g. back_and_forth_task), False if it is a record task (e.g. spotlight_task)
+- fsync_every: number of journal lines after which the journal is fsynced
+- progress: optional function called with (number of finished tasks, total number of tasks) after each task (e.g. to update a tqdm bar)
+An exception raised by a task is recorded in the journal as the error of that task and does not stop the run;
+failed tasks are executed again when the runner is restarted.
+It returns a dictionary with the number of tasks 'done' in this run, 'skipped' (already in the journal) and 'failed'.
+"""
+
+def run_with_checkpoint(records, task, journal_path, per_keyword=True, fsync_every=20, progress=None):
+    stats = {'done': 0, 'skipped': 0, 'failed': 0}
+    with CheckpointJournal(journal_path, fsync_every) as journal:
+        #  records are normalized one at a time (a CompactItem is used as it is, so its abstract is loaded only if the task reads it)
+        total = sum(len(data_utils.normalize_record(record)['Keywords']) for record in records) if per_keyword else len(records)
+        finished = 0
+        for record_index, (record_id, record) in enumerate(zip(record_identifiers(records), records)):
+            record = data_utils.normalize_record(record)
+            if per_keyword:
+                units = [(keyword_index, keyword) for keyword_index, keyword in enumerate(record['Keywords'])]
+            else:
+                units = [(None, None)]
+            for keyword_index, keyword in units:
+                if journal.is_done(record_id, keyword_index):
+                    stats['skipped'] += 1
+                else:
+                    try:
+                        result = task(record, keyword) if per_keyword else task(record)
+                        journal.append(record_id, record_index, keyword_index, keyword, result)
+                        stats['done'] += 1
+                    except Exception as e:
+                        print("Task failed for record {} (keyword {}): {}".format(record_id, keyword, e))
+                        journal.append(record_id, record_index, keyword_index, keyword, None, "{}: {}".format(type(e).__name__, e))
+                        stats['failed'] += 1
+                finished += 1
+                if progress is not None:
+                    progress(finished, total)
+    return stats
+
+
+#  values that json cannot serialize: numpy numbers and arrays (ids and scores read with pandas) are converted to Python numbers and lists,
+#  the other values (e.g. timestamps) to strings
+def _json_default(value):
+    if hasattr(value, 'dtype') and hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+"""
+The following function is the compaction step: it merges the results in the journal with the records and writes them to output_path
+as a single JSON file (written once, at the end of the run). For each task, the last successful entry of the journal is used.
+- records from eval_utils.parse_excel_file: keyword results are stored in each keyword dictionary under result_field
+(by default 'llm_uris', like in the evaluation notebook; failed or missing keywords get an empty list);
+- items from get_sample / get_item_by_id: keyword results are stored in item[result_field] as a list aligned with item['Keywords'];
+- record-level results are stored in record[result_field].
+The records are not modified: the function returns the merged copies.
+"""
+
+def compact_journal(journal_path, records, output_path, result_field='llm_uris'):
+    results = {}
+    for entry in read_journal(journal_path):
+        key = task_key(entry['record_id'], entry['keyword_index'])
+        if entry.get('error') is None or key not in results:
+            results[key] = entry
+
+    def result_of(key):
+        entry = results.get(key)
+        if entry is None or entry.get('error') is not None or entry['result'] is None:
+            return []
+        return entry['result']
+
+    merged = []
+    for record_id, record in zip(record_identifiers(records), records):
+        if isinstance(record, Mapping) and not isinstance(record, dict):
+            record = record.to_dict() if hasattr(record, 'to_dict') else dict(record)  # e.g. data_utils.CompactItem
+        record = json.loads(json.dumps(record, default=_json_default))  # deep copy (NaN values from Excel are kept)
+        if task_key(record_id, None) in results:
+            record[result_field] = result_of(task_key(record_id, None))
+        elif 'kws' in record:
+            for keyword_index, kw in enumerate(record['kws']):
+                kw[result_field] = result_of(task_key(record_id, keyword_index))
+        else:
+            record[result_field] = [result_of(task_key(record_id, keyword_index)) for keyword_index in range(len(record.get('Keywords', [])))]
+        merged.append(record)
+
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(merged, f, ensure_ascii=False, indent=2)
+    os.replace(output_path + '.tmp', output_path)
+    return merged
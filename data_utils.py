@@ -1,29 +1,39 @@
 import json
-import requests
+import queue
+import sqlite3
+import sys
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import cache_utils
+import http_utils
 
 """
 Function for executing a query using the GoTriple API.
-Takes as parameters the language of the articles we want as output and the query term.
-Returns the data in Json format if the request was successful (by default, it searches for 250 documents), 
+Takes as parameters the language of the articles we want as output, the query term, the number of documents to retrieve (size, by default 250)
+and, optionally, the page of results to retrieve (pages start from 1, see iter_sample).
+Returns the data in Json format if the request was successful, 
 None (and print an error message otherwise)
 It could be improved using other parameters, for example Year (which is not useful for our purposes).
 """
 
-def query_api(language, query_term, size=10):
+def query_api(language, query_term, size=250, page=None):
     
     url = 'https://api.gotriple.eu/documents'
     params = {
         'q': query_term,
         'include_duplicates': 'false',
         'fq': 'in_language={}'.format(language),  
-        'size': 250
+        'size': size
     }
+    if page is not None:
+        params['page'] = page
 
     headers = {
         'accept': 'application/json'
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    response = http_utils.get(url, headers=headers, params=params)
 
     if response.status_code == 200:
         data = response.json()
@@ -48,7 +58,7 @@ returned
 
 def get_item_by_id(id):
     url = 'https://api.gotriple.eu/documents/{}'.format(id)
-    response = requests.get(url)
+    response = http_utils.get(url)
     if response.status_code == 200:
         document = response.json()
         keywords_original_language = [kw['text'] for kw in document["keywords"]]
@@ -105,6 +115,37 @@ def get_item_from_user():
     return item
 
 
+"""
+The following function converts a document returned by the GoTriple API into an item (see get_sample for the structure of an item),
+keeping only the keywords in the given language. It returns None if the document has no keywords in that language.
+"""
+
+def document_to_item(document, language):
+    keywords_original_language = [kw['text'] for kw in document["keywords"] if kw["lang"] == language]
+    if len(keywords_original_language) == 0:
+        return None
+    item = {}
+    item['Language'] = language
+    item['Id'] = document["id"]
+    item['Keywords'] = []
+    item['Title_eng'] = None
+    item['Title_or'] = None
+    item['Abstract_eng'] = None
+    item['Abstract_or'] = None
+    for headline in document["headline"]:
+        if headline["lang"] == "en":
+            item['Title_eng'] = headline["text"]
+        if headline["lang"] == language:
+            item['Title_or'] = headline["text"]
+    for abstract in document["abstract"]:
+        if abstract["lang"] == "en":
+            item['Abstract_eng'] = abstract["text"]
+        if abstract["lang"] == language:
+            item['Abstract_or'] = abstract["text"]
+    item['Keywords'] = keywords_original_language
+    return item
+
+
 def get_sample(languages, sample_size):
     total_items = []
     #  load the Json file with a list of query terms in different languages, useful to make queries
@@ -118,7 +159,12 @@ def get_sample(languages, sample_size):
         query_terms_it = iter(query_terms)
         keywords_count = 0
         while (keywords_count < keywords_per_language):
-            next_query_term = next(query_terms_it)
+            next_query_term = next(query_terms_it, None)
+            if next_query_term is None:
+                print("Not enough keywords found for language {} ({} instead of {})".format(language, keywords_count, keywords_per_language))
+                break
+            if language not in next_query_term:
+                continue
             data = query_api(language, next_query_term[language])
             try:
                 try_item = data[0]
@@ -126,28 +172,9 @@ def get_sample(languages, sample_size):
                 print("Error in API query")
             else:
                 for document in data:
-                    keywords_original_language = [kw['text'] for kw in document["keywords"] if kw["lang"] == language]
-                    if len(keywords_original_language) > 0:
-                        item = {}
-                        item['Language'] = language
-                        item['Id'] = document["id"]
-                        item['Keywords'] = []
-                        item['Title_eng'] = None
-                        item['Title_or'] = None
-                        item['Abstract_eng'] = None
-                        item['Abstract_or'] = None
-                        for headline in document["headline"]:
-                            if headline["lang"] == "en":
-                                item['Title_eng'] = headline["text"]
-                            if headline["lang"] == language:
-                                item['Title_or'] = headline["text"]
-                        for abstract in document["abstract"]:
-                            if abstract["lang"] == "en":
-                                item['Abstract_eng'] = abstract["text"]
-                            if abstract["lang"] == language:
-                                item['Abstract_or'] = abstract["text"]
-                        item['Keywords'] = keywords_original_language
-                        keywords_count += len(keywords_original_language)
+                    item = document_to_item(document, language)
+                    if item is not None:
+                        keywords_count += len(item['Keywords'])
                         items.append(item)
 
 
@@ -156,13 +183,93 @@ def get_sample(languages, sample_size):
         items = []
         keywords_count = 0
         while (keywords_count < keywords_per_language):
-            next_item = next(items_iter)
+            next_item = next(items_iter, None)
+            if next_item is None:
+                break
             items.append(next_item)
             keywords_count += len(next_item['Keywords'])
         total_items.extend(items)
 
     return total_items
 
+"""
+The following function is a streaming version of get_sample, for large samples (e.g. tens of thousands of keywords).
+Instead of returning a list, it is a generator that yields items as soon as they are fetched, so the whole sample is never kept in memory.
+Languages are fetched concurrently by a pool of max_workers threads. For each language, the function goes through the query terms
+of query_terms.json and pages through the results of each term (page_size documents per request, at most max_pages pages per term);
+requests for a language stop as soon as its keyword quota (sample_size / number of languages) is met, or when the query terms are exhausted
+(a message is printed in that case). Documents already returned for a language are skipped.
+Items have the same structure as in get_sample, but they are yielded in the order they arrive (items of different languages are interleaved).
+If the generator is closed before the end (e.g. break in a for loop), the workers stop after their current request.
+"""
+
+def iter_sample(languages, sample_size, page_size=100, max_pages=10, max_workers=4, query_terms_path="query_terms.json"):
+    with open(query_terms_path, "r") as file: 
+        query_terms = json.load(file)
+    keywords_per_language = sample_size / len(languages)
+
+    items_queue = queue.Queue(maxsize=1000)  #  bounded, so that workers wait if the consumer is slower
+    stop = threading.Event()
+    done = object()
+
+    def put(element):
+        while not stop.is_set():
+            try:
+                items_queue.put(element, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_language(language):
+        keywords_count = 0
+        seen_ids = set()
+        try:
+            for query_term in query_terms:
+                if language not in query_term:
+                    continue
+                for page in range(1, max_pages + 1):
+                    if stop.is_set() or keywords_count >= keywords_per_language:
+                        return
+                    data = query_api(language, query_term[language], size=page_size, page=page)
+                    if not data:
+                        break
+                    for document in data:
+                        if document["id"] in seen_ids:
+                            continue
+                        seen_ids.add(document["id"])
+                        item = document_to_item(document, language)
+                        if item is None:
+                            continue
+                        if not put(item):
+                            return
+                        keywords_count += len(item['Keywords'])
+                        if keywords_count >= keywords_per_language:
+                            return
+                    if len(data) < page_size:
+                        break
+            print("Not enough keywords found for language {} ({} instead of {})".format(language, keywords_count, keywords_per_language))
+        except Exception as e:
+            print("Error while fetching documents for language {}: {}".format(language, e))
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for language in languages:
+            executor.submit(fetch_language, language)
+        finished = 0
+        while finished < len(languages):
+            element = items_queue.get()
+            if element is done:
+                finished += 1
+            else:
+                yield element
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
 """
 The following function generates prompts to be given to LLMs.
 The function takes two parameters: 
@@ -209,4 +316,197 @@ def prompt_generator(item, context):
         Please, don't match keywords to the code of WikiData entities (e.g., Q123456), but to the entity name.
         INCLUDE EACH SEPARATE ENTITY BETWEEN [] IN THE ANSWER }} [/INST]
     """.format(", ".join([kw for kw in item['Keywords']]))
-    return prompt
\ No newline at end of file
+    return prompt
+
+"""
+The tool works with two record formats: the items produced by get_sample and get_item_by_id (keys 'Language', 'Id', 'Title_or',
+'Abstract_or', 'Keywords', where Keywords is a list of strings) and the records produced by eval_utils.parse_excel_file 
+(keys 'language', 'id', 'title_or', 'abstract_or', 'kws', where kws is a list of dictionaries with a 'label' key).
+The following function takes a record in either format and returns a dictionary with the keys of the first format 
+(keywords are always returned as a list of strings), so that the batch functions can accept both.
+Missing values (None or NaN, as read from Excel) are replaced by empty strings for titles and abstracts.
+A CompactItem (see below) already has the keys of the first format and is returned as it is: its keywords stay a tuple and its abstracts
+are still loaded from the abstract store only when they are read.
+"""
+
+def normalize_record(record):
+    if isinstance(record, CompactItem):
+        return record
+
+    def text_value(*keys):
+        for key in keys:
+            value = record.get(key)
+            if isinstance(value, str):
+                return value
+        return ""
+
+    if 'Keywords' in record:
+        keywords = list(record['Keywords'])
+    else:
+        keywords = [kw['label'] if isinstance(kw, dict) else kw for kw in record.get('kws', [])]
+
+    return {
+        'Language': record.get('Language', record.get('language')),
+        'Id': record.get('Id', record.get('id')),
+        'Keywords': keywords,
+        'Title_eng': text_value('Title_eng', 'title_eng'),
+        'Title_or': text_value('Title_or', 'title_or'),
+        'Abstract_eng': text_value('Abstract_eng', 'abstract_eng'),
+        'Abstract_or': text_value('Abstract_or', 'abstract_or')
+    }
+
+
+def _is_missing(value):
+    return value is None or value != value  # NaN read from Excel
+
+
+"""
+Items and records are plain dictionaries that keep the titles and the abstracts of the article in memory for the whole run.
+For large samples, CompactItem is a smaller representation of an item: its attributes are stored in __slots__ (no per-item dictionary),
+language codes and keywords are interned (the same string object is shared by all the items that have it) and the abstracts
+are not kept in the item but loaded from an abstract store only when they are read (e.g. when a prompt with the abstract is built).
+A CompactItem is a read-only mapping with the keys of the items of get_sample ('Language', 'Id', 'Keywords', 'Title_eng', 'Title_or',
+'Abstract_eng', 'Abstract_or'), so it can be given to all the functions that take an item (main_functions, normalize_record,
+dedup_utils, spotlight_utils, checkpoint_utils). Keywords are a tuple. to_dict() returns the equivalent item.
+normalize_record returns a CompactItem as it is, and these functions read 'Abstract_or' / 'Abstract_eng' only when they build a prompt
+with the abstract as context, so the abstracts of the other items are never loaded.
+Abstract stores have a method get(item_id) returning the pair (abstract_or, abstract_eng), or None:
+- SQLiteAbstractStore: a side store in a SQLite file, filled by compact_item;
+- GoTripleAbstractStore: downloads the article from GoTriple (get_item_by_id) when the abstract is needed.
+Abstracts are looked up by the Id of the item, so items without an Id always keep their abstracts in memory.
+Both stores can be pickled, so CompactItems can be sent to worker processes (e.g. the process pool of keywords_translation.py):
+a SQLiteAbstractStore is pickled as the path of its file (pending writes are committed first) and opens its own connection
+in the worker, a GoTripleAbstractStore starts with an empty cache.
+"""
+
+class SQLiteAbstractStore:
+    def __init__(self, path="abstracts.sqlite", commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self._open()
+
+    def _open(self):
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS abstracts (id TEXT PRIMARY KEY, abstract_or TEXT NOT NULL, abstract_eng TEXT NOT NULL)")
+        self._connection.commit()
+
+    def __getstate__(self):
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+        return {'path': self.path, 'commit_every': self.commit_every}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.commit_every = state['commit_every']
+        self._open()
+
+    def put(self, item_id, abstract_or, abstract_eng):
+        if _is_missing(item_id):
+            raise ValueError("Abstracts of items without an Id cannot be stored")
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO abstracts (id, abstract_or, abstract_eng) VALUES (?, ?, ?)", (str(item_id), abstract_or or "", abstract_eng or ""))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._connection.commit()
+                self._pending = 0
+
+    def get(self, item_id):
+        with self._lock:
+            row = self._connection.execute("SELECT abstract_or, abstract_eng FROM abstracts WHERE id = ?", (str(item_id),)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+class GoTripleAbstractStore:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        #  the last abstracts downloaded are kept, since the prompts of all the keywords of an article are usually built one after the other
+        self._cache = cache_utils.MemoryCache(max_entries=max_entries)
+
+    def __getstate__(self):
+        return {'max_entries': self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'])
+
+    def get(self, item_id):
+        abstracts = self._cache.get(item_id)
+        if abstracts is None:
+            item = get_item_by_id(item_id)
+            if item is None:
+                return None
+            abstracts = (item['Abstract_or'] or "", item['Abstract_eng'] or "")
+            self._cache.set(item_id, abstracts)
+        return abstracts
+
+
+class CompactItem(Mapping):
+    __slots__ = ('Language', 'Id', 'Keywords', 'Title_eng', 'Title_or', '_abstracts', '_store')
+    KEYS = ('Language', 'Id', 'Keywords', 'Title_eng', 'Title_or', 'Abstract_eng', 'Abstract_or')
+
+    def __init__(self, language, item_id, keywords, title_or="", title_eng="", abstract_or="", abstract_eng="", store=None):
+        self.Language = sys.intern(language) if isinstance(language, str) else language
+        self.Id = item_id
+        self.Keywords = tuple(sys.intern(keyword) for keyword in keywords)
+        self.Title_or = title_or
+        self.Title_eng = title_eng
+        self._store = store
+        #  with a store the abstracts are not kept in the item
+        self._abstracts = None if store is not None else (abstract_or or "", abstract_eng or "")
+
+    def abstracts(self):
+        if self._abstracts is not None:
+            return self._abstracts
+        return self._store.get(self.Id) or ("", "")
+
+    def __getitem__(self, key):
+        if key == 'Abstract_or':
+            return self.abstracts()[0]
+        if key == 'Abstract_eng':
+            return self.abstracts()[1]
+        if key in CompactItem.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(CompactItem.KEYS)
+
+    def __len__(self):
+        return len(CompactItem.KEYS)
+
+    def to_dict(self):
+        item = dict(self)
+        item['Keywords'] = list(self.Keywords)
+        return item
+
+    def __repr__(self):
+        return "CompactItem(Language={!r}, Id={!r}, Keywords={!r})".format(self.Language, self.Id, self.Keywords)
+
+
+"""
+The following function converts an item or a record (see normalize_record) to a CompactItem. If store has a method put (SQLiteAbstractStore),
+the abstracts are written to the store; with a store without put (GoTripleAbstractStore) they are dropped and downloaded when needed;
+without a store, or if the item has no Id, they are kept in the item.
+"""
+
+def compact_item(record, store=None):
+    if isinstance(record, CompactItem):
+        return record
+    item = normalize_record(record)
+    if _is_missing(item['Id']):
+        store = None  # abstracts are found by Id
+    if store is not None and hasattr(store, 'put'):
+        store.put(item['Id'], item['Abstract_or'], item['Abstract_eng'])
+    return CompactItem(item['Language'], item['Id'], item['Keywords'], item['Title_or'], item['Title_eng'], item['Abstract_or'], item['Abstract_eng'], store)
+
+
+def compact_items(records, store=None):
+    for record in records:
+        yield compact_item(record, store)
@@ -0,0 +1,162 @@
+"""This file contains a planning stage that deduplicates keywords across a whole dataset before they are mapped.
+In GoTriple the same keyword often appears in many articles of the same language (e.g. 'sociologie' or 'gender'), and the mapping
+functions resolve each occurrence independently, paying the LLM calls and the Wikidata searches every time.
+The plan groups the occurrences by language and normalized keyword (case, Unicode form, spaces and surrounding punctuation are ignored);
+each group is resolved once and the result is copied back to every occurrence.
+Groups are resolved either without context (context='none': empty title and abstract, so the result depends only on the keyword)
+or with the context of one representative article of the group (context='representative': the first article of the group
+with an abstract, or with a title).
+Both the items produced by data_utils.get_sample / get_item_by_id and the records produced by eval_utils.parse_excel_file
+are accepted (see data_utils.normalize_record).
+"""
+
+import copy
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import data_utils
+import main_functions
+
+
+CONTEXT_MODES = ('none', 'representative')
+
+
+def normalize_keyword(keyword):
+    keyword = unicodedata.normalize('NFKC', keyword).casefold()
+    keyword = " ".join(keyword.split())
+    return re.sub(r'^[\W_]+|[\W_]+$', '', keyword) or keyword
+
+
+"""
+The following function builds the plan for a dataset. It returns a dictionary with:
+- 'context': the context mode
+- 'groups': a list of groups, each a dictionary with the keys 'Language', 'Keyword' (the first surface form of the keyword),
+'Normalized', 'Occurrences' (list of pairs (record index, keyword index)), and 'Title' and 'Abstract' (the context used to resolve the group,
+empty strings with context='none')
+- 'stats': see dedup_stats
+"""
+
+def plan_keyword_groups(records, context='none'):
+    if context not in CONTEXT_MODES:
+        raise ValueError("Unknown context mode: {} (expected one of {})".format(context, ", ".join(CONTEXT_MODES)))
+
+    groups = {}
+    context_scores = {}
+    for record_index, record in enumerate(records):
+        record = data_utils.normalize_record(record)
+        #  (score, title, abstract) of the record as a representative, read only when a group still needs a better one,
+        #  so that no abstract is loaded with context='none' (see data_utils.CompactItem)
+        candidate = None
+        for keyword_index, keyword in enumerate(record['Keywords']):
+            key = (record['Language'], normalize_keyword(keyword))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {'Language': record['Language'], 'Keyword': keyword, 'Normalized': key[1], 'Occurrences': [], 'Title': "", 'Abstract': ""}
+                context_scores[key] = -1
+            group['Occurrences'].append((record_index, keyword_index))
+            if context == 'representative' and context_scores[key] < 2:
+                if candidate is None:
+                    abstract = record['Abstract_or']
+                    #  an article with an abstract is a better representative than an article with only a title
+                    candidate = (2 if abstract else (1 if record['Title_or'] else 0), record['Title_or'], abstract)
+                if candidate[0] > context_scores[key]:
+                    context_scores[key], group['Title'], group['Abstract'] = candidate
+
+    plan = {'context': context, 'groups': list(groups.values())}
+    plan['stats'] = dedup_stats(plan)
+    return plan
+
+
+"""
+The following function returns the statistics of a plan: number of keyword occurrences, number of groups (resolutions actually made),
+dedupe ratio (fraction of the occurrences that are not resolved, 1 - groups / occurrences), reduction factor (occurrences / groups)
+and the same numbers for each language.
+"""
+
+def dedup_stats(plan):
+    def summary(groups):
+        occurrences = sum(len(group['Occurrences']) for group in groups)
+        return {
+            'occurrences': occurrences,
+            'groups': len(groups),
+            'dedupe_ratio': 1 - len(groups) / occurrences if occurrences else 0.0,
+            'reduction_factor': occurrences / len(groups) if groups else 1.0
+        }
+
+    languages = sorted(set(group['Language'] for group in plan['groups']), key=str)
+    stats = summary(plan['groups'])
+    stats['by_language'] = {language: summary([group for group in plan['groups'] if group['Language'] == language]) for language in languages}
+    return stats
+
+
+#  copies the result of each group to its occurrences, as a list of per-keyword dictionaries in the format of async_utils
+def _fan_out(records, plan, group_results):
+    groups = {occurrence: group_index for group_index, group in enumerate(plan['groups']) for occurrence in group['Occurrences']}
+    results = []
+    for record_index, record in enumerate(records):
+        record = data_utils.normalize_record(record)
+        for keyword_index, keyword in enumerate(record['Keywords']):
+            group_index = groups.get((record_index, keyword_index))
+            if group_index is None:
+                continue
+            value, error = group_results[group_index]
+            results.append({
+                'record_index': record_index,
+                'keyword_index': keyword_index,
+                'Id': record['Id'],
+                'Language': record['Language'],
+                'Keyword': keyword,
+                'URIs': copy.deepcopy(value),
+                'Error': error,
+                'Group': group_index
+            })
+    return results
+
+
+"""
+The following function resolves each group of the plan once with resolver, a function called with (language, title, abstract, keyword),
+and returns a list with one dictionary per keyword occurrence, in the same order as the records and their keywords, with the keys
+of async_utils.run_back_and_forth_on_dataset ('record_index', 'keyword_index', 'Id', 'Language', 'Keyword', 'URIs', 'Error')
+and 'Group' (index of the group in the plan). The result can be given to async_utils.attach_results_to_records.
+Groups are resolved by max_workers threads; an exception raised for a group is reported as the 'Error' of all its occurrences.
+If plan is None, it is built with plan_keyword_groups(records, context).
+"""
+
+def run_deduplicated(records, resolver, context='none', max_workers=4, plan=None):
+    if plan is None:
+        plan = plan_keyword_groups(records, context)
+
+    def resolve(group):
+        try:
+            return resolver(group['Language'], group['Title'], group['Abstract'], group['Keyword']), None
+        except Exception as e:
+            return None, "{}: {}".format(type(e).__name__, e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        group_results = list(executor.map(resolve, plan['groups']))
+    return _fan_out(records, plan, group_results)
+
+
+def back_and_forth_resolver(client, model_name, num_entities=1, NUM_NAMES=10):
+    def resolver(language, title, abstract, keyword):
+        return main_functions.useLLM_back_and_forth(language, title, abstract, keyword, client, model_name, num_entities, NUM_NAMES)
+    return resolver
+
+
+"""
+The following function is the deduplicated version of async_utils.run_back_and_forth_on_dataset: the groups of the plan are mapped
+with the asyncio runner (with the same concurrency limits) and the results are copied to all the occurrences.
+"""
+
+def run_back_and_forth_deduplicated(records, client, model_name, context='none', llm_concurrency=8, wikidata_concurrency=16, num_entities=1, NUM_NAMES=10, plan=None):
+    import async_utils
+
+    if plan is None:
+        plan = plan_keyword_groups(records, context)
+    group_records = [
+        {'Id': group_index, 'Language': group['Language'], 'Title_or': group['Title'], 'Abstract_or': group['Abstract'], 'Keywords': [group['Keyword']]}
+        for group_index, group in enumerate(plan['groups'])
+    ]
+    group_results = async_utils.run_back_and_forth_on_dataset(group_records, client, model_name, llm_concurrency, wikidata_concurrency, num_entities, NUM_NAMES)
+    return _fan_out(records, plan, [(result['URIs'], result['Error']) for result in group_results])
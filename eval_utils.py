@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 def parse_excel_file(filepath: str) -> list:
@@ -100,3 +101,154 @@ def compute_precision(correct_uris, retrieved_uris):
         return len(set(correct_uris) & set(retrieved_uris)) / len(retrieved_uris)
 
 
+"""
+Columnar evaluation.
+The functions below are a columnar alternative to parse_excel_file and to the per-keyword loops of the evaluation notebook.
+The wide sheet (one row per article, with kw_i / Wikidata_url_kw_i / match_kw_i columns) is melted once into a long table with one row
+per keyword, and precision, recall and F1 are computed for all the systems at once with vectorized pandas operations,
+grouped by language, match type and system.
+"""
+
+KEYWORD_COLUMNS = ('kw_{}', 'Wikidata_url_kw_{}', 'match_kw_{}')
+
+
+def _non_empty(values):
+    return pd.notna(values) & (values.astype(str) != "")
+
+
+"""
+The following function reads the evaluation Excel file (or takes a DataFrame already read) and returns a long DataFrame with one row per keyword,
+keeping the same keywords as parse_excel_file (non-empty label and non-empty Wikidata URL or match).
+Columns are: 'record_index' (position of the article, the same as the index in the list returned by parse_excel_file), 'kw_index'
+(position of the keyword in the 'kws' list of the record), 'language', 'id', 'label', 'wikidata_url' (list of URLs) and 'match'.
+"""
+
+def parse_excel_file_long(filepath_or_df) -> pd.DataFrame:
+    df = filepath_or_df if isinstance(filepath_or_df, pd.DataFrame) else pd.read_excel(filepath_or_df)
+
+    indexes = sorted(int(col[3:]) for col in df.columns if isinstance(col, str) and col.startswith('kw_') and col[3:].isdigit())
+    number_of_rows, number_of_indexes = len(df), len(indexes)
+
+    #  each (number_of_rows x number_of_indexes) block is flattened row by row, so keywords keep the order of the sheet
+    def block(template):
+        return df.reindex(columns=[template.format(i) for i in indexes]).to_numpy(dtype=object).ravel()
+
+    long = pd.DataFrame({
+        'record_index': np.repeat(np.arange(number_of_rows), number_of_indexes),
+        'language': np.repeat(df['language'].to_numpy(dtype=object) if 'language' in df else None, number_of_indexes),
+        'id': np.repeat(df['id'].to_numpy(dtype=object) if 'id' in df else None, number_of_indexes),
+        'label': pd.Series(block(KEYWORD_COLUMNS[0]), dtype=object),
+        'wikidata_url': pd.Series(block(KEYWORD_COLUMNS[1]), dtype=object),
+        'match': pd.Series(block(KEYWORD_COLUMNS[2]), dtype=object)
+    })
+
+    keep = _non_empty(long['label']) & (_non_empty(long['wikidata_url']) | _non_empty(long['match']))
+    long = long[keep].reset_index(drop=True)
+    long['kw_index'] = long.groupby('record_index').cumcount()
+    long['wikidata_url'] = [url.split(";") if isinstance(url, str) else [] for url in long['wikidata_url']]
+    long['match'] = long['match'].where(pd.notna(long['match']), "")
+    return long[['record_index', 'kw_index', 'language', 'id', 'label', 'wikidata_url', 'match']]
+
+
+"""
+The following function converts the output of a system, stored in records produced by parse_excel_file (as in the evaluation notebook,
+where each keyword dictionary gets a field such as 'llm_uris'), into a long DataFrame with columns 'system', 'record_index', 'kw_index'
+and 'retrieved' (list of URIs). Missing or None outputs become empty lists.
+URIs split on their dots by the old EntitySelectionPrompt parser (e.g. ['http://www', 'wikidata', 'org/entity/Q5']) are joined again,
+like in the evaluation notebook.
+"""
+
+def system_outputs_from_records(records, field='llm_uris', system='llm') -> pd.DataFrame:
+    rows = []
+    for record_index, record in enumerate(records):
+        for kw_index, kw in enumerate(record['kws']):
+            retrieved = kw.get(field) or []
+            if len(retrieved) == 3 and retrieved[1] == "wikidata":
+                retrieved = ['.'.join(retrieved)]
+            rows.append((system, record_index, kw_index, list(retrieved)))
+    return pd.DataFrame(rows, columns=['system', 'record_index', 'kw_index', 'retrieved'])
+
+
+#  normalizes Wikidata URLs of the dataset (https://www.wikidata.org/wiki/Q1) to the URIs returned by the tools (http://www.wikidata.org/entity/Q1)
+def normalize_wikidata_uris(uris: pd.Series) -> pd.Series:
+    return uris.astype(str).str.replace("https", "http", regex=False).str.replace("/wiki/", "/entity/", regex=False)
+
+
+"""
+The following function computes precision, recall and F1 for each (system, keyword) pair, in the same way as compute_precision and compute_recall:
+recall = |correct & retrieved| / number of correct URIs, precision = |correct & retrieved| / number of retrieved URIs (0 when the denominator is 0).
+- gold: the long DataFrame returned by parse_excel_file_long
+- outputs: a long DataFrame as returned by system_outputs_from_records (outputs of several systems can be concatenated)
+- match_types: only keywords with these match types are scored (like in the evaluation notebook)
+Keywords without an output for a system are scored as if the system retrieved nothing.
+It returns a DataFrame with one row per (system, keyword) and the columns of gold plus 'system', 'correct', 'retrieved_count', 'hits',
+'precision', 'recall' and 'f1'.
+"""
+
+def score_keywords(gold: pd.DataFrame, outputs: pd.DataFrame, match_types=("e", "r")) -> pd.DataFrame:
+    keys = ['record_index', 'kw_index']
+    gold = gold[gold['match'].isin(match_types)]
+
+    gold_uris = gold[keys + ['wikidata_url']].explode('wikidata_url').dropna(subset=['wikidata_url'])
+    gold_uris['uri'] = normalize_wikidata_uris(gold_uris['wikidata_url'])
+    correct = gold_uris.groupby(keys).size().rename('correct')
+
+    retrieved_uris = outputs[['system'] + keys + ['retrieved']].explode('retrieved').dropna(subset=['retrieved'])
+    retrieved_uris['uri'] = retrieved_uris['retrieved'].astype(str)
+    retrieved_count = retrieved_uris.groupby(['system'] + keys).size().rename('retrieved_count')
+
+    hits = (
+        retrieved_uris[['system'] + keys + ['uri']].drop_duplicates()
+        .merge(gold_uris[keys + ['uri']].drop_duplicates(), on=keys + ['uri'])
+        .groupby(['system'] + keys).size().rename('hits')
+    )
+
+    systems = pd.DataFrame({'system': outputs['system'].unique()})
+    scores = systems.merge(gold, how='cross')
+    scores = scores.join(correct, on=keys).join(retrieved_count, on=['system'] + keys).join(hits, on=['system'] + keys)
+    scores[['correct', 'retrieved_count', 'hits']] = scores[['correct', 'retrieved_count', 'hits']].fillna(0).astype(int)
+
+    scores['recall'] = np.where(scores['correct'] > 0, scores['hits'] / scores['correct'].clip(lower=1), 0.0)
+    scores['precision'] = np.where(scores['retrieved_count'] > 0, scores['hits'] / scores['retrieved_count'].clip(lower=1), 0.0)
+    denominator = scores['precision'] + scores['recall']
+    scores['f1'] = np.where(denominator > 0, 2 * scores['precision'] * scores['recall'] / denominator.where(denominator > 0, 1), 0.0)
+    return scores
+
+
+"""
+The following function aggregates the scores returned by score_keywords.
+For each group (by default: system; add 'language' or 'match' to get the breakdowns of the evaluation notebook) it returns:
+- macro_precision, macro_recall, macro_f1: means of the per-keyword values (the values printed by the evaluation notebook)
+- micro_precision, micro_recall, micro_f1: computed from the summed hits, correct and retrieved counts
+- keywords: number of scored keywords
+"""
+
+def compute_metrics(scores: pd.DataFrame, by=('system',)) -> pd.DataFrame:
+    grouped = scores.groupby(list(by))
+    metrics = grouped.agg(
+        keywords=('f1', 'size'),
+        macro_precision=('precision', 'mean'),
+        macro_recall=('recall', 'mean'),
+        macro_f1=('f1', 'mean'),
+        hits=('hits', 'sum'),
+        correct=('correct', 'sum'),
+        retrieved_count=('retrieved_count', 'sum')
+    )
+    metrics['micro_precision'] = np.where(metrics['retrieved_count'] > 0, metrics['hits'] / metrics['retrieved_count'].clip(lower=1), 0.0)
+    metrics['micro_recall'] = np.where(metrics['correct'] > 0, metrics['hits'] / metrics['correct'].clip(lower=1), 0.0)
+    denominator = metrics['micro_precision'] + metrics['micro_recall']
+    metrics['micro_f1'] = np.where(denominator > 0, 2 * metrics['micro_precision'] * metrics['micro_recall'] / denominator.where(denominator > 0, 1), 0.0)
+    return metrics.drop(columns=['hits', 'correct', 'retrieved_count'])
+
+
+"""
+The following function returns the three tables of the evaluation notebook report (total, per match type, per language) for all the systems.
+"""
+
+def evaluation_report(gold: pd.DataFrame, outputs: pd.DataFrame, match_types=("e", "r")) -> dict:
+    scores = score_keywords(gold, outputs, match_types)
+    return {
+        'Total': compute_metrics(scores, ['system']),
+        'Per_match_type': compute_metrics(scores, ['system', 'match']),
+        'Per_language': compute_metrics(scores, ['system', 'language'])
+    }
@@ -0,0 +1,129 @@
+"""This file contains the HTTP client shared by all the functions that call external services
+(GoTriple API, DBPedia Spotlight, Wikidata API).
+Instead of calling requests.get directly, the other modules call http_utils.get, which uses a single requests.Session.
+The session keeps a pool of keep-alive connections for each host (so that TCP and TLS handshakes are not repeated
+for every request), applies default connect/read timeouts and retries requests that fail with 429 or 5xx status codes,
+with exponential backoff (the Retry-After header sent by the server is honored).
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics_utils
+
+
+USER_AGENT = "T3.4.1_KeywordsTranslation (https://github.com/atrium-research/T3.4.1_KeywordsTranslation)"
+
+#  default configuration, it can be changed with the function configure
+POOL_CONNECTIONS = 10  # number of hosts for which a connection pool is kept
+POOL_MAXSIZE = 20  # maximum number of keep-alive connections kept for each host
+TIMEOUT = (5, 60)  # (connect timeout, read timeout) in seconds
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1  # waits 1s, 2s, 4s, ... between retries (unless the server sends Retry-After)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session():
+    retry = Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'POST', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False  # after the last retry the response is returned, so callers can check the status code
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    return session
+
+
+"""
+The following function returns the shared session (it is created the first time the function is called).
+The session can be used safely by different threads.
+"""
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+"""
+The following function changes the configuration of the HTTP client. Parameters left to None keep their current value.
+- pool_connections: number of hosts for which a pool of connections is kept
+- pool_maxsize: maximum number of connections kept alive for each host (it should be at least the number of threads making requests)
+- timeout: default timeout in seconds, either a number or a pair (connect timeout, read timeout)
+- max_retries and backoff_factor: retry policy for connection errors and 429/5xx responses
+The current session is closed and a new one is created with the new configuration.
+"""
+
+def configure(pool_connections=None, pool_maxsize=None, timeout=None, max_retries=None, backoff_factor=None):
+    global POOL_CONNECTIONS, POOL_MAXSIZE, TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR, _session
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    if timeout is not None:
+        TIMEOUT = timeout
+    if max_retries is not None:
+        MAX_RETRIES = max_retries
+    if backoff_factor is not None:
+        BACKOFF_FACTOR = backoff_factor
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = _build_session()
+    return _session
+
+
+#  when instrumentation is enabled (see metrics_utils), each request is reported with its host, status code and number of retries
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    if not metrics_utils.ENABLED:
+        return get_session().request(method, url, **kwargs)
+
+    host = urlsplit(url).netloc
+    with metrics_utils.span('http_request', host=host):
+        response = get_session().request(method, url, **kwargs)
+    metrics_utils.count('http_requests', 1, host=host, status=response.status_code)
+    retries = getattr(getattr(response.raw, 'retries', None), 'history', None)
+    if retries:
+        metrics_utils.count('http_retries', len(retries), host=host)
+    return response
+
+
+"""
+The following functions are drop-in replacements for requests.get and requests.post: they take the same arguments,
+use the shared session and apply the default timeout if no timeout is given.
+"""
+
+def get(url, params=None, **kwargs):
+    return request('GET', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('POST', url, data=data, json=json, **kwargs)
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
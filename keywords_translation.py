@@ -0,0 +1,472 @@
+"""This file is the command-line entry point of the tool, to map the keywords of many articles outside the notebooks:
+python -m keywords_translation map --input articles.xlsx --backend back-and-forth --provider openai --model gpt-4o-mini --workers 4 --output results.jsonl
+
+Input is read in a streaming way (one article at a time), from:
+- an Excel file in the format of the evaluation dataset (one row per article, columns language, id, title_or, abstract_or, kw_0, kw_1, ...);
+- a JSONL file with one article per line (items from data_utils.get_sample, records from eval_utils.parse_excel_file, or {"id": ...}
+lines with only a GoTriple id);
+- a text file with one GoTriple id per line (or ids given with --ids): articles are downloaded with data_utils.get_item_by_id.
+Articles are spread over a pool of worker processes. Each worker creates its client (OpenAI, Groq, local llama.cpp model) once
+and reuses it for all its articles. Results are written to the output JSONL file as soon as they are ready (one line per article,
+in completion order, with the position of the article in the input as 'index'); with --resume, articles already in the output are skipped.
+Articles that failed are mapped again by --resume and their new line is appended, so an output file can have several lines for the same
+index: readers must keep the last successful line of each index (shard_utils.read_output), or use the merge command, which writes one line per index.
+Local inference (--backend local, --provider local or a local --route) runs in a single worker, since each worker process loads its own
+copy of the GGUF model and uses all the CPU threads.
+With --route, the workers are threads of this process instead of processes: they share a single router_utils.LLMRouter, so the rpm / tpm
+limits (given or learned from the headers) hold for the whole run and not for each worker, and the adaptive concurrency of each provider
+can grow up to the number of workers (16 by default).
+Progress and throughput are printed on stderr. Each run also writes a manifest next to its output ('<output>.manifest.json').
+Large jobs can be split over several machines with --num-shards and --shard, and the outputs merged with the merge command (see shard_utils.py).
+
+Backends are the functions of main_functions.py:
+- spotlight: useDBPediaSpotlight
+- openai / groq: useOpenAILLM / useGroqLLM (API keys are read from OPENAI_API_KEY / GROQ_API_KEY)
+- back-and-forth: useLLM_back_and_forth for each keyword, with the client of --provider (openai, groq or local), or with a router_utils.LLMRouter
+over several providers (--route)
+- local: useLLM with a local GGUF model (see llama_engine.py)
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import data_utils
+import shard_utils
+
+
+BACKENDS = ('spotlight', 'openai', 'groq', 'back-and-forth', 'local')
+
+#  state of a worker process, created once by _init_worker
+_WORKER = {}
+
+
+def _is_empty(value):
+    return value is None or value == "" or value != value  # NaN
+
+
+"""
+The following function reads an Excel file row by row (with openpyxl in read-only mode, so the whole sheet is never loaded in memory)
+and yields one record per row in the format of eval_utils.parse_excel_file. If the sheet has the gold columns of the evaluation dataset
+(Wikidata_url_kw_i, match_kw_i), keywords are filtered as in parse_excel_file (a keyword is kept only if it has a Wikidata URL or a match).
+"""
+
+def iter_excel_records(path):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell) if cell is not None else "" for cell in next(rows)]
+        indexes = sorted(int(column[3:]) for column in header if column.startswith('kw_') and column[3:].isdigit())
+        has_gold = any(column.startswith('Wikidata_url_kw_') or column.startswith('match_kw_') for column in header)
+        for row in rows:
+            values = dict(zip(header, row))
+            record = {
+                'language': values.get('language'),
+                'id': values.get('id'),
+                'title_or': values.get('title_or'),
+                'title_eng': values.get('title_eng'),
+                'abstract_or': values.get('abstract_or'),
+                'abstract_eng': values.get('abstract_eng'),
+                'kws': []
+            }
+            for i in indexes:
+                label = values.get('kw_{}'.format(i))
+                wikidata_url = values.get('Wikidata_url_kw_{}'.format(i))
+                match = values.get('match_kw_{}'.format(i))
+                if _is_empty(label):
+                    continue
+                if has_gold and _is_empty(wikidata_url) and _is_empty(match):
+                    continue
+                record['kws'].append({
+                    'label': str(label),
+                    'wikidata_url': str(wikidata_url).split(";") if not _is_empty(wikidata_url) else [],
+                    'match': match if not _is_empty(match) else ""
+                })
+            if record['language'] is None and record['id'] is None and not record['kws']:
+                continue  # empty row
+            yield record
+    finally:
+        workbook.close()
+
+
+def iter_jsonl_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_id_records(ids):
+    for gotriple_id in ids:
+        gotriple_id = gotriple_id.strip()
+        if gotriple_id:
+            yield {'id': gotriple_id}
+
+
+"""
+The following function yields the input articles, according to the extension of path ('.xlsx', '.jsonl'/'.json', otherwise a text file of ids)
+or to ids if path is None.
+"""
+
+def iter_input(path=None, ids=None, input_format=None):
+    if path is None:
+        return iter_id_records(ids or [])
+    input_format = input_format or ('xlsx' if path.endswith('.xlsx') else 'jsonl' if path.endswith(('.jsonl', '.json')) else 'ids')
+    if input_format == 'xlsx':
+        return iter_excel_records(path)
+    if input_format == 'jsonl':
+        return iter_jsonl_records(path)
+    return iter_id_records(open(path, 'r', encoding='utf-8'))
+
+
+def _make_client(provider, config):
+    if provider == 'local':
+        import llama_engine
+        client = llama_engine.get_engine(config['local_model'])
+    else:
+        import tools_utils
+        if provider == 'groq':
+            client = tools_utils.groq_authentication(os.environ.get('GROQ_API_KEY'))
+        else:
+            client = tools_utils.openAI_authentication(os.environ.get('OPENAI_API_KEY'))
+    if config.get('llm_cache'):
+        import cache_utils
+        client = cache_utils.CachingLLMClient(client, config['llm_cache'], mode=config.get('llm_cache_mode', 'read-write'))
+    return client
+
+
+#  routes are strings 'provider=model[,rpm=N][,tpm=N]' (e.g. 'groq=llama-3.3-70b-versatile,rpm=30,tpm=6000'), see router_utils.LLMRouter;
+#  without rpm / tpm the limits are learned from the rate-limit headers of the provider
+def _parse_route(route):
+    provider, _, value = route.partition('=')
+    if provider not in ('openai', 'groq', 'local'):
+        raise ValueError("unknown provider {!r} (expected openai, groq or local)".format(provider))
+    model, *options = value.split(',')
+    limits = {}
+    for option in options:
+        name, _, number = option.partition('=')
+        if name not in ('rpm', 'tpm') or not number.isdigit():
+            raise ValueError("invalid route option {!r} (expected rpm=N or tpm=N)".format(option))
+        limits[name] = int(number)
+    return provider, model or None, limits
+
+
+def _make_router(routes, config):
+    import router_utils
+
+    providers = []
+    for route in routes:
+        provider, model, limits = _parse_route(route)
+        providers.append(router_utils.Provider(provider, _make_client(provider, config), model=model, **limits))
+    return router_utils.LLMRouter(providers)
+
+
+#  True if the back-and-forth calls go through a router, which must be shared by all the workers (they are then threads, see run_map)
+def _uses_router(config):
+    return config['backend'] == 'back-and-forth' and bool(config.get('routes'))
+
+
+#  True if the workers load a local GGUF model
+def _uses_local_model(config):
+    if config['backend'] == 'local':
+        return True
+    if config['backend'] != 'back-and-forth':
+        return False
+    if config.get('routes'):
+        return any(_parse_route(route)[0] == 'local' for route in config['routes'])
+    return config['provider'] == 'local'
+
+
+#  initializer of the worker processes: the client is created once per process and reused for all the articles
+def _init_worker(config):
+    import main_functions
+
+    _WORKER.clear()
+    _WORKER['config'] = config
+    main_functions.set_structured_outputs(config.get('structured_outputs'))
+    backend = config['backend']
+    if backend in ('openai', 'groq'):
+        _WORKER['client'] = _make_client(backend, config)
+    elif backend == 'back-and-forth' and config.get('routes'):
+        _WORKER['client'] = _make_router(config['routes'], config)
+    elif backend == 'back-and-forth':
+        _WORKER['client'] = _make_client(config['provider'], config)
+    elif backend == 'local':
+        import llama_engine
+        _WORKER['client'] = llama_engine.get_engine(config['local_model'])
+
+
+"""
+The following function maps one article in a worker process and returns the line written to the output file:
+'index', 'Id', 'Language', 'Keywords', 'backend', 'result' (the value returned by the main_functions function; for back-and-forth,
+a list aligned with 'Keywords'), 'error' (None or the error message) and 'seconds'.
+"""
+
+def map_record(index, record):
+    import main_functions
+
+    config = _WORKER['config']
+    backend = config['backend']
+    context = config['context']
+    start = time.perf_counter()
+    line = {'index': index, 'Id': record.get('Id', record.get('id')), 'Language': None, 'Keywords': [], 'backend': backend, 'result': None, 'error': None}
+    try:
+        if set(record) <= {'id', 'Id'}:
+            item = data_utils.get_item_by_id(line['Id'])
+            if item is None:
+                raise ValueError("article not found on GoTriple or without keywords")
+        else:
+            item = record
+        item = data_utils.normalize_record(item)
+        line['Language'] = item['Language']
+        line['Keywords'] = item['Keywords']
+
+        if backend == 'spotlight':
+            line['result'] = main_functions.useDBPediaSpotlight(item, bool(context))
+        elif backend == 'openai':
+            line['result'] = main_functions.useOpenAILLM(item, config['model'], context, _WORKER['client'])
+        elif backend == 'groq':
+            line['result'] = main_functions.useGroqLLM(item, config['model'], context, _WORKER['client'])
+        elif backend == 'local':
+            line['result'] = main_functions.useLLM(item, _WORKER['client'], context)
+        else:
+            results = []
+            errors = []
+            for keyword in item['Keywords']:
+                try:
+                    results.append(main_functions.useLLM_back_and_forth(item['Language'], item['Title_or'], item['Abstract_or'], keyword, _WORKER['client'], config['model'], config['num_entities'], config['num_names']))
+                except Exception as e:
+                    results.append(None)
+                    errors.append("{}: {}: {}".format(keyword, type(e).__name__, e))
+            line['result'] = results
+            line['error'] = "; ".join(errors) or None
+    except Exception as e:
+        line['error'] = "{}: {}".format(type(e).__name__, e)
+    line['seconds'] = time.perf_counter() - start
+    return line
+
+
+#  indexes of the articles already mapped without errors in an existing output file (for --resume)
+def _done_indexes(output_path):
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # truncated last line
+                if entry.get('error') is None:
+                    done.add(entry['index'])
+    return done
+
+
+class _Progress:
+    def __init__(self, every):
+        self.every = every
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.records = 0
+        self.keywords = 0
+        self.failed = 0
+        self.skipped = 0
+        self.input_records = 0
+
+    def add(self, line):
+        self.records += 1
+        self.keywords += len(line['Keywords'])
+        self.failed += line['error'] is not None
+        now = time.perf_counter()
+        if now - self.last >= self.every:
+            self.last = now
+            print(self.format(), file=sys.stderr, flush=True)
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'records': self.records,
+            'keywords': self.keywords,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'input_records': self.input_records,
+            'seconds': elapsed,
+            'records_per_second': self.records / elapsed if elapsed > 0 else 0,
+            'keywords_per_second': self.keywords / elapsed if elapsed > 0 else 0
+        }
+
+    def format(self):
+        stats = self.stats()
+        return "{records} articles ({failed} failed, {skipped} skipped), {keywords} keywords in {seconds:.0f}s: {records_per_second:.2f} articles/s, {keywords_per_second:.2f} keywords/s".format(**stats)
+
+
+"""
+The following function runs the mapping. records is an iterable of articles, config the worker configuration (see main) and workers the number
+of worker processes (0 to run in the current process; with routes, the number of worker threads sharing the router). With num_shards > 1, only the articles of the given shard are mapped (see shard_utils.py);
+indexes in the output are always positions in the whole input. At most max_in_flight articles are read ahead of the results, so the memory used
+does not depend on the size of the input. With resume, the truncated last line left by an interrupted run is removed before new lines are appended.
+Local inference needs workers <= 1 (ValueError otherwise). If assigned is a set, the indexes of all the articles of the shard (including
+those skipped by resume) are added to it, to check that the output is complete (see shard_utils.finish_manifest).
+It returns the throughput statistics, with the number of articles read from the input ('input_records').
+"""
+
+def run_map(records, config, output_path, workers=4, resume=False, max_in_flight=None, progress_every=10, shard=0, num_shards=1, assigned=None):
+    if workers > 1 and _uses_local_model(config):
+        raise ValueError("Local inference loads the model in each worker process: use a single worker")
+    if resume:
+        import checkpoint_utils
+        checkpoint_utils.repair_tail(output_path)
+    done = _done_indexes(output_path) if resume else set()
+    progress = _Progress(progress_every)
+    max_in_flight = max_in_flight or max(1, workers) * 4
+
+    def pending_records():
+        for index, record in enumerate(records):
+            progress.input_records = index + 1
+            if num_shards > 1 and shard_utils.record_shard(index, record, num_shards) != shard:
+                continue
+            if assigned is not None:
+                assigned.add(index)
+            if index in done:
+                progress.skipped += 1
+                continue
+            yield index, record
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as output:
+        def write(line):
+            output.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+            output.flush()
+            progress.add(line)
+
+        if workers == 0:
+            _init_worker(config)
+            for index, record in pending_records():
+                write(map_record(index, record))
+        else:
+            if _uses_router(config):
+                #  a router per process would apply the rate limits to each process: one router is shared by threads
+                _init_worker(config)
+                executor = ThreadPoolExecutor(max_workers=workers)
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config,))
+            with executor:
+                in_flight = set()
+                for index, record in pending_records():
+                    in_flight.add(executor.submit(map_record, index, record))
+                    if len(in_flight) >= max_in_flight:
+                        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            write(future.result())
+                for future in wait(in_flight).done:
+                    write(future.result())
+
+    print(progress.format(), file=sys.stderr, flush=True)
+    return progress.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m keywords_translation", description="Mapping of GoTriple keywords to Wikidata entities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    mapping = subparsers.add_parser('map', help="map the keywords of a set of articles")
+    mapping.add_argument('--input', default=None, help="Excel file, JSONL file or text file with one GoTriple id per line")
+    mapping.add_argument('--input-format', choices=['xlsx', 'jsonl', 'ids'], default=None, help="format of the input (default: from the extension)")
+    mapping.add_argument('--ids', nargs='+', default=None, help="GoTriple ids (instead of --input)")
+    mapping.add_argument('--output', required=True, help="JSONL file where results are written")
+    mapping.add_argument('--backend', choices=BACKENDS, default='back-and-forth')
+    mapping.add_argument('--provider', choices=['openai', 'groq', 'local'], default='openai', help="client used by the back-and-forth backend")
+    mapping.add_argument('--route', nargs='+', default=None, metavar='PROVIDER=MODEL[,rpm=N][,tpm=N]', help="spread the back-and-forth calls over several providers (see router_utils.py), e.g. --route groq=llama-3.3-70b-versatile,rpm=30,tpm=6000 openai=gpt-4o-mini (limits not given are learned from the rate-limit headers)")
+    mapping.add_argument('--model', default='gpt-4o-mini', help="model name for the openai, groq and back-and-forth backends")
+    mapping.add_argument('--local-model', default=None, help="path of the GGUF model for the local backend and provider")
+    mapping.add_argument('--context', default='All', help="context given to the models: Title, All or None (for spotlight, None disables the context)")
+    mapping.add_argument('--num-entities', type=int, default=1)
+    mapping.add_argument('--num-names', type=int, default=10)
+    mapping.add_argument('--structured-outputs', choices=['json_object', 'json_schema'], default=None, help="structured outputs of the back-and-forth stages (see main_functions.set_structured_outputs)")
+    mapping.add_argument('--llm-cache', default=None, help="SQLite file of the LLM completion cache (see cache_utils.CachingLLMClient)")
+    mapping.add_argument('--llm-cache-mode', choices=['read-write', 'read-only', 'bypass'], default='read-write')
+    mapping.add_argument('--workers', type=int, default=None, help="number of worker processes (0 to run in this process; default: 4, 1 for local inference); with --route, number of worker threads sharing the router (default: 16)")
+    mapping.add_argument('--limit', type=int, default=None, help="maximum number of articles to read")
+    mapping.add_argument('--resume', action='store_true', help="skip the articles already mapped in the output file")
+    mapping.add_argument('--progress-every', type=float, default=10, help="seconds between progress lines")
+    mapping.add_argument('--stats', default=None, help="JSON file where the throughput statistics are saved")
+    mapping.add_argument('--num-shards', type=int, default=1, help="number of shards of the job (see shard_utils.py)")
+    mapping.add_argument('--shard', type=int, default=0, help="shard mapped by this run (0 to num-shards - 1); '{shard}' in --output is replaced by it")
+
+    merge = subparsers.add_parser('merge', help="merge the outputs of the shards of a job (see shard_utils.py)")
+    merge.add_argument('--manifests', nargs='+', required=True, help="manifest files of the shards (glob patterns are accepted)")
+    merge.add_argument('--output', required=True, help="merged JSONL file")
+    merge.add_argument('--allow-incomplete', action='store_true', help="merge even if some shards are missing or have failed records")
+
+    status = subparsers.add_parser('status', help="print the status of the shards of a job")
+    status.add_argument('--manifests', nargs='+', required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == 'merge':
+        try:
+            lines = shard_utils.merge_shards(args.manifests, args.output, args.allow_incomplete)
+        except ValueError as e:
+            parser.exit(1, "merge failed: {}\n".format(e))
+        print("{} records merged into {}".format(lines, args.output), file=sys.stderr)
+        return
+    if args.command == 'status':
+        for shard_status in shard_utils.shard_statuses(args.manifests):
+            print("shard {shard}: {status} ({records} records, {failed} failed, {missing} missing) {output}".format(**shard_status))
+        return
+
+    if args.input is None and not args.ids:
+        parser.error("--input or --ids is required")
+    for route in args.route or []:
+        try:
+            _parse_route(route)
+        except ValueError as e:
+            parser.error("--route {}: {}".format(route, e))
+    config = {
+        'backend': args.backend,
+        'provider': args.provider,
+        'routes': args.route,
+        'model': args.model,
+        'local_model': args.local_model,
+        'context': None if args.context == 'None' else args.context,
+        'num_entities': args.num_entities,
+        'num_names': args.num_names,
+        'structured_outputs': args.structured_outputs,
+        'llm_cache': args.llm_cache,
+        'llm_cache_mode': args.llm_cache_mode
+    }
+    local = _uses_local_model(config)
+    if local and not args.local_model:
+        parser.error("--local-model is required for local inference")
+    if args.workers is None:
+        args.workers = 1 if local else 16 if _uses_router(config) else 4
+    elif local and args.workers > 1:
+        parser.error("local inference loads a copy of the model in each worker process: use --workers 1")
+    if not 0 <= args.shard < args.num_shards:
+        parser.error("--shard must be between 0 and --num-shards - 1")
+    output_path = args.output.replace('{shard}', str(args.shard))
+
+    #  the job must be the same on all the shards (paths of local files, which can differ between machines, are left out)
+    job = {
+        'fingerprint': shard_utils.input_fingerprint(args.input, args.ids),
+        'input_format': args.input_format,
+        'limit': args.limit,
+        'config': dict(config, local_model=os.path.basename(config['local_model']) if config['local_model'] else None, llm_cache=None, llm_cache_mode=None)
+    }
+    manifest = shard_utils.start_manifest(output_path, job, args.shard, args.num_shards)
+
+    records = iter_input(args.input, args.ids, args.input_format)
+    if args.limit is not None:
+        records = (record for index, record in zip(range(args.limit), records))
+    assigned = set()
+    stats = run_map(records, config, output_path, args.workers, args.resume, progress_every=args.progress_every, shard=args.shard, num_shards=args.num_shards, assigned=assigned)
+    shard_utils.finish_manifest(output_path, manifest, stats, assigned)
+    if args.stats:
+        with open(args.stats, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""This file contains a local inference engine for GGUF models, based on llama-cpp-python (https://github.com/abetlen/llama-cpp-python),
+to run the LLM functions of main_functions.py fully offline on CPU-only machines.
+The engine loads the model once per process (see get_engine) and keeps it in memory. It has the same interface as the OpenAI and Groq
+clients (engine.chat.completions.create(model=..., messages=...)), so it can be given as client to useLLM_back_and_forth,
+useLLM_back_and_forth_article and async_utils; it can also be called like a llama.cpp model (engine(prompt, max_tokens=...)),
+so it can be given as model to useLLM.
+
+A llama.cpp context can only run one generation at a time, so all the requests (also those sent by different threads) go through
+a queue served by a single worker thread. The worker takes up to max_batch_size waiting requests at a time and runs them ordered by
+prompt, so that prompts sharing a prefix run one after the other. llama.cpp only evaluates the tokens after the longest prefix shared with
+the previous prompt; the states of previous prompts are also kept in a RAM cache (cache_bytes), so a prefix seen earlier is restored
+instead of being evaluated again. With the shared-prefix layout of prompt_utils.PromptBuilder the instructions and the article
+(title and abstract) are evaluated once for all the keywords of an article.
+
+llama-cpp-python is an optional dependency: pip install llama-cpp-python
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+try:
+    from llama_cpp import Llama, LlamaRAMCache
+except ImportError:
+    Llama = None
+    LlamaRAMCache = None
+
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+#  converts the dictionaries returned by llama-cpp-python into objects with attributes, like the answers of the OpenAI client
+def _to_namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _to_namespace(v) for key, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+#  text used to order the waiting requests, so that requests with the same prefix run one after the other
+def _prefix_key(request):
+    kind, kwargs = request
+    if kind == 'chat':
+        return "\n".join("{}: {}".format(message['role'], message['content']) for message in kwargs['messages'])
+    return kwargs['prompt']
+
+
+"""
+The following class is the engine. Parameters are:
+- model_path: path of the GGUF model file
+- n_ctx: size of the context in tokens (prompt and answer)
+- n_threads: number of CPU threads (by default, all the CPUs)
+- n_batch: number of prompt tokens evaluated in a single forward pass
+- cache_bytes: size of the RAM cache of prompt states (0 to disable it)
+- max_batch_size: maximum number of waiting requests ordered together by the worker
+- chat_format: chat template of the model (None to use the one stored in the GGUF file)
+- default_max_tokens: maximum number of generated tokens when the request does not give max_tokens
+- llm: an already loaded llama_cpp.Llama object (model_path is then only used as a name)
+Other keyword arguments are passed to llama_cpp.Llama.
+"""
+
+class LocalLLMEngine:
+    def __init__(self, model_path, n_ctx=4096, n_threads=None, n_batch=512, cache_bytes=2 << 30, max_batch_size=8,
+                 chat_format=None, default_max_tokens=256, llm=None, **kwargs):
+        if llm is None:
+            if Llama is None:
+                raise ImportError("llama-cpp-python is required for the local engine: pip install llama-cpp-python")
+            llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads or os.cpu_count(), n_batch=n_batch,
+                        chat_format=chat_format, verbose=False, **kwargs)
+            if cache_bytes and LlamaRAMCache is not None:
+                llm.set_cache(LlamaRAMCache(capacity_bytes=cache_bytes))
+        self.llm = llm
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.default_max_tokens = default_max_tokens
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._serve, name="llama-engine", daemon=True)
+        self._worker.start()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat_completion))
+
+    def _serve(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            pending = [first]
+            while len(pending) < self.max_batch_size:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                pending.append(request)
+            pending.sort(key=lambda entry: _prefix_key(entry[0]))
+            for request, future in pending:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self._run(request))
+                    except Exception as e:
+                        future.set_exception(e)
+
+    def _run(self, request):
+        kind, kwargs = request
+        start = time.perf_counter()
+        if kind == 'chat':
+            output = self.llm.create_chat_completion(**kwargs)
+        else:
+            output = self.llm.create_completion(**kwargs)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        usage = output.get('usage') or {}
+        self.prompt_tokens += usage.get('prompt_tokens', 0)
+        self.completion_tokens += usage.get('completion_tokens', 0)
+        return output
+
+    def _submit(self, kind, kwargs):
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("The engine is closed")
+            self._queue.put(((kind, kwargs), future))
+        return future.result()
+
+    #  same arguments as the OpenAI client (model is ignored, the loaded model is used)
+    def _create_chat_completion(self, messages, model=None, max_tokens=None, temperature=0.2, **kwargs):
+        kwargs.update(messages=messages, max_tokens=max_tokens or self.default_max_tokens, temperature=temperature)
+        output = self._submit('chat', kwargs)
+        return _to_namespace(output)
+
+    #  same arguments and answer as a llama_cpp.Llama model (used by main_functions.useLLM)
+    def __call__(self, prompt, max_tokens=None, **kwargs):
+        kwargs.update(prompt=prompt, max_tokens=max_tokens or self.default_max_tokens)
+        return self._submit('completion', kwargs)
+
+    def stats(self):
+        return {
+            'llm_calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'llm_seconds': self.seconds
+        }
+
+    #  requests queued after the stop signal are not run: their callers get RuntimeError("engine closed")
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None and request[1].set_running_or_notify_cancel():
+                request[1].set_exception(RuntimeError("engine closed"))
+
+
+"""
+The following function returns the engine of the model at model_path, loading it the first time it is called in the process:
+later calls (from any module or thread) return the same warm engine. Keyword arguments are used only when the model is loaded
+(see LocalLLMEngine).
+"""
+
+def get_engine(model_path, **kwargs):
+    key = os.path.abspath(model_path)
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            _ENGINES[key] = LocalLLMEngine(model_path, **kwargs)
+        return _ENGINES[key]
+
+
+def close_engines():
+    with _ENGINES_LOCK:
+        for engine in _ENGINES.values():
+            engine.close()
+        _ENGINES.clear()
@@ -8,48 +8,118 @@ import importlib
 import data_utils
 import tools_utils
 import prompt_utils
+import cache_utils
+import metrics_utils
 #  from llama_cpp import Llama
 import re
 from openai import OpenAI
 
 from tenacity import (
   retry,
+  retry_if_not_exception_type,
   stop_after_attempt,
   wait_random_exponential,
 )  # for exponential backoff
 
+
+#  prompt builder used by the LLM functions (see prompt_utils.PromptBuilder and set_prompt_builder), None for the original prompts
+PROMPT_BUILDER = None
+
+
+"""The following function sets the prompt builder used by all the functions of this file: abstracts are shortened to the token budget
+of the builder and, in the back-and-forth flow, prompts use the shared-prefix layout (see prompt_utils.PromptBuilder).
+Use None to go back to the original prompts (full abstract)."""
+
+def set_prompt_builder(builder):
+    global PROMPT_BUILDER
+    PROMPT_BUILDER = builder
+    return builder
+
+
+#  structured outputs of the LLM stages of the back-and-forth flows: None (free text answers), 'json_object' (JSON mode, OpenAI, Groq
+#  and llama.cpp) or 'json_schema' (JSON schema, OpenAI and recent Groq models), see set_structured_outputs
+STRUCTURED_OUTPUTS = None
+STRUCTURED_OUTPUT_MODES = (None, 'json_object', 'json_schema')
+
+#  number of repair requests sent when the answer of a stage cannot be parsed (see parsed_stage_completion)
+REPAIR_ATTEMPTS = 1
+
+
+#  candidate entities given to the entity selection stage (see prune_candidate_entities and set_candidate_pruning):
+#  at most CANDIDATES_TOP_K candidates (None for no limit), whose lines take at most CANDIDATES_TOKEN_BUDGET tokens (None for no limit);
+#  with SHORT_CIRCUIT_SELECTION, the selection call is skipped when at most one candidate remains
+CANDIDATES_TOP_K = 10
+CANDIDATES_TOKEN_BUDGET = 800
+SHORT_CIRCUIT_SELECTION = True
+
+
+"""The following function sets the pruning of the candidate entities of the selection stage. Use top_k=None, token_budget=None and
+short_circuit=False to send all the candidates found on Wikidata to the LLM (duplicated entities are always merged)."""
+
+def set_candidate_pruning(top_k=10, token_budget=800, short_circuit=True):
+    global CANDIDATES_TOP_K, CANDIDATES_TOKEN_BUDGET, SHORT_CIRCUIT_SELECTION
+    CANDIDATES_TOP_K = top_k
+    CANDIDATES_TOKEN_BUDGET = token_budget
+    SHORT_CIRCUIT_SELECTION = short_circuit
+
+
+"""The following function sets the structured outputs mode of the back-and-forth flows: with 'json_object' or 'json_schema' the prompts ask for
+a JSON answer and the request has the corresponding response_format, so that the provider constrains the answer to the format
+(with 'json_schema', the selected URIs are also constrained to the candidate entities).
+Use None to go back to free text answers."""
+
+def set_structured_outputs(mode):
+    global STRUCTURED_OUTPUTS
+    if mode not in STRUCTURED_OUTPUT_MODES:
+        raise ValueError("Unknown structured outputs mode: {} (expected one of {})".format(mode, STRUCTURED_OUTPUT_MODES))
+    STRUCTURED_OUTPUTS = mode
+    return mode
+
+
+#  copy of the item with the abstract shortened by the prompt builder (the item itself if no builder is set, or if the prompt has no abstract:
+#  the abstract of a CompactItem is then not loaded)
+def _budgeted_item(item, context):
+    if PROMPT_BUILDER is None or context != "All" or not item.get('Abstract_or'):
+        return item
+    item = dict(item)
+    item['Abstract_or'] = PROMPT_BUILDER.prepare_abstract(item['Abstract_or'], item.get('Title_or') or "", item['Keywords'])
+    return item
+
 """- The first function uses DBPedia Spotlight. It maps keywords to DBPedia resources 
 (each keyword is mapped to the DBPedia correspondent to the keywords language) 
 if the language of the keyword is different than 'en' (English). 
 - The parameter 'context' specifies the text that is given as input to DBPedia Spotlight. 
 If True, the title and abstract are given as additional context (this slows execution since DBPedia Spotlight 
 annotates the whole input). If False, only keywords are given as input
-- If keywords are in English, a further mapping from DBPedia to Wikidata resources is performed 
-(using SPARQL). This feature is not available for other languages for what it seems 
-like a lack of semantic annotation (the SPARQL engine is not available for DBPedia corresponding to some languages and there is shortage of annotated links between pages in different languages). Moreover, it should be noted that the performance of DBPedia Spotlight seems to be poorer when it is used in languages other than English (THIS NEEDS VERIFICATION).
+- A further mapping from DBPedia to Wikidata resources is performed: if keywords are in English, using SPARQL. 
+For other languages SPARQL is not available (the SPARQL engine is not available for DBPedia corresponding to some languages and there is shortage of annotated links between pages in different languages),
+so the DBPedia resource names are mapped to the titles of the Wikipedia pages of the language, which are resolved with the sitelinks of Wikidata
+(batched wbgetentities requests, see tools_utils.get_wikidata_uris_from_sitelinks). Moreover, it should be noted that the performance of DBPedia Spotlight seems to be poorer when it is used in languages other than English (THIS NEEDS VERIFICATION).
 
 - The function returns a list where each element corresponds to an annotation. 
 Each element of the returned list has three keys: 'Form' (specifies the surface form that DBPedia Spotlight has linked to the URI), 
-'DBPediaURI' and 'WikiDataURI' (contains None if the language of the keywords is not English) """
+'DBPediaURI' and 'WikiDataURI' (list of Wikidata URIs, empty if the DBPedia resource has no Wikidata entity) """
 
 def useDBPediaSpotlight(item, context):
 
     results = []
 
     #  useful to retrieve entities relevant to the keywords (and not to the context) in case of search with context
-    keywords_token = [token for kw in item['Keywords'] for token in kw.split(' ')]
-
-    abstract = item['Abstract_or'] if item['Abstract_or'] else ""
-    title = item['Title_or'] if item['Title_or'] else ""
+    keywords_token = set(token for kw in item['Keywords'] for token in kw.split(' '))
 
-    #  prepare the text for the query
+    #  prepare the text for the query (the abstract is read only when it is needed, see data_utils.CompactItem)
     if context:
+        abstract = item['Abstract_or'] or ""
+        title = item['Title_or'] or ""
         text = 'Title: ' + title + '. ' + 'Abstract: ' + abstract + '. Keywords: ' + ", ".join(item['Keywords'])
     else:
         text = ", ".join(item['Keywords'])
 
     #  send a request to DBPedia Spotlight API
-    data = tools_utils.queryAPIDBpediaSpotlight(text, item['Language'])['Resources']
+    with metrics_utils.span('spotlight_annotation'):
+        response = tools_utils.queryAPIDBpediaSpotlight(text, item['Language'])
+    #  Spotlight omits 'Resources' when nothing is annotated
+    data = response.get('Resources', []) if response is not None else []
 
     #  processes the output to retain only entities corresponding to keywords
     for entity in data:
@@ -59,12 +129,16 @@ def useDBPediaSpotlight(item, context):
         else: 
             results.append({'Form': entity['@surfaceForm'], 'DBPediaURI': entity['@URI']})
 
-    #  conversion of DBPedia URIs in Wikidata URIs
-    for result in results:
-        if item['Language'] == 'en':
-            result['WikidataURI'] = tools_utils.get_wikidata_uri(result['DBPediaURI'])
-        else: 
-            result['WikidataURI'] = None
+    #  conversion of DBPedia URIs in Wikidata URIs (with a single bulk query when there is more than one URI,
+    #  and with the Wikipedia sitelinks of Wikidata for the other language editions of DBPedia)
+    dbpedia_uris = set(result['DBPediaURI'] for result in results)
+    with metrics_utils.span('dbpedia_to_wikidata'):
+        if item['Language'] == 'en' and len(dbpedia_uris) == 1:
+            wikidata_uris = {uri: tools_utils.get_wikidata_uri(uri) for uri in dbpedia_uris}
+        elif len(dbpedia_uris) > 0:
+            wikidata_uris = tools_utils.resolve_dbpedia_uris(dbpedia_uris, item['Language'])
+        for result in results:
+            result['WikidataURI'] = wikidata_uris.get(result['DBPediaURI'], [])
 
     
     #  remove duplicates
@@ -97,27 +171,30 @@ NB: This feature is only for experimentation since it has very slow response tim
 """
 
 def useLLM(item, model, context):
-    prompt = data_utils.prompt_generator(item, context)
+    prompt = data_utils.prompt_generator(_budgeted_item(item, context), context)
 
-    output = model(
-      prompt,
-      max_tokens=200, 
-    ) 
+    with metrics_utils.span('llm_mapping'):
+        output = model(
+          prompt,
+          max_tokens=200, 
+        ) 
+    metrics_utils.record_usage(output, 'llm_mapping')
 
     #  formatting of the answer (this procedure is dependent on the output form we impose via the prompt.)
     entities = re.findall(r'\[([^\]]+)\]', output['choices'][0]['text'])
 
     #  Wikidata query
     results = []
-    for entity in entities:
-        item = {}
-        item['Keyword'] = entity
-        uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
-        if uri:
-            item['URI'] = uri['concepturi']
-        else:
-            item['URI'] = ''
-        results.append(item)
+    with metrics_utils.span('wikidata_search'):
+        for entity in entities:
+            item = {}
+            item['Keyword'] = entity
+            uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
+            if uri:
+                item['URI'] = uri['concepturi']
+            else:
+                item['URI'] = ''
+            results.append(item)
 
     return results
 
@@ -144,15 +221,17 @@ It returns a list of dictionaries where each dictionary has a field 'Keyword' an
 """
 
 def useOpenAILLM(item, model, context, client):
-  prompt = data_utils.prompt_generator(item, context)
-
-  completion = client.chat.completions.create(
-      model=model,
-      messages=[
-      {"role": "system", "content": "You are a helpful assistant."},
-      {"role": "user", "content": prompt}
-      ]
-    )
+  prompt = data_utils.prompt_generator(_budgeted_item(item, context), context)
+
+  with metrics_utils.span('llm_mapping'):
+    completion = client.chat.completions.create(
+        model=model,
+        messages=[
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": prompt}
+        ]
+      )
+  metrics_utils.record_usage(completion, 'llm_mapping', model)
   
   
   #  formatting of the answer 
@@ -160,15 +239,16 @@ def useOpenAILLM(item, model, context, client):
 
   #  Wikidata query (same code of the useLLM function)
   results = []
-  for entity in entities:
-      item = {}
-      item['Keyword'] = entity
-      uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
-      if uri:
-          item['URI'] = uri['concepturi']
-      else:
-          item['URI'] = ''
-      results.append(item)
+  with metrics_utils.span('wikidata_search'):
+    for entity in entities:
+        item = {}
+        item['Keyword'] = entity
+        uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
+        if uri:
+            item['URI'] = uri['concepturi']
+        else:
+            item['URI'] = ''
+        results.append(item)
 
   return results
 
@@ -191,85 +271,307 @@ It returns a list of dictionaries where each dictionary has a field 'Keyword' an
 """
 
 def useGroqLLM(item, model_name, context, client):
-    prompt = data_utils.prompt_generator(item, context)
+    prompt = data_utils.prompt_generator(_budgeted_item(item, context), context)
 
-    completion = client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt},
-    ],
-    model=model_name
-    )
+    with metrics_utils.span('llm_mapping'):
+        completion = client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt},
+        ],
+        model=model_name
+        )
+    metrics_utils.record_usage(completion, 'llm_mapping', model_name)
 
     entities = re.findall(r'\[([^\]]+)\]', completion.choices[0].message.content)
 
     results = []
-    for entity in entities:
-        item = {}
-        item['Keyword'] = entity
-        uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
-        if uri:
-            item['URI'] = uri['concepturi']
-        else:
-            item['URI'] = ''
-        results.append(item)
+    with metrics_utils.span('wikidata_search'):
+        for entity in entities:
+            item = {}
+            item['Keyword'] = entity
+            uri = tools_utils.query_wikidata(entity.lower().split("()")[0])
+            if uri:
+                item['URI'] = uri['concepturi']
+            else:
+                item['URI'] = ''
+            results.append(item)
 
     return results
 
 
-def useLLM_back_and_forth(original_language, title, abstract, keyword, client, model_name, num_entities=1, NUM_NAMES = 10):
-
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-    def completion_with_backoff(**kwargs):
-        return client.chat.completions.create(**kwargs)    
-    
-    potential_entities_generation_prompt_object = prompt_utils.PotentialEntitiesGenerationPrompt(NUM_NAMES, original_language, title, abstract, keyword)
-    potential_entities_generation_prompt = potential_entities_generation_prompt_object.generate_prompt()
+"""
+The last function (useLLM_back_and_forth) maps a single keyword with a two-step process: 
+first, a LLM generates potential entity names for the keyword (candidate generation); then, each name is searched on Wikidata 
+(Wikidata stage) and, finally, the LLM selects the best matching entities among the Wikidata results (entity selection).
+The client can be any OpenAI-compatible client (OpenAI, Groq). The three stages are also available as separate functions
+(generate_potential_entities, find_candidate_entities, select_entities), so that they can be scheduled independently 
+(see async_utils.py).
+"""
 
-    completion = completion_with_backoff(
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": potential_entities_generation_prompt},
-        ],
-        model=model_name
-    )
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), retry=retry_if_not_exception_type(cache_utils.CacheMissError), before_sleep=metrics_utils.retry_counter('llm_completion'))
+def _completion_with_retries(client, **kwargs):
+    return client.chat.completions.create(**kwargs)
+
+
+#  clients that retry and fall back on other providers themselves (handles_retries = True, e.g. router_utils.LLMRouter)
+#  are called directly: once they give up, waiting and retrying here would only delay the error
+def completion_with_backoff(client, **kwargs):
+    if getattr(client, 'handles_retries', False) is True:
+        return client.chat.completions.create(**kwargs)
+    return _completion_with_retries(client, **kwargs)
+
+
+#  LLM call of a stage of the back-and-forth flow, reported to metrics_utils (time and tokens of the stage,
+#  and the number of prompt tokens counted before sending, see prompt_utils.count_tokens).
+#  history is a list of messages added after the prompt (used by the repair requests)
+def stage_completion(stage, client, prompt, model_name, response_format=None, history=None):
+    if metrics_utils.ENABLED:
+        metrics_utils.count('estimated_prompt_tokens', prompt_utils.count_tokens(prompt), stage=stage, model=model_name)
+    kwargs = {}
+    if response_format is not None:
+        kwargs['response_format'] = response_format
+    with metrics_utils.span(stage):
+        completion = completion_with_backoff(
+            client,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt},
+            ] + (history or []),
+            model=model_name,
+            **kwargs
+        )
+    metrics_utils.record_usage(completion, stage, model_name)
+    return completion
 
 
-    response = completion.choices[0].message.content
+"""
+The following function runs a stage of the back-and-forth flow with the prompt object of the stage and returns the parsed answer
+(see checking_schema_function), or None if it cannot be parsed after REPAIR_ATTEMPTS repair requests.
+A repair request sends the prompt again with the unparsable answer and a message that explains what is wrong (see repair_prompt),
+so only the failed stage is repeated (in the selection stage, the candidate entities already found on Wikidata are reused).
+Repair requests are reported as the stage '<stage>_repair', and each answer is counted in metrics_utils as 'parse_results'
+(with the labels attempt: 'first' or 'repair' and result: 'ok' or 'failed').
+"""
 
-    try:
-        llm_generated_entities = potential_entities_generation_prompt_object.checking_schema_function(response)
-    except:
+def parsed_stage_completion(stage, client, prompt_object, model_name):
+    prompt_object.output_format = 'json' if STRUCTURED_OUTPUTS else 'text'
+    prompt = prompt_object.generate_prompt()
+    response_format = prompt_object.response_format(STRUCTURED_OUTPUTS) if STRUCTURED_OUTPUTS else None
+
+    history = []
+    for attempt in range(REPAIR_ATTEMPTS + 1):
+        completion = stage_completion(stage if attempt == 0 else stage + '_repair', client, prompt, model_name, response_format, history)
+        answer = completion.choices[0].message.content
+        try:
+            parsed = prompt_object.checking_schema_function(answer)
+        except Exception:
+            parsed = None
+        metrics_utils.count('parse_results', 1, stage=stage, model=model_name, attempt='first' if attempt == 0 else 'repair', result='failed' if parsed is None else 'ok')
+        if parsed is not None:
+            return parsed
+        history = history + [
+            {"role": "assistant", "content": answer or ""},
+            {"role": "user", "content": prompt_object.repair_prompt(answer)},
+        ]
+    return None
+
+
+#  prompt objects of the two LLM stages, built by the prompt builder if one is set (also used by batch_api_utils)
+def generation_prompt_object(NUM_NAMES, original_language, title, abstract, keyword):
+    if PROMPT_BUILDER is not None:
+        return PROMPT_BUILDER.generation_prompt(NUM_NAMES, original_language, title, abstract, keyword)
+    return prompt_utils.PotentialEntitiesGenerationPrompt(NUM_NAMES, original_language, title, abstract, keyword)
+
+
+def selection_prompt_object(num_entities, original_language, title, abstract, keyword, wikidata_entities_string):
+    if PROMPT_BUILDER is not None:
+        return PROMPT_BUILDER.selection_prompt(num_entities, original_language, title, abstract, keyword, wikidata_entities_string)
+    return prompt_utils.EntitySelectionPrompt(num_entities, original_language, title, abstract, keyword, wikidata_entities_string)
+
+
+#  first stage: returns the list of potential entity names generated by the LLM, or None if the answer cannot be parsed
+def generate_potential_entities(original_language, title, abstract, keyword, client, model_name, NUM_NAMES = 10):
+    potential_entities_generation_prompt_object = generation_prompt_object(NUM_NAMES, original_language, title, abstract, keyword)
+    llm_generated_entities = parsed_stage_completion('candidate_generation', client, potential_entities_generation_prompt_object, model_name)
+    if llm_generated_entities is None:
         print("Generated potential entities cannot be parsed")
         return None
 
+    return llm_generated_entities
+
+
+#  second stage: searches each generated name on Wikidata and returns the list of candidate entities (see tools_utils.query_best_matches_wikidata)
+def find_candidate_entities(llm_generated_entities):
     wikidata_entities = []
-    for generated_entity in llm_generated_entities:
-        wikidata_entities.extend(tools_utils.query_best_matches_wikidata(generated_entity))
+    with metrics_utils.span('wikidata_search'):
+        for generated_entity in llm_generated_entities:
+            wikidata_entities.extend(tools_utils.query_best_matches_wikidata(generated_entity))
+    return wikidata_entities
 
+
+def format_candidate_entities(wikidata_entities):
     wikidata_entities_string = ""
     for entity in wikidata_entities:
         wikidata_entities_string += "Entity: " + entity['label'] + "; " + "Description: " + entity['description'] + "; " + "URI: " + entity['uri'] + "\n"
+    return wikidata_entities_string
 
-    entity_selection_prompt_object = prompt_utils.EntitySelectionPrompt(num_entities, original_language, title, abstract, keyword, wikidata_entities_string)
-    entity_selection_prompt = entity_selection_prompt_object.generate_prompt()
-
-
-    completion = completion_with_backoff(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": entity_selection_prompt},
-        ],
-        model=model_name
-    )
 
+"""
+The following function builds the candidate set of the selection stage from the Wikidata results of all the generated names.
+The same entity is often found by several names: results are merged by QID, and the scores of the merged results are added,
+so that entities found by more names rank higher ('hits' is the number of names that found the entity).
+Candidates are sorted by combined score (ties keep the order in which they were found) and the best top_k are kept,
+as long as their lines in the prompt (see format_candidate_entities) fit in token_budget tokens (the best candidate is always kept).
+"""
 
-    
-    response = completion.choices[0].message.content
-    try:
-        selected_entities = entity_selection_prompt_object.checking_schema_function(response)
-    except:
+def prune_candidate_entities(wikidata_entities, top_k=None, token_budget=None):
+    merged = {}
+    for entity in wikidata_entities:
+        qid = entity['uri'].rstrip('/').rsplit('/', 1)[-1]
+        if qid in merged:
+            merged[qid]['score'] += entity.get('score') or 0
+            merged[qid]['hits'] += 1
+        else:
+            merged[qid] = dict(entity, score=entity.get('score') or 0, hits=1)
+    candidates = sorted(merged.values(), key=lambda entity: entity['score'], reverse=True)
+    if top_k is not None:
+        candidates = candidates[:top_k]
+    if token_budget is not None:
+        kept = []
+        tokens = 0
+        for entity in candidates:
+            entity_tokens = prompt_utils.count_tokens(format_candidate_entities([entity]))
+            if kept and tokens + entity_tokens > token_budget:
+                break
+            kept.append(entity)
+            tokens += entity_tokens
+        candidates = kept
+    return candidates
+
+
+#  candidate set of the selection stage with the settings of set_candidate_pruning (the numbers of candidates are reported to metrics_utils)
+def selection_candidates(wikidata_entities):
+    candidates = prune_candidate_entities(wikidata_entities, CANDIDATES_TOP_K, CANDIDATES_TOKEN_BUDGET)
+    metrics_utils.count('selection_candidates_found', len(wikidata_entities))
+    metrics_utils.count('selection_candidates_kept', len(candidates))
+    return candidates
+
+
+#  result of the selection stage without calling the LLM when at most one candidate remains (None if the LLM has to be called)
+def short_circuit_selection(candidates):
+    if SHORT_CIRCUIT_SELECTION and len(candidates) <= 1:
+        metrics_utils.count('selection_short_circuits', 1, candidates=len(candidates))
+        return [entity['uri'] for entity in candidates]
+    return None
+
+
+#  third stage: returns the URIs of the entities selected by the LLM among the candidates, or None if the answer cannot be parsed
+def select_entities(original_language, title, abstract, keyword, wikidata_entities, client, model_name, num_entities=1):
+    wikidata_entities = selection_candidates(wikidata_entities)
+    selected_entities = short_circuit_selection(wikidata_entities)
+    if selected_entities is not None:
+        return selected_entities
+
+    wikidata_entities_string = format_candidate_entities(wikidata_entities)
+
+    entity_selection_prompt_object = selection_prompt_object(num_entities, original_language, title, abstract, keyword, wikidata_entities_string)
+    selected_entities = parsed_stage_completion('entity_selection', client, entity_selection_prompt_object, model_name)
+    if selected_entities is None:
         print("Selected entities cannot be parsed")
         return None
 
     return selected_entities
+
+
+def useLLM_back_and_forth(original_language, title, abstract, keyword, client, model_name, num_entities=1, NUM_NAMES = 10):
+
+    llm_generated_entities = generate_potential_entities(original_language, title, abstract, keyword, client, model_name, NUM_NAMES)
+    if llm_generated_entities is None:
+        return None
+
+    wikidata_entities = find_candidate_entities(llm_generated_entities)
+
+    return select_entities(original_language, title, abstract, keyword, wikidata_entities, client, model_name, num_entities)
+
+
+#  the article-level prompts always ask for a JSON object, so both structured outputs modes apply to them
+def _article_response_format(prompt_object):
+    return prompt_object.response_format(STRUCTURED_OUTPUTS) if STRUCTURED_OUTPUTS else None
+
+
+#  in the article-level flow each keyword entry of the answer is counted as an answer (failed entries are repaired by the per-keyword fallbacks)
+def _count_article_parse_results(stage, model_name, parsed_per_keyword):
+    if metrics_utils.ENABLED:
+        failed = sum(1 for parsed in parsed_per_keyword if parsed is None)
+        metrics_utils.count('parse_results', len(parsed_per_keyword) - failed, stage=stage, model=model_name, attempt='first', result='ok')
+        metrics_utils.count('parse_results', failed, stage=stage, model=model_name, attempt='first', result='failed')
+
+
+"""
+The following function is the article-level version of useLLM_back_and_forth: it maps all the keywords of an article with 
+a single candidate generation call and a single entity selection call (instead of two calls for each keyword), 
+so that the title and the abstract are sent to the model only twice for the whole article.
+The model answers with a JSON object with one entry for each keyword (see prompt_utils.MultiKeywordPotentialEntitiesGenerationPrompt).
+If the part of the answer for a keyword cannot be parsed, only that keyword falls back to the per-keyword functions: 
+a keyword without generated names is mapped with useLLM_back_and_forth, a keyword without a selection is mapped with
+select_entities (reusing the candidates already found on Wikidata).
+The function takes the same arguments as useLLM_back_and_forth, except that keywords is a list of keywords, and returns a list 
+aligned with keywords, where each element is the value useLLM_back_and_forth would return for that keyword.
+"""
+
+def useLLM_back_and_forth_article(original_language, title, abstract, keywords, client, model_name, num_entities=1, NUM_NAMES = 10):
+    if len(keywords) == 0:
+        return []
+
+    #  the per-keyword fallbacks below receive the original abstract, which they shorten in the same way
+    article_abstract = PROMPT_BUILDER.prepare_abstract(abstract, title) if PROMPT_BUILDER is not None else abstract
+    generation_prompt_object = prompt_utils.MultiKeywordPotentialEntitiesGenerationPrompt(NUM_NAMES, original_language, title, article_abstract, keywords)
+
+    completion = stage_completion('candidate_generation', client, generation_prompt_object.generate_prompt(), model_name, _article_response_format(generation_prompt_object))
+    generated_entities_per_keyword = generation_prompt_object.checking_schema_function(completion.choices[0].message.content)
+    _count_article_parse_results('candidate_generation', model_name, generated_entities_per_keyword)
+
+    results = [None] * len(keywords)
+
+    #  keywords whose generated names cannot be parsed go through the per-keyword path
+    batched_indexes = []
+    for i, llm_generated_entities in enumerate(generated_entities_per_keyword):
+        if llm_generated_entities is None:
+            print("Generated potential entities cannot be parsed for keyword '{}', falling back to the per-keyword path".format(keywords[i]))
+            results[i] = useLLM_back_and_forth(original_language, title, abstract, keywords[i], client, model_name, num_entities, NUM_NAMES)
+        else:
+            batched_indexes.append(i)
+
+    if len(batched_indexes) == 0:
+        return results
+
+    candidates_per_keyword = {i: selection_candidates(find_candidate_entities(generated_entities_per_keyword[i])) for i in batched_indexes}
+
+    #  keywords with at most one candidate do not need the selection call
+    for i in list(batched_indexes):
+        selected_entities = short_circuit_selection(candidates_per_keyword[i])
+        if selected_entities is not None:
+            results[i] = selected_entities
+            batched_indexes.remove(i)
+
+    if len(batched_indexes) == 0:
+        return results
+
+    selection_prompt_object = prompt_utils.MultiKeywordEntitySelectionPrompt(
+        num_entities, original_language, title, article_abstract,
+        [keywords[i] for i in batched_indexes],
+        [format_candidate_entities(candidates_per_keyword[i]) for i in batched_indexes]
+    )
+
+    completion = stage_completion('entity_selection', client, selection_prompt_object.generate_prompt(), model_name, _article_response_format(selection_prompt_object))
+    selected_entities_per_keyword = selection_prompt_object.checking_schema_function(completion.choices[0].message.content)
+    _count_article_parse_results('entity_selection', model_name, selected_entities_per_keyword)
+
+    for i, selected_entities in zip(batched_indexes, selected_entities_per_keyword):
+        if selected_entities is None:
+            print("Selected entities cannot be parsed for keyword '{}', falling back to the per-keyword path".format(keywords[i]))
+            selected_entities = select_entities(original_language, title, abstract, keywords[i], candidates_per_keyword[i], client, model_name, num_entities)
+        results[i] = selected_entities
+
+    return results
@@ -0,0 +1,331 @@
+"""This file contains the optional instrumentation of the mapping pipelines.
+main_functions.py, tools_utils.py and http_utils.py report what they do through the functions of this file:
+- span(stage): time spent in each stage (e.g. 'candidate_generation', 'wikidata_search', 'entity_selection');
+- record_usage(completion, stage, model): LLM calls and tokens, taken from completion.usage;
+- count(name, value, **labels): counters, such as HTTP requests, HTTP retries, tenacity retries and cache hits/misses.
+Events are sent to the sinks added with add_sink: MemorySink (in-memory aggregates), JSONLSink (one JSON line per event)
+and PrometheusSink (Prometheus text format). When no sink is added, instrumentation is disabled: span returns a shared no-op
+context manager and the other functions return after checking a single global flag.
+
+Example:
+with metrics_utils.collect() as metrics:
+    main_functions.useLLM_back_and_forth(...)
+print(metrics.summary())
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from math import ceil
+
+
+ENABLED = False
+_sinks = []
+_sinks_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+def add_sink(sink):
+    global ENABLED
+    with _sinks_lock:
+        _sinks.append(sink)
+        ENABLED = True
+    return sink
+
+
+def remove_sink(sink):
+    global ENABLED
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+        ENABLED = len(_sinks) > 0
+
+
+def clear_sinks():
+    global ENABLED
+    with _sinks_lock:
+        _sinks.clear()
+        ENABLED = False
+
+
+"""
+The following context manager adds a sink (by default a new MemorySink) for the duration of the block and returns it.
+"""
+
+@contextmanager
+def collect(sink=None):
+    sink = add_sink(sink if sink is not None else MemorySink())
+    try:
+        yield sink
+    finally:
+        remove_sink(sink)
+        if hasattr(sink, 'flush'):
+            sink.flush()
+
+
+#  an event is a dictionary with keys 'type' ('span' or 'counter'), 'name', 'value', 'labels' and 'time'
+def emit(event_type, name, value, labels):
+    event = {'type': event_type, 'name': name, 'value': value, 'labels': labels, 'time': time.time()}
+    for sink in list(_sinks):
+        sink.handle(event)
+
+
+class _Span:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        labels = self.labels
+        if exc_type is not None:
+            labels = dict(labels, error=exc_type.__name__)
+        emit('span', self.name, time.perf_counter() - self.start, labels)
+        return False
+
+
+"""
+The following function returns a context manager that measures the time spent in the block and reports it as a span of the given stage.
+"""
+
+def span(stage, **labels):
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(stage, labels)
+
+
+def count(name, value=1, **labels):
+    if ENABLED:
+        emit('counter', name, value, labels)
+
+
+"""
+The following function reports an LLM call and its token usage. completion is the answer of an OpenAI-compatible client
+(completion.usage) or of a llama.cpp model (output['usage']).
+"""
+
+def record_usage(completion, stage, model=None):
+    if not ENABLED:
+        return
+    usage = completion.get('usage') if isinstance(completion, dict) else getattr(completion, 'usage', None)
+    labels = {'stage': stage, 'model': model}
+    count('llm_calls', 1, **labels)
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage.get('prompt_tokens'), usage.get('completion_tokens')
+    else:
+        prompt_tokens, completion_tokens = getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None)
+    count('llm_prompt_tokens', prompt_tokens or 0, **labels)
+    count('llm_completion_tokens', completion_tokens or 0, **labels)
+
+
+"""
+The following function returns a callback for the before_sleep argument of tenacity.retry, which counts the retries of an operation.
+"""
+
+def retry_counter(operation):
+    def before_sleep(retry_state):
+        count('retries', 1, operation=operation)
+    return before_sleep
+
+
+def cache_lookup(cache, hit):
+    if ENABLED:
+        emit('counter', 'cache_lookups', 1, {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+
+#  nearest-rank percentile of a sorted list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+"""
+The following function summarizes a list of latencies (in seconds) as count, mean, p50, p95, p99 and max, in milliseconds.
+"""
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    if values:
+        summary['mean_ms'] = sum(values) / len(values) * 1000
+        for p in (50, 95, 99):
+            summary['p{}_ms'.format(p)] = percentile(values, p) * 1000
+        summary['max_ms'] = values[-1] * 1000
+    return summary
+
+
+#  labels as a sorted tuple of (name, value) pairs, used as the key of the aggregates (labels set to None are left out)
+def _label_items(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+#  label items shown as 'name=value,name=value' in the summary (only for display: values can contain ',' or '=')
+def _label_string(label_items):
+    return ",".join("{}={}".format(key, value) for key, value in label_items)
+
+
+#  (labels as a dictionary, value) of the aggregates of the counter name
+def _counter_labels(aggregates, name):
+    return [(dict(label_items), value) for (counter_name, label_items), value in aggregates if counter_name == name]
+
+
+"""
+The following sink keeps the events in memory: the durations of the spans of each stage and the sum of each counter
+(counters are grouped by name and labels, e.g. 'llm_prompt_tokens' with 'stage=entity_selection,model=gpt-4o-mini').
+summary() returns the latency of each stage (see latency_summary), the counters, the hit rate of each cache, and the parse failure
+and repair rates of each LLM stage (see main_functions.parsed_stage_completion).
+"""
+
+class MemorySink:
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        with self._lock:
+            if event['type'] == 'span':
+                self.spans.setdefault(event['name'], []).append(event['value'])
+            else:
+                key = (event['name'], _label_items(event['labels']))
+                self.counters[key] = self.counters.get(key, 0) + event['value']
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def counter(self, name, **labels):
+        with self._lock:
+            wanted = set(_label_items(labels))
+            return sum(total for (counter_name, label_items), total in self.counters.items()
+                       if counter_name == name and wanted <= set(label_items))
+
+    def summary(self):
+        with self._lock:
+            spans = {stage: latency_summary(values) for stage, values in self.spans.items()}
+            aggregates = sorted(self.counters.items())
+        counters = {}
+        for (name, label_items), value in aggregates:
+            by_labels = counters.setdefault(name, {})
+            by_labels[_label_string(label_items)] = by_labels.get(_label_string(label_items), 0) + value
+        cache_hit_rates = {}
+        for labels, value in _counter_labels(aggregates, 'cache_lookups'):
+            rate = cache_hit_rates.setdefault(labels['cache'], {'hit': 0, 'miss': 0})
+            rate[labels['result']] += value
+        for rate in cache_hit_rates.values():
+            lookups = rate['hit'] + rate['miss']
+            rate['hit_rate'] = rate['hit'] / lookups if lookups else 0.0
+        parse_rates = {}
+        for labels, value in _counter_labels(aggregates, 'parse_results'):
+            rate = parse_rates.setdefault(labels['stage'], {'answers': 0, 'failures': 0, 'repairs': 0, 'repaired': 0})
+            if labels['attempt'] == 'first':
+                rate['answers'] += value
+                rate['failures'] += value if labels['result'] == 'failed' else 0
+            else:
+                rate['repairs'] += value
+                rate['repaired'] += value if labels['result'] == 'ok' else 0
+        for rate in parse_rates.values():
+            rate['failure_rate'] = rate['failures'] / rate['answers'] if rate['answers'] else 0.0
+            rate['repair_success_rate'] = rate['repaired'] / rate['repairs'] if rate['repairs'] else 0.0
+        return {'spans': spans, 'counters': counters, 'cache_hit_rates': cache_hit_rates, 'parse_rates': parse_rates}
+
+
+"""
+The following sink writes each event as a JSON line to path (lines are buffered and written to disk by flush() and close()).
+"""
+
+class JSONLSink:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+"""
+The following sink aggregates the events in the Prometheus text format: counters become '<prefix>_<name>_total' and the spans
+of each stage become the histogram '<prefix>_stage_duration_seconds' (with the stage as a label).
+render() returns the text; write(path) writes it to a file (e.g. for the textfile collector of the node exporter).
+"""
+
+class PrometheusSink:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix="keywords_translation", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        labels = _label_items(event['labels'])
+        with self._lock:
+            if event['type'] == 'span':
+                key = (('stage', event['name']),) + labels
+                histogram = self.histograms.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                for i, bound in enumerate(self.buckets):
+                    if event['value'] <= bound:
+                        histogram['buckets'][i] += 1
+                histogram['sum'] += event['value']
+                histogram['count'] += 1
+            else:
+                key = (event['name'], labels)
+                self.counters[key] = self.counters.get(key, 0) + event['value']
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                metric = "{}_{}_total".format(self.prefix, name)
+                lines.append("# TYPE {} counter".format(metric))
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append("{}{} {}".format(metric, self._format_labels(labels), value))
+            if self.histograms:
+                metric = "{}_stage_duration_seconds".format(self.prefix)
+                lines.append("# TYPE {} histogram".format(metric))
+                for labels, histogram in sorted(self.histograms.items()):
+                    for bound, value in zip(self.buckets, histogram['buckets']):
+                        lines.append("{}_bucket{} {}".format(metric, self._format_labels(labels + (('le', str(bound)),)), value))
+                    lines.append("{}_bucket{} {}".format(metric, self._format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+                    lines.append("{}_sum{} {}".format(metric, self._format_labels(labels), histogram['sum']))
+                    lines.append("{}_count{} {}".format(metric, self._format_labels(labels), histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
@@ -1,3 +1,7 @@
+import json
+import re
+import threading
+
 POTENTIAL_ENTITIES_GENERATION_PROMPT = """
 You are a helpful assistant. 
 You will be provided information about an academic article in the area of social sciences and humanities. 
@@ -11,7 +15,7 @@ In other cases (complex concept or expression), you have to provide entities tha
 
 You can give up to {number_of_names} potential entity names for a keyword. 
 You don't necessarily have to provide {number_of_names} names: 1 name is enough if the keyword is a simple concept. However, you need to provide at least 1 name.
-Give the list of names separated by commas. The names should always be in English. Please, include only the list of names in the output, without any other text.
+{answer_format}
 
 Original language of the article: {original_language}
 Title of the article: {title}
@@ -28,7 +32,7 @@ You will be provided the following elements about the article: Original language
 
 Your goal is the following: given the list of entities and their descriptions, select the best matching entity that matches the keyword.
 
-Provide the URI of the best matching entity. Please, include only the URI, without any other text.
+{answer_format}
 
 Original language of the article: {original_language}
 Title of the article: {title}
@@ -40,7 +44,55 @@ Entities:
 """
 
 
+"""
+The answer format of the two prompts above depends on output_format: 'text' (the original format, a list of names separated by commas
+and a URI) or 'json' (a JSON object, for the structured outputs of the providers, see main_functions.set_structured_outputs).
+checking_schema_function accepts both formats and validates the answer strictly: it returns None (instead of a wrong list)
+when the answer has no name, or no URI among the candidate entities, so that the stage can be repaired (see repair_prompt).
+"""
+
+TEXT_NAMES_FORMAT = "Give the list of names separated by commas. The names should always be in English. Please, include only the list of names in the output, without any other text."
+JSON_NAMES_FORMAT = 'The names should always be in English. Answer with a JSON object with the key "names" and the list of names as value, for example: {"names": ["literature", "fact"]}. Please, include only the JSON object in the output, without any other text.'
+TEXT_URI_FORMAT = "Provide the URI of the best matching entity. Please, include only the URI, without any other text."
+JSON_URI_FORMAT = 'Answer with a JSON object with the key "uris" and the list with the URI of the best matching entity as value, for example: {"uris": ["http://www.wikidata.org/entity/Q8242"]}. Please, include only the JSON object in the output, without any other text.'
+
+REPAIR_PROMPT = """
+Your previous answer could not be used: {reason}.
+Answer the same task again. {answer_format}
+"""
+
+WIKIDATA_URI_PATTERN = re.compile(r'https?://www\.wikidata\.org/entity/(Q\d+)|\b(Q\d+)\b')
+
+
+#  Wikidata URIs in a text, in order of appearance and without duplicates (bare QIDs are converted to URIs)
+def extract_wikidata_uris(text):
+    uris = []
+    for match in WIKIDATA_URI_PATTERN.finditer(text):
+        uri = "http://www.wikidata.org/entity/" + (match.group(1) or match.group(2))
+        if uri not in uris:
+            uris.append(uri)
+    return uris
+
+
+def _json_schema_format(name, key, items):
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "array", "items": items}},
+                "required": [key],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
 class PotentialEntitiesGenerationPrompt:
+    output_format = 'text'
+
     def __init__(self, number_of_names, original_language, title, abstract, keyword):
         self.number_of_names = number_of_names
         self.original_language = original_language
@@ -48,19 +100,44 @@ class PotentialEntitiesGenerationPrompt:
         self.abstract = abstract
         self.keyword = keyword
 
+    def answer_format(self):
+        return JSON_NAMES_FORMAT if self.output_format == 'json' else TEXT_NAMES_FORMAT
+
     def generate_prompt(self):
-        return POTENTIAL_ENTITIES_GENERATION_PROMPT.format(number_of_names=self.number_of_names, original_language=self.original_language, title=self.title, abstract=self.abstract, keyword=self.keyword)
+        return POTENTIAL_ENTITIES_GENERATION_PROMPT.format(number_of_names=self.number_of_names, original_language=self.original_language, title=self.title, abstract=self.abstract, keyword=self.keyword, answer_format=self.answer_format())
 
-    def checking_schema_function(self, answer: str) -> str:
-        try:
-            answer = answer.strip()
-            answer = answer.split(",")
-            return answer
-        except:
+    #  response_format argument of the chat completion for the structured outputs mode 'json_object' or 'json_schema'
+    def response_format(self, mode):
+        if mode == 'json_schema':
+            return _json_schema_format("potential_entities", "names", {"type": "string"})
+        return {"type": "json_object"}
+
+    def checking_schema_function(self, answer: str) -> list:
+        if not isinstance(answer, str):
             return None
+        parsed = parse_json_object(answer) if '{' in answer else None
+        if parsed is not None:
+            names = parsed.get('names')
+            if isinstance(names, str):
+                names = [names]
+            if not isinstance(names, list):
+                return None
+            names = [name.strip() for name in names if isinstance(name, str)]
+        else:
+            answer = answer.strip()
+            separator = "," if "," in answer or "\n" not in answer else "\n"
+            #  list markers and quotes around the names are removed
+            names = [re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', name).strip().strip('"\'') for name in answer.split(separator)]
+        names = [name for name in names if name]
+        return names[:self.number_of_names] if names else None
+
+    def repair_prompt(self, answer):
+        return REPAIR_PROMPT.format(reason="it does not contain any entity name", answer_format=self.answer_format())
         
 
 class EntitySelectionPrompt:
+    output_format = 'text'
+
     def __init__(self, number_of_entities, original_language, title, abstract, keyword, entities):
         self.number_of_entities = number_of_entities
         self.original_language = original_language
@@ -69,30 +146,385 @@ class EntitySelectionPrompt:
         self.keyword = keyword
         self.entities = entities
 
+    def answer_format(self):
+        return JSON_URI_FORMAT if self.output_format == 'json' else TEXT_URI_FORMAT
+
     def generate_prompt(self):
-        return ENTITY_SELECTION_PROMPT.format(number_of_entities=self.number_of_entities, original_language=self.original_language, title=self.title, abstract=self.abstract, keyword=self.keyword, entities=self.entities)
+        return ENTITY_SELECTION_PROMPT.format(number_of_entities=self.number_of_entities, original_language=self.original_language, title=self.title, abstract=self.abstract, keyword=self.keyword, entities=self.entities, answer_format=self.answer_format())
 
-    def checking_schema_function(self, answer: str) -> str:
-        try:
-            answer = answer.strip()
-            answer_comma_splitted = answer.split(",")
-            if len(answer_comma_splitted) == 1:
-                answer_dot_splitted = answer.split(".")
-                if len(answer_dot_splitted) == 1:
-                    answer_newline_splitted = answer.split("\n")
-                    if len(answer_newline_splitted) == 1:
-                        answer_space_splitted = answer.split(" ")
-                        if len(answer_space_splitted) == 1:
-                            return []
-                        else:
-                            return [uri.strip() for uri in answer_space_splitted]
-                    else:
-                        return [uri.strip() for uri in answer_newline_splitted]
-                else:
-                    return [uri.strip() for uri in answer_dot_splitted]
-            else:
-                return [uri.strip() for uri in answer_comma_splitted]
-        except:
+    def candidate_uris(self):
+        return extract_wikidata_uris(self.entities) if self.entities else []
+
+    def response_format(self, mode):
+        if mode == 'json_schema':
+            candidates = self.candidate_uris()
+            return _json_schema_format("selected_entities", "uris", {"type": "string", "enum": candidates} if candidates else {"type": "string"})
+        return {"type": "json_object"}
+
+    #  returns the URIs of the answer that are among the candidate entities (None if there is none)
+    def checking_schema_function(self, answer: str) -> list:
+        if not isinstance(answer, str):
             return None
-        
+        parsed = parse_json_object(answer) if '{' in answer else None
+        if parsed is not None and 'uris' in parsed:
+            values = parsed['uris'] if isinstance(parsed['uris'], list) else [parsed['uris']]
+            answer = " ".join(value for value in values if isinstance(value, str))
+        uris = extract_wikidata_uris(answer)
+        candidates = self.candidate_uris()
+        if candidates:
+            uris = [uri for uri in uris if uri in candidates]
+        return uris or None
+
+    def repair_prompt(self, answer):
+        if self.candidate_uris() and extract_wikidata_uris(answer or ""):
+            reason = "the URIs it contains are not among the URIs of the entities provided"
+        else:
+            reason = "it does not contain the URI of an entity"
+        return REPAIR_PROMPT.format(reason=reason, answer_format=self.answer_format())
+
+
+
+MULTI_KEYWORD_POTENTIAL_ENTITIES_GENERATION_PROMPT = """
+You are a helpful assistant. 
+You will be provided information about an academic article in the area of social sciences and humanities. 
+You will be provided the following elements about the article: Original language of the article, Title of the article, Abstract of the article.
+When one of these elements is not available, you will be provided an empty string.
+
+Your goal is the following: for each keyword of the article (keywords have been provided by the author of the article and can be in any language), find the corresponding entity in Wikidata. 
+You have to provide the name of the entity, then another agent will take care of finding the corresponding URI.
+In some cases, the keyword is a Wikidata entity itself (for example, a word like "horse" has a Wikidata entity with the same name).
+In other cases (complex concept or expression), you have to provide entities that you think are related to the keyword, given your understanding of the article content. 
+
+You can give up to {number_of_names} potential entity names for each keyword. 
+You don't necessarily have to provide {number_of_names} names: 1 name is enough if the keyword is a simple concept. However, you need to provide at least 1 name for each keyword.
+The names should always be in English. 
+Keywords are numbered. Answer with a JSON object where each key is the number of a keyword (as a string) and each value is the list of names for that keyword, 
+for example: {{"1": ["literature"], "2": ["literature", "fact"]}}. Please, include only the JSON object in the output, without any other text.
+
+Original language of the article: {original_language}
+Title of the article: {title}
+Abstract of the article: {abstract}
+Keywords:
+{keywords}
+"""
+
+
+MULTI_KEYWORD_ENTITY_SELECTION_PROMPT = """
+You are a helpful assistant. 
+You will be provided with the keywords of an academic article and, for each keyword, a list of Wikidata entities and their descriptions. 
+These entities are potential matches for the keyword.
+You will be provided the following elements about the article: Original language of the article, Title of the article, Abstract of the article, and the original keywords (note that the keywords can be in any language).
+
+Your goal is the following: for each keyword, given its list of entities and their descriptions, select the best matching entity that matches the keyword.
+
+Keywords are numbered. Answer with a JSON object where each key is the number of a keyword (as a string) and each value is the list with the URI of the best matching entity, 
+for example: {{"1": ["http://www.wikidata.org/entity/Q8242"], "2": ["http://www.wikidata.org/entity/Q1190554"]}}. Please, include only the JSON object in the output, without any other text.
+
+Original language of the article: {original_language}
+Title of the article: {title}
+Abstract of the article: {abstract}
+
+{keywords_and_entities}
+"""
+
+
+#  extracts the JSON object from an answer (models sometimes wrap it in a markdown code block or add some text around it)
+def parse_json_object(answer):
+    answer = answer.strip()
+    match = re.search(r'\{.*\}', answer, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        parsed = json.loads(match.group(0))
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+#  returns, for each keyword number, the list of strings in the answer (None for the keywords whose value is missing or malformed)
+def parse_keyword_lists(answer, number_of_keywords):
+    parsed = parse_json_object(answer) if answer else None
+    results = []
+    for i in range(1, number_of_keywords + 1):
+        value = parsed.get(str(i)) if parsed is not None else None
+        if isinstance(value, str):
+            value = [value]
+        if isinstance(value, list) and len(value) > 0 and all(isinstance(v, str) for v in value):
+            results.append([v.strip() for v in value if v.strip()] or None)
+        else:
+            results.append(None)
+    return results
+
+
+#  response_format of the article-level prompts: a JSON object with the keys "1" ... "n" (see response_format of PotentialEntitiesGenerationPrompt)
+def _keyword_lists_format(mode, name, number_of_keywords):
+    if mode != 'json_schema':
+        return {"type": "json_object"}
+    keys = [str(i) for i in range(1, number_of_keywords + 1)]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "array", "items": {"type": "string"}} for key in keys},
+                "required": keys,
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+"""
+The following classes are the article-level versions of PotentialEntitiesGenerationPrompt and EntitySelectionPrompt:
+all the keywords of an article are included in a single prompt, so that the title and the abstract are sent only once.
+The answer is a JSON object with one entry for each keyword. The method checking_schema_function returns a list
+aligned with the keywords, where the entry of a keyword is None if its part of the answer cannot be parsed
+(for the selection prompt, also if it contains no URI of the candidate entities of the keyword).
+"""
+
+class MultiKeywordPotentialEntitiesGenerationPrompt:
+    def __init__(self, number_of_names, original_language, title, abstract, keywords):
+        self.number_of_names = number_of_names
+        self.original_language = original_language
+        self.title = title
+        self.abstract = abstract
+        self.keywords = keywords
+
+    def generate_prompt(self):
+        keywords = "\n".join("{}. {}".format(i, keyword) for i, keyword in enumerate(self.keywords, start=1))
+        return MULTI_KEYWORD_POTENTIAL_ENTITIES_GENERATION_PROMPT.format(number_of_names=self.number_of_names, original_language=self.original_language, title=self.title, abstract=self.abstract, keywords=keywords)
+
+    def checking_schema_function(self, answer: str) -> list:
+        return parse_keyword_lists(answer, len(self.keywords))
+
+    def response_format(self, mode):
+        return _keyword_lists_format(mode, "potential_entities", len(self.keywords))
+
+
+class MultiKeywordEntitySelectionPrompt:
+    def __init__(self, number_of_entities, original_language, title, abstract, keywords, entities):
+        #  entities is a list aligned with keywords, with the string of candidate entities of each keyword
+        self.number_of_entities = number_of_entities
+        self.original_language = original_language
+        self.title = title
+        self.abstract = abstract
+        self.keywords = keywords
+        self.entities = entities
+
+    def generate_prompt(self):
+        keywords_and_entities = ""
+        for i, (keyword, entities) in enumerate(zip(self.keywords, self.entities), start=1):
+            keywords_and_entities += "Keyword {}: {}\nEntities: \n{}\n".format(i, keyword, entities)
+        return MULTI_KEYWORD_ENTITY_SELECTION_PROMPT.format(number_of_entities=self.number_of_entities, original_language=self.original_language, title=self.title, abstract=self.abstract, keywords_and_entities=keywords_and_entities)
+
+    def candidate_uris(self, i):
+        return extract_wikidata_uris(self.entities[i]) if self.entities[i] else []
+
+    #  same check as EntitySelectionPrompt.checking_schema_function for each keyword: the entry of a keyword is the list of the URIs
+    #  of its part of the answer that are among its candidate entities (None if there is none)
+    def checking_schema_function(self, answer: str) -> list:
+        results = []
+        for i, values in enumerate(parse_keyword_lists(answer, len(self.keywords))):
+            uris = extract_wikidata_uris(" ".join(values)) if values is not None else []
+            candidates = self.candidate_uris(i)
+            if candidates:
+                uris = [uri for uri in uris if uri in candidates]
+            results.append(uris or None)
+        return results
+
+    def response_format(self, mode):
+        return _keyword_lists_format(mode, "selected_entities", len(self.keywords))
+
+
+
+"""
+The following functions and classes build prompts with a token budget and a layout that is friendly to the automatic prompt caching
+of the providers (OpenAI, Groq and llama.cpp reuse the computation of the longest prefix already seen in a previous request).
+In the templates above the instructions change from one stage to the other, so the prompts of the two stages share no prefix.
+In the templates below every prompt starts with the same header followed by the article (language, title, abstract), then come the
+instructions of the stage and, last, the keyword (and its candidate entities): all the prompts of an article, for all its keywords
+and for both stages, share the same prefix.
+Abstracts longer than the budget are shortened by sentence, either keeping the first sentences ('truncate') or the sentences that
+share more words with the title and the keywords ('extractive').
+Token counts use tiktoken when it is installed, otherwise an estimate of 4 characters per token.
+"""
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARACTERS_PER_TOKEN = 4
+_ENCODINGS = {}
+
+
+def count_tokens(text, encoding_name="cl100k_base"):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if encoding_name not in _ENCODINGS:
+            _ENCODINGS[encoding_name] = tiktoken.get_encoding(encoding_name)
+        return len(_ENCODINGS[encoding_name].encode(text))
+    return -(-len(text) // CHARACTERS_PER_TOKEN)
+
+
+def split_sentences(text):
+    return [sentence for sentence in re.split(r'(?<=[.!?…])\s+', text.strip()) if sentence]
+
+
+#  first words of text that fit in max_tokens
+def _truncate_words(text, max_tokens, encoding_name):
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle]) + " …", encoding_name) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]) + " …" if low > 0 else ""
+
+
+"""
+The following function shortens text to at most max_tokens tokens, by whole sentences. mode is 'truncate' (first sentences)
+or 'extractive' (sentences with more words in common with query_terms, e.g. the title and the keywords, kept in their original order;
+the first sentence gets a small bonus since it usually states the subject of the article).
+If not even one sentence fits, the first sentence is cut by words. Text within the budget is returned unchanged.
+"""
+
+def budget_text(text, max_tokens, mode='truncate', query_terms=(), encoding_name="cl100k_base"):
+    if not text or max_tokens is None or count_tokens(text, encoding_name) <= max_tokens:
+        return text
+    sentences = split_sentences(text)
+    lengths = [count_tokens(sentence, encoding_name) + 1 for sentence in sentences]
+
+    if mode == 'truncate':
+        order = range(len(sentences))
+    elif mode == 'extractive':
+        query_words = set(word for term in query_terms if term for word in re.findall(r'\w+', term.lower()) if len(word) > 3)
+        scores = []
+        for i, sentence in enumerate(sentences):
+            words = set(re.findall(r'\w+', sentence.lower()))
+            scores.append(len(words & query_words) + (0.5 if i == 0 else 0))
+        order = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))
+    else:
+        raise ValueError("Unknown budget mode: {}".format(mode))
+
+    selected = []
+    used = 0
+    for i in order:
+        if used + lengths[i] <= max_tokens:
+            selected.append(i)
+            used += lengths[i]
+        elif mode == 'truncate':
+            break
+    if not selected:
+        return _truncate_words(sentences[0], max_tokens, encoding_name)
+    return " ".join(sentences[i] for i in sorted(selected))
+
+
+ARTICLE_CONTEXT_PREFIX = """
+You are a helpful assistant. 
+You will be provided information about an academic article in the area of social sciences and humanities, followed by a task about one of its keywords.
+You will be provided the following elements about the article: Original language of the article, Title of the article, Abstract of the article.
+When one of these elements is not available, you will be provided an empty string.
+
+Original language of the article: {original_language}
+Title of the article: {title}
+Abstract of the article: {abstract}
+"""
+
+
+PREFIX_POTENTIAL_ENTITIES_GENERATION_TASK = """
+Task: given a keyword of the article (which has been provided by the author of the article and can be in any language), find the corresponding entity in Wikidata. 
+You have to provide the name of the entity, then another agent will take care of finding the corresponding URI.
+In some cases, the keyword is a Wikidata entity itself (for example, a word like "horse" has a Wikidata entity with the same name).
+In other cases (complex concept or expression), you have to provide entities that you think are related to the keyword, given your understanding of the article content. 
+
+You can give up to {number_of_names} potential entity names for a keyword. 
+You don't necessarily have to provide {number_of_names} names: 1 name is enough if the keyword is a simple concept. However, you need to provide at least 1 name.
+{answer_format}
+
+Keyword: {keyword}
+"""
+
+
+PREFIX_ENTITY_SELECTION_TASK = """
+Task: you will be provided with a keyword of the article (note that the keyword can be in any language) and a list of Wikidata entities and their descriptions, 
+which are potential matches for the keyword. Select the best matching entity that matches the keyword.
+
+{answer_format}
+
+Keyword: {keyword}
+
+Entities: 
+{entities}
+"""
+
+
+"""
+The following classes have the same interface and answer format as PotentialEntitiesGenerationPrompt and EntitySelectionPrompt,
+with the shared-prefix layout described above. The abstract should already be shortened (see PromptBuilder).
+"""
+
+class PrefixPotentialEntitiesGenerationPrompt(PotentialEntitiesGenerationPrompt):
+    def generate_prompt(self):
+        return (ARTICLE_CONTEXT_PREFIX.format(original_language=self.original_language, title=self.title, abstract=self.abstract)
+                + PREFIX_POTENTIAL_ENTITIES_GENERATION_TASK.format(number_of_names=self.number_of_names, keyword=self.keyword, answer_format=self.answer_format()))
+
+
+class PrefixEntitySelectionPrompt(EntitySelectionPrompt):
+    def generate_prompt(self):
+        return (ARTICLE_CONTEXT_PREFIX.format(original_language=self.original_language, title=self.title, abstract=self.abstract)
+                + PREFIX_ENTITY_SELECTION_TASK.format(keyword=self.keyword, entities=self.entities, answer_format=self.answer_format()))
+
+
+"""
+The following class builds the prompts of the back-and-forth flow (see main_functions.set_prompt_builder). Parameters are:
+- abstract_token_budget: maximum number of tokens of the abstract (None for no limit); the budget is per article, so that the
+shortened abstract, and therefore the prefix, is the same in all the prompts of the article
+- abstract_mode: 'truncate' or 'extractive' (see budget_text)
+- shared_prefix: True for the shared-prefix layout, False for the original templates (only the abstract is shortened)
+- encoding_name: tiktoken encoding used to count tokens
+Shortened abstracts are memoized, so the abstract of an article is shortened once for all its keywords.
+"""
+
+class PromptBuilder:
+    def __init__(self, abstract_token_budget=300, abstract_mode='truncate', shared_prefix=True, encoding_name="cl100k_base"):
+        self.abstract_token_budget = abstract_token_budget
+        self.abstract_mode = abstract_mode
+        self.shared_prefix = shared_prefix
+        self.encoding_name = encoding_name
+        self._abstracts = {}
+        self._lock = threading.Lock()
+
+    #  thread-safe (the builder is shared by the threads of async_utils): the shortened abstract is computed outside the lock
+    def prepare_abstract(self, abstract, title="", keywords=()):
+        if not abstract or self.abstract_token_budget is None:
+            return abstract
+        key = (abstract, title, tuple(keywords)) if self.abstract_mode == 'extractive' else abstract
+        with self._lock:
+            shortened = self._abstracts.get(key)
+        if shortened is None:
+            shortened = budget_text(abstract, self.abstract_token_budget, self.abstract_mode, [title] + list(keywords), self.encoding_name)
+            with self._lock:
+                if len(self._abstracts) >= 10000:
+                    self._abstracts.clear()
+                self._abstracts[key] = shortened
+        return shortened
+
+    def generation_prompt(self, number_of_names, original_language, title, abstract, keyword):
+        #  in extractive mode the title (not the keyword) guides the selection of sentences, so the abstract is the same for all the keywords
+        abstract = self.prepare_abstract(abstract, title)
+        prompt_class = PrefixPotentialEntitiesGenerationPrompt if self.shared_prefix else PotentialEntitiesGenerationPrompt
+        return prompt_class(number_of_names, original_language, title, abstract, keyword)
+
+    def selection_prompt(self, number_of_entities, original_language, title, abstract, keyword, entities):
+        abstract = self.prepare_abstract(abstract, title)
+        prompt_class = PrefixEntitySelectionPrompt if self.shared_prefix else EntitySelectionPrompt
+        return prompt_class(number_of_entities, original_language, title, abstract, keyword, entities)
 
+    def count_tokens(self, prompt):
+        return count_tokens(prompt, self.encoding_name)
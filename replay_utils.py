@@ -0,0 +1,308 @@
+"""This file contains the record/replay layer used by the pipeline benchmarks (see benchmark_utils.py).
+Live services (GoTriple, DBPedia Spotlight, DBPedia SPARQL, Wikidata, OpenAI/Groq) have a latency variance that hides any improvement,
+so the benchmarks run against recorded responses instead:
+- while recording, the HTTP requests of http_utils and the calls to the LLM client are executed normally and their responses are saved
+in a fixture file (FixtureStore);
+- while replaying, a local stand-in serves the recorded responses without network, with a configurable injected latency for each
+service, and counts the requests and their latencies per service.
+HTTP traffic is intercepted with a requests transport adapter mounted on the shared session of http_utils, so the mapping functions
+are executed unchanged. LLM calls go through ReplayLLMClient, which has the same interface as the OpenAI and Groq clients
+(and can also be called like a llama.cpp model, for main_functions.useLLM).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+import http_utils
+from metrics_utils import latency_summary
+
+
+SERVICES = ('gotriple', 'spotlight', 'sparql', 'wikidata', 'llm', 'other')
+
+
+#  name of the service a URL belongs to, used to group request counts and latencies
+def service_of(url):
+    host = urlsplit(url).netloc
+    if 'gotriple' in host:
+        return 'gotriple'
+    if 'dbpedia-spotlight' in host:
+        return 'spotlight'
+    if 'dbpedia.org' in host:
+        return 'sparql'
+    if 'wikidata.org' in host:
+        return 'wikidata'
+    return 'other'
+
+
+#  key of an HTTP request: method, URL with sorted query parameters, and hash of the body
+def http_request_key(method, url, body=None):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if body:
+        body = urlencode(sorted(parse_qsl(body.decode('utf-8'), keep_blank_values=True))).encode('utf-8') if b'=' in body else body
+    body_hash = hashlib.sha256(body).hexdigest() if body else ''
+    return "{} {}://{}{}?{} {}".format(method.upper(), parts.scheme, parts.netloc, parts.path, query, body_hash)
+
+
+#  key of an LLM call: hash of the model and of the prompt (messages for chat clients, prompt text for llama.cpp models)
+def llm_request_key(model, messages=None, prompt=None, max_tokens=None):
+    payload = json.dumps({'model': model, 'messages': messages, 'prompt': prompt, 'max_tokens': max_tokens}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+"""
+The following class stores the recorded responses. It is saved as a JSON file with three sections:
+'http' (request key -> status code, headers and body of the response), 'llm' (request key -> content of the answer and token usage)
+and 'meta' (free information about the recording, e.g. the records and the model used by benchmark_utils).
+"""
+
+class FixtureStore:
+    def __init__(self, path=None):
+        self.path = path
+        self.http = {}
+        self.llm = {}
+        self.meta = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.http = data.get('http', {})
+            self.llm = data.get('llm', {})
+            self.meta = data.get('meta', {})
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            data = {'meta': self.meta, 'http': self.http, 'llm': self.llm}
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+"""
+The following class collects the latency of each request for each service (see SERVICES), and the number of requests
+without a recorded response (misses). It is shared by the HTTP adapters and the LLM clients of this file.
+"""
+
+class ReplayStats:
+    def __init__(self):
+        self.latencies = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def add(self, service, latency):
+        with self._lock:
+            self.latencies.setdefault(service, []).append(latency)
+
+    def add_miss(self, service):
+        with self._lock:
+            self.misses[service] = self.misses.get(service, 0) + 1
+
+    def request_counts(self):
+        with self._lock:
+            return {service: len(values) for service, values in self.latencies.items()}
+
+    def summary(self):
+        with self._lock:
+            return {service: latency_summary(values) for service, values in self.latencies.items()}
+
+    def reset(self):
+        with self._lock:
+            self.latencies = {}
+            self.misses = {}
+
+
+"""
+The following class is the transport adapter used while recording: it sends the requests with the adapter it replaces
+(so the connection pools and the retry policy of http_utils are kept) and saves every response in the store.
+"""
+
+class RecordingAdapter(BaseAdapter):
+    def __init__(self, store, adapter, stats=None):
+        super().__init__()
+        self.store = store
+        self.adapter = adapter
+        self.stats = stats if stats is not None else ReplayStats()
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = self.adapter.send(request, **kwargs)
+        self.stats.add(service_of(request.url), time.perf_counter() - start)
+        entry = {
+            'status_code': response.status_code,
+            'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')},
+            'body': response.content.decode('utf-8', errors='replace')
+        }
+        with self.store._lock:
+            self.store.http[http_request_key(request.method, request.url, request.body)] = entry
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+"""
+The following class is the transport adapter that serves the recorded responses. latency is the delay injected before each response,
+either a number of seconds for all the services or a dictionary service -> seconds.
+If strict is True, a request without a recorded response raises an error; otherwise a 404 response is returned.
+"""
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, store, latency=0.0, stats=None, strict=True):
+        super().__init__()
+        self.store = store
+        self.latency = latency
+        self.stats = stats if stats is not None else ReplayStats()
+        self.strict = strict
+
+    def _latency(self, service):
+        if isinstance(self.latency, dict):
+            return self.latency.get(service, 0.0)
+        return self.latency
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        start = time.perf_counter()
+        service = service_of(request.url)
+        entry = self.store.http.get(http_request_key(request.method, request.url, request.body))
+        if entry is None:
+            if self.strict:
+                raise KeyError("No recorded response for {} {}".format(request.method, request.url))
+            self.stats.add_miss(service)
+            entry = {'status_code': 404, 'headers': {'Content-Type': 'application/json'}, 'body': '{}'}
+        delay = self._latency(service)
+        if delay:
+            time.sleep(delay)
+
+        response = Response()
+        response.status_code = entry['status_code']
+        response.headers = CaseInsensitiveDict(entry.get('headers', {}))
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        self.stats.add(service, time.perf_counter() - start)
+        return response
+
+    def close(self):
+        pass
+
+
+def _mount(adapter):
+    session = http_utils.get_session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+"""
+The following functions install the recording or the replay adapter on the shared session of http_utils.
+Call http_utils.close() (or stop_http) to go back to the normal session.
+"""
+
+def record_http(store, stats=None):
+    adapter = RecordingAdapter(store, http_utils.get_session().get_adapter('https://'), stats)
+    _mount(adapter)
+    return adapter
+
+
+def replay_http(store, latency=0.0, stats=None, strict=True):
+    adapter = ReplayAdapter(store, latency, stats, strict)
+    _mount(adapter)
+    return adapter
+
+
+def stop_http():
+    http_utils.close()
+
+
+def _completion(content, model, usage):
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, message=SimpleNamespace(role='assistant', content=content), finish_reason='stop')],
+        usage=SimpleNamespace(**usage) if usage else None
+    )
+
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+"""
+The following class wraps an LLM client (or a llama.cpp model) while recording: every answer is saved in the store.
+It can be used everywhere the wrapped client (or model) is expected.
+"""
+
+class RecordingLLMClient:
+    def __init__(self, client, store, stats=None):
+        self.client = client
+        self.store = store
+        self.stats = stats if stats is not None else ReplayStats()
+        self.chat = SimpleNamespace(completions=_Completions(self._create))
+
+    def _create(self, **kwargs):
+        start = time.perf_counter()
+        completion = self.client.chat.completions.create(**kwargs)
+        self.stats.add('llm', time.perf_counter() - start)
+        usage = getattr(completion, 'usage', None)
+        entry = {
+            'content': completion.choices[0].message.content,
+            'usage': {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens, 'total_tokens': usage.total_tokens} if usage else None
+        }
+        with self.store._lock:
+            self.store.llm[llm_request_key(kwargs.get('model'), messages=kwargs.get('messages'))] = entry
+        return completion
+
+    def __call__(self, prompt, max_tokens=None, **kwargs):
+        start = time.perf_counter()
+        output = self.client(prompt, max_tokens=max_tokens, **kwargs)
+        self.stats.add('llm', time.perf_counter() - start)
+        with self.store._lock:
+            self.store.llm[llm_request_key(None, prompt=prompt, max_tokens=max_tokens)] = {'content': output['choices'][0]['text'], 'usage': output.get('usage')}
+        return output
+
+
+"""
+The following class replays the recorded LLM answers, with the interface of the OpenAI and Groq clients (client.chat.completions.create)
+and of llama.cpp models (model(prompt, max_tokens=...)). latency is the delay injected before each answer (in seconds).
+"""
+
+class ReplayLLMClient:
+    def __init__(self, store, latency=0.0, stats=None, strict=True):
+        self.store = store
+        self.latency = latency
+        self.stats = stats if stats is not None else ReplayStats()
+        self.strict = strict
+        self.chat = SimpleNamespace(completions=_Completions(self._create))
+
+    def _entry(self, key):
+        start = time.perf_counter()
+        entry = self.store.llm.get(key)
+        if entry is None:
+            if self.strict:
+                raise KeyError("No recorded LLM answer for request {}".format(key))
+            self.stats.add_miss('llm')
+            entry = {'content': '', 'usage': None}
+        if self.latency:
+            time.sleep(self.latency)
+        self.stats.add('llm', time.perf_counter() - start)
+        return entry
+
+    def _create(self, **kwargs):
+        entry = self._entry(llm_request_key(kwargs.get('model'), messages=kwargs.get('messages')))
+        return _completion(entry['content'], kwargs.get('model'), entry.get('usage'))
+
+    def __call__(self, prompt, max_tokens=None, **kwargs):
+        entry = self._entry(llm_request_key(None, prompt=prompt, max_tokens=max_tokens))
+        return {'choices': [{'text': entry['content']}], 'usage': entry.get('usage')}
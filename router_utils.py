@@ -0,0 +1,309 @@
+"""This file contains a router that spreads the LLM calls of the mapping functions over several providers (Groq, OpenAI, local llama.cpp models).
+With a single client, completion_with_backoff waits up to a minute when a provider answers 429 (rate limit reached), even if another
+provider could serve the request. The router holds several clients and, for each request, picks the provider with the most headroom:
+- each provider has two token buckets, one for requests per minute (rpm) and one for tokens per minute (tpm), refilled continuously;
+the tokens of a request are estimated from its messages (prompt_utils.count_tokens) plus max_tokens;
+- the buckets are corrected with the rate-limit headers returned by OpenAI and Groq (x-ratelimit-remaining-requests,
+x-ratelimit-remaining-tokens), when the client gives access to them, and the provider is paused until x-ratelimit-reset-requests /
+x-ratelimit-reset-tokens when nothing remains; when rpm or tpm is not given, the capacity of the bucket is learned from
+x-ratelimit-limit-requests / x-ratelimit-limit-tokens (taken as limits per minute);
+- the number of concurrent requests of each provider is adapted with AIMD (additive increase, multiplicative decrease):
+it grows by one every 'limit' successful calls and is halved on a 429;
+- on a 429 the provider is paused until the time given by the retry-after header (or the bucket reset time), and on 429, 5xx and connection
+errors the request is sent again to another provider (fallback). Other errors (e.g. 400) are raised immediately.
+The router has the interface of the OpenAI client (router.chat.completions.create(model=..., messages=...)), so it can be given as client
+to useLLM_back_and_forth, useLLM_back_and_forth_article and async_utils. Since it retries and falls back itself (handles_retries),
+main_functions.completion_with_backoff calls it without its own exponential backoff. The model of each provider is set when the provider is added
+(the model name given to create is used for providers without a model).
+
+Example:
+router = router_utils.LLMRouter([
+    router_utils.Provider('groq', groq_client, model='llama-3.3-70b-versatile', rpm=30, tpm=6000),
+    router_utils.Provider('openai', openai_client, model='gpt-4o-mini', rpm=500, tpm=200000),
+])
+main_functions.useLLM_back_and_forth(language, title, abstract, keyword, router, 'gpt-4o-mini')
+"""
+
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import metrics_utils
+import prompt_utils
+
+
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+RETRYABLE_ERRORS = ('APIConnectionError', 'APITimeoutError', 'ConnectionError', 'Timeout', 'TimeoutError')
+
+
+"""
+The following class is a token bucket of the given capacity, refilled with capacity tokens every period seconds.
+A capacity of None means no limit until a limit is learned from the headers of the provider (see update).
+"""
+
+class TokenBucket:
+    def __init__(self, capacity, period=60.0):
+        self.period = period
+        self.configured = bool(capacity)
+        self._set_capacity(capacity)
+        self.level = float(capacity) if capacity else None
+        self.updated = time.monotonic()
+
+    def _set_capacity(self, capacity):
+        self.capacity = capacity
+        self.rate = capacity / self.period if capacity else None
+
+    def _refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    #  fraction of the bucket that is available (1.0 without limit)
+    def headroom(self, now):
+        if not self.capacity:
+            return 1.0
+        self._refill(now)
+        return max(0.0, self.level) / self.capacity
+
+    #  seconds to wait before amount tokens are available (0 if they are available now)
+    def wait_time(self, amount, now):
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.level -= amount
+
+    def give_back(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.level = min(self.capacity, self.level + amount)
+
+    #  correction with the number of remaining tokens given by the rate-limit headers of the provider; limit (the capacity given
+    #  by the headers) is used as capacity when none was configured
+    def update(self, remaining, now, limit=None):
+        if not self.configured and limit and limit != self.capacity:
+            self._refill(now)
+            self.level = float(limit) if self.level is None else min(self.level, float(limit))
+            self._set_capacity(limit)
+        if self.capacity and remaining is not None:
+            self._refill(now)
+            self.level = min(self.level, float(remaining))
+
+
+#  durations of the rate-limit headers, e.g. '1s', '6m0s', '2m59.56s', '20ms'
+def parse_duration(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def _header(headers, name):
+    if headers is None:
+        return None
+    try:
+        return headers.get(name)
+    except AttributeError:
+        return None
+
+
+def _int_header(headers, name):
+    value = _header(headers, name)
+    try:
+        return int(float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+"""
+The following class is a provider of the router. Parameters are:
+- name: name of the provider (used in the metrics and in stats)
+- client: OpenAI-compatible client (OpenAI, Groq, llama_engine.LocalLLMEngine, cache_utils.CachingLLMClient, ...)
+- model: model used for the requests sent to this provider (None to use the model of the request)
+- rpm, tpm: requests and tokens per minute allowed (None to learn them from the rate-limit headers, no limit until then)
+- max_concurrency: maximum number of concurrent requests; initial_concurrency: starting number of concurrent requests (AIMD)
+- priority: used to choose between providers with the same headroom (higher first)
+"""
+
+class Provider:
+    def __init__(self, name, client, model=None, rpm=None, tpm=None, max_concurrency=16, initial_concurrency=4, priority=0):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.priority = priority
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def headroom(self, now):
+        if now < self.paused_until or self.in_flight >= int(self.limit):
+            return 0.0
+        return min(self.requests.headroom(now), self.tokens.headroom(now), 1 - self.in_flight / int(self.limit))
+
+    def wait_time(self, tokens, now):
+        if self.in_flight >= int(self.limit):
+            return None  # until a request of this provider ends
+        return max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now), 0.0)
+
+    def on_success(self, headers, now):
+        self.calls += 1
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            remaining = _int_header(headers, 'x-ratelimit-remaining-' + kind)
+            bucket.update(remaining, now, _int_header(headers, 'x-ratelimit-limit-' + kind))
+            if remaining == 0:
+                self.paused_until = max(self.paused_until, now + (parse_duration(_header(headers, 'x-ratelimit-reset-' + kind)) or 1.0))
+
+    def on_error(self, error, now):
+        self.errors += 1
+        status = _status_code(error)
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+        if status == 429:
+            self.rate_limited += 1
+            self.limit = max(1.0, self.limit / 2)
+            pause = parse_duration(_header(headers, 'retry-after')) or max(
+                parse_duration(_header(headers, 'x-ratelimit-reset-requests')) or 0,
+                parse_duration(_header(headers, 'x-ratelimit-reset-tokens')) or 0) or 1.0
+            self.paused_until = max(self.paused_until, now + pause)
+        elif status is None or status >= 500:
+            self.paused_until = max(self.paused_until, now + 1.0)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'rate_limited': self.rate_limited,
+            'in_flight': self.in_flight,
+            'concurrency_limit': int(self.limit),
+            'rpm': self.requests.capacity,
+            'tpm': self.tokens.capacity
+        }
+
+
+def _estimate_tokens(kwargs):
+    prompt_tokens = sum(prompt_utils.count_tokens(message.get('content') or "") for message in kwargs.get('messages', []))
+    return prompt_tokens + (kwargs.get('max_tokens') or 256)
+
+
+"""
+The following class is the router. Parameters are:
+- providers: list of Provider
+- max_attempts: number of providers tried for a request before the last error is raised (fallback on 429, 5xx and connection errors)
+- max_wait: maximum number of seconds a request waits for a provider with headroom before TimeoutError is raised
+"""
+
+class LLMRouter:
+    handles_retries = True
+
+    def __init__(self, providers, max_attempts=4, max_wait=300):
+        if not providers:
+            raise ValueError("The router needs at least one provider")
+        self.providers = list(providers)
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self.fallbacks = 0
+        self._condition = threading.Condition()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat_completion))
+
+    #  waits for the provider with the most headroom (excluding those in exclude, unless all were tried) and reserves a slot
+    def _acquire(self, tokens, exclude):
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                candidates = [provider for provider in self.providers if provider not in exclude] or self.providers
+                ready = [provider for provider in candidates if provider.wait_time(tokens, now) == 0.0]
+                if ready:
+                    provider = max(ready, key=lambda p: (p.headroom(now), p.priority))
+                    provider.in_flight += 1
+                    provider.requests.take(1, now)
+                    provider.tokens.take(tokens, now)
+                    return provider
+                waits = [wait for wait in (provider.wait_time(tokens, now) for provider in candidates) if wait is not None]
+                if now >= deadline:
+                    raise TimeoutError("No LLM provider available after {} seconds".format(self.max_wait))
+                self._condition.wait(min(waits + [deadline - now]) if waits else deadline - now)
+
+    def _release(self, provider, tokens, headers=None, error=None):
+        with self._condition:
+            now = time.monotonic()
+            provider.in_flight -= 1
+            if error is None:
+                provider.on_success(headers, now)
+            else:
+                provider.on_error(error, now)
+                if _status_code(error) != 429:
+                    provider.requests.give_back(1, now)
+                    provider.tokens.give_back(tokens, now)
+            self._condition.notify_all()
+
+    #  sends the request to the provider, with access to the response headers when the client allows it (OpenAI and Groq clients)
+    @staticmethod
+    def _send(provider, kwargs):
+        completions = provider.client.chat.completions
+        raw_create = getattr(getattr(completions, 'with_raw_response', None), 'create', None)
+        if raw_create is not None:
+            raw = raw_create(**kwargs)
+            return raw.parse(), raw.headers
+        return completions.create(**kwargs), None
+
+    def _create_chat_completion(self, **kwargs):
+        tokens = _estimate_tokens(kwargs)
+        tried = []
+        error = None
+        for attempt in range(self.max_attempts):
+            provider = self._acquire(tokens, tried)
+            request = dict(kwargs, model=provider.model or kwargs.get('model'))
+            if attempt > 0:
+                self.fallbacks += 1
+                metrics_utils.count('router_fallbacks', 1, provider=provider.name)
+            try:
+                with metrics_utils.span('router_request', provider=provider.name):
+                    completion, headers = self._send(provider, request)
+            except Exception as e:
+                self._release(provider, tokens, error=e)
+                metrics_utils.count('router_errors', 1, provider=provider.name, status=_status_code(e))
+                if not is_retryable(e):
+                    raise
+                error = e
+                tried.append(provider)
+                continue
+            self._release(provider, tokens, headers=headers)
+            metrics_utils.count('router_requests', 1, provider=provider.name)
+            return completion
+        raise error
+
+    def stats(self):
+        with self._condition:
+            return {'fallbacks': self.fallbacks, 'providers': {provider.name: provider.stats() for provider in self.providers}}
@@ -0,0 +1,214 @@
+"""This file contains the sharded run mode of keywords_translation.py, to split a large mapping job over several machines.
+Records are assigned to shards by a stable hash of their Id (records without an Id use their position in the input), so every node
+reading the same input computes the same split without any coordination:
+python -m keywords_translation map --input ids.txt --num-shards 4 --shard 0 --output results.shard{shard}.jsonl   (on the first node)
+...
+python -m keywords_translation merge --manifests results.shard*.jsonl.manifest.json --output results.jsonl
+Each shard writes its own output file (which is also its checkpoint: with --resume, a failed or interrupted shard starts again from
+where it stopped) and a manifest next to it ('<output>.manifest.json') with the input fingerprint, the configuration, the status
+of the shard, the number of records assigned to it and the records that failed or have no line in the output. A shard is 'complete'
+when every record assigned to it has a line without errors; shards that are 'running' (interrupted) or 'incomplete' (some records failed
+or are missing) can be run again alone with the same command and --resume.
+merge checks that the manifests belong to the same job, that all the shards are complete and that their lines cover every record
+of the input, then writes the lines of all the shards
+ordered by their position in the input, without the timing field ('seconds'): the merged file is identical to the merge of a single-node
+run (--num-shards 1) of the same input.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+#  fields of the output lines that depend on the run (not on the input), left out of the merged file
+RUN_FIELDS = ('seconds',)
+
+
+def shard_of(record_id, num_shards):
+    digest = hashlib.sha1(str(record_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+#  shard of the record at position index of the input
+def record_shard(index, record, num_shards):
+    record_id = record.get('Id', record.get('id'))
+    if record_id is None or record_id != record_id:  # missing or NaN
+        record_id = "#{}".format(index)
+    return shard_of(record_id, num_shards)
+
+
+"""
+The following function returns the fingerprint of the input of a job: the SHA-256 of the input file, or of the list of ids.
+"""
+
+def input_fingerprint(path=None, ids=None):
+    digest = hashlib.sha256()
+    if path is not None:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        digest.update("\n".join(ids or []).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def manifest_path(output_path):
+    return output_path + MANIFEST_SUFFIX
+
+
+def write_manifest(output_path, manifest):
+    path = manifest_path(output_path)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False, default=str)
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+"""
+The following function creates the manifest of a shard at the start of its run (status 'running'). job is a dictionary describing
+the job (input, fingerprint, configuration), which must be the same for all the shards.
+"""
+
+def start_manifest(output_path, job, shard, num_shards):
+    manifest = {
+        'job': job,
+        'shard': shard,
+        'num_shards': num_shards,
+        'output': os.path.abspath(output_path),
+        'status': 'running',
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'finished': None,
+        'records': None,
+        'input_records': None,
+        'assigned_records': None,
+        'failed_indexes': [],
+        'missing_indexes': [],
+        'stats': None
+    }
+    write_manifest(output_path, manifest)
+    return manifest
+
+
+#  latest line of each record in an output file: a successful line wins over the errors of previous runs of the shard
+def read_output(output_path):
+    lines = {}
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for text in f:
+                try:
+                    line = json.loads(text)
+                except ValueError:
+                    continue  # truncated last line
+                previous = lines.get(line['index'])
+                if previous is None or line.get('error') is None or previous.get('error') is not None:
+                    lines[line['index']] = line
+    return lines
+
+
+"""
+The following function completes the manifest of a shard at the end of its run, from its output file (so that records mapped by
+previous runs of the shard are also counted). assigned is the set of the indexes of the records of the shard (see keywords_translation.run_map)
+and stats the statistics of the run, with the number of records of the input ('input_records').
+Status is 'complete' if every assigned record has a line without errors, 'incomplete' otherwise: failed_indexes lists the positions
+in the input of the records that failed, missing_indexes those without any line in the output (e.g. lost in a crash).
+"""
+
+def finish_manifest(output_path, manifest, stats, assigned):
+    lines = read_output(output_path)
+    manifest['failed_indexes'] = sorted(index for index, line in lines.items() if line.get('error') is not None)
+    manifest['missing_indexes'] = sorted(set(assigned) - set(lines))
+    manifest['records'] = len(lines)
+    manifest['input_records'] = stats['input_records']
+    manifest['assigned_records'] = len(assigned)
+    manifest['status'] = 'incomplete' if manifest['failed_indexes'] or manifest['missing_indexes'] else 'complete'
+    manifest['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    manifest['stats'] = stats
+    write_manifest(output_path, manifest)
+    return manifest
+
+
+"""
+The following function returns the status of each shard of a job from the manifests (paths or glob patterns), as a list of dictionaries
+with 'shard', 'status', 'records', 'failed', 'missing' and 'output', plus the shards with no manifest (status 'missing').
+It raises ValueError if the manifests do not belong to the same job.
+"""
+
+def shard_statuses(manifest_paths):
+    manifests = _load_manifests(manifest_paths)
+    num_shards = manifests[0]['num_shards']
+    by_shard = {manifest['shard']: manifest for manifest in manifests}
+    statuses = []
+    for shard in range(num_shards):
+        manifest = by_shard.get(shard)
+        if manifest is None:
+            statuses.append({'shard': shard, 'status': 'missing', 'records': None, 'failed': None, 'missing': None, 'output': None})
+        else:
+            statuses.append({'shard': shard, 'status': manifest['status'], 'records': manifest['records'], 'failed': len(manifest['failed_indexes']),
+                             'missing': len(manifest.get('missing_indexes', [])), 'output': manifest['output']})
+    return statuses
+
+
+def _load_manifests(manifest_paths):
+    paths = sorted(set(path for pattern in manifest_paths for path in (glob.glob(pattern) or [pattern])))
+    manifests = []
+    for path in paths:
+        manifest = read_manifest(path)
+        #  the output is next to its manifest (shard files may have been copied from other machines)
+        if path.endswith(MANIFEST_SUFFIX):
+            manifest['output'] = path[:-len(MANIFEST_SUFFIX)]
+        manifests.append(manifest)
+    if not manifests:
+        raise ValueError("No manifest found")
+    first = manifests[0]
+    for manifest in manifests[1:]:
+        if manifest['job'] != first['job'] or manifest['num_shards'] != first['num_shards']:
+            raise ValueError("Manifests of different jobs: {} and {}".format(first['output'], manifest['output']))
+    shards = [manifest['shard'] for manifest in manifests]
+    if len(shards) != len(set(shards)):
+        raise ValueError("Several manifests for the same shard")
+    return manifests
+
+
+"""
+The following function merges the outputs of the shards of a job into output_path and returns the number of lines written.
+All the shards must be complete and their lines must cover every record of the input (ValueError otherwise), unless allow_incomplete is True
+(the failed lines are then merged as they are, and missing shards and records are skipped).
+Lines are ordered by their position in the input and the run fields (RUN_FIELDS) are removed, so the result does not depend
+on the number of shards, on their scheduling or on the order in which records finished.
+"""
+
+def merge_shards(manifest_paths, output_path, allow_incomplete=False):
+    manifests = _load_manifests(manifest_paths)
+    if not allow_incomplete:
+        not_complete = [status for status in shard_statuses(manifest_paths) if status['status'] != 'complete']
+        if not_complete:
+            raise ValueError("Shards not complete: " + ", ".join("{} ({})".format(status['shard'], status['status']) for status in not_complete))
+
+    lines = {}
+    for manifest in manifests:
+        for index, line in read_output(manifest['output']).items():
+            if index in lines:
+                raise ValueError("Record {} is in more than one shard".format(index))
+            lines[index] = line
+    if not allow_incomplete:
+        input_records = set(manifest.get('input_records') for manifest in manifests)
+        if len(input_records) != 1 or None in input_records:
+            raise ValueError("The shards did not read the same number of input records: {}".format(sorted(input_records, key=str)))
+        missing = [index for index in range(input_records.pop()) if index not in lines]
+        if missing:
+            raise ValueError("{} records are missing from the shards (first: {})".format(len(missing), ", ".join(str(index) for index in missing[:10])))
+
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+        for index in sorted(lines):
+            line = {key: value for key, value in lines[index].items() if key not in RUN_FIELDS}
+            f.write(json.dumps(line, ensure_ascii=False, sort_keys=True, default=str) + "\n")
+    os.replace(output_path + '.tmp', output_path)
+    return len(lines)
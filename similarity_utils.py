@@ -0,0 +1,150 @@
+"""This file contains the functions used to score Wikidata candidates against a query term.
+tools_utils.query_wikidata and tools_utils.query_best_matches_wikidata rank candidates with difflib.SequenceMatcher(None, query, label).ratio(),
+which is computed one pair at a time in pure Python. This is fine for the short lists returned by the Wikidata API, but it becomes
+slow with the long candidate lists of a local index (see wikidata_index.py) or of large caches.
+The functions below score one query against many labels at once with NumPy:
+- the 'ngram' method computes the Dice coefficient between the character n-gram multisets of the query and of each label,
+fully vectorized (it is a different measure than SequenceMatcher, usually with a very similar ranking);
+- the 'compat' method returns exactly the same scores and ranking as SequenceMatcher for the top-k labels: it first computes
+a vectorized upper bound of the SequenceMatcher ratio for every label (the character overlap, as in SequenceMatcher.quick_ratio)
+and then computes the exact ratio only for the labels whose bound can still enter the top-k;
+- the 'sequence' method is the original per-pair SequenceMatcher loop.
+"""
+
+from difflib import SequenceMatcher
+import heapq
+
+import numpy as np
+
+
+#  below this number of labels, the vectorized code is slower than the plain loop
+VECTORIZE_MIN_LABELS = 32
+NGRAM_SIZE = 3
+BITS_PER_CHARACTER = 21  # Unicode code points fit in 21 bits, so 3 characters fit in a 64-bit integer
+
+
+def sequence_ratio(query, label):
+    return SequenceMatcher(None, query, label).ratio()
+
+
+#  concatenates the code points of all the strings, and returns them with the length of each string
+def _code_points(strings):
+    lengths = np.fromiter((len(s) for s in strings), dtype=np.int64, count=len(strings))
+    code_points = np.frombuffer("".join(strings).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.uint64)
+    return code_points, lengths
+
+
+#  returns the n-grams of all the strings (each n-gram encoded as an integer) and the index of the string each n-gram belongs to
+def _ngrams(code_points, lengths, n):
+    number_of_positions = len(code_points) - n + 1
+    if number_of_positions <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    grams = code_points[:number_of_positions].copy()
+    for j in range(1, n):
+        grams = (grams << np.uint64(BITS_PER_CHARACTER)) | code_points[j:number_of_positions + j]
+    owners = np.repeat(np.arange(len(lengths)), lengths)[:number_of_positions]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    #  n-grams that cross the boundary between two strings are dropped
+    valid = np.arange(number_of_positions) - starts[owners] + n <= lengths[owners]
+    return grams[valid], owners[valid]
+
+
+#  size of the multiset intersection between the n-grams of the query and the n-grams of each label
+def _multiset_overlap(query_grams, label_grams, owners, number_of_labels):
+    if len(query_grams) == 0 or len(label_grams) == 0:
+        return np.zeros(number_of_labels, dtype=np.int64)
+    unique_grams, query_counts = np.unique(query_grams, return_counts=True)
+    positions = np.minimum(np.searchsorted(unique_grams, label_grams), len(unique_grams) - 1)
+    matches = unique_grams[positions] == label_grams
+    flat = owners[matches] * len(unique_grams) + positions[matches]
+    counts = np.bincount(flat, minlength=number_of_labels * len(unique_grams)).reshape(number_of_labels, len(unique_grams))
+    return np.minimum(counts, query_counts).sum(axis=1)
+
+
+"""
+The following function returns, for each label, an upper bound of SequenceMatcher(None, query, label).ratio(): twice the number of
+characters the two strings have in common (counted with multiplicity) divided by the total number of characters.
+"""
+
+def sequence_ratio_upper_bounds(query, labels):
+    label_points, label_lengths = _code_points(labels)
+    query_points, _ = _code_points([query])
+    overlap = _multiset_overlap(query_points, label_points, np.repeat(np.arange(len(labels)), label_lengths), len(labels))
+    total = label_lengths + len(query)
+    #  SequenceMatcher returns 1.0 for two empty strings
+    return np.where(total > 0, 2.0 * overlap / np.maximum(total, 1), 1.0)
+
+
+"""
+The following function returns the Dice similarity between the character n-grams of the query and of each label (a NumPy array of scores
+between 0 and 1). Strings are lower-cased and padded with a space at both ends, so that short strings have n-grams too.
+"""
+
+def ngram_similarities(query, labels, n=NGRAM_SIZE):
+    padded = [" {} ".format(label.lower()) for label in labels]
+    label_points, label_lengths = _code_points(padded)
+    label_grams, owners = _ngrams(label_points, label_lengths, n)
+    query_points, query_lengths = _code_points([" {} ".format(query.lower())])
+    query_grams, _ = _ngrams(query_points, query_lengths, n)
+
+    overlap = _multiset_overlap(query_grams, label_grams, owners, len(labels))
+    total = np.maximum(label_lengths - n + 1, 0) + len(query_grams)
+    return np.where(total > 0, 2.0 * overlap / np.maximum(total, 1), 0.0)
+
+
+"""
+The following function scores all the labels against the query and returns a NumPy array of scores.
+method is 'ngram' (vectorized n-gram similarity), 'sequence' or 'compat' (both return the exact SequenceMatcher ratio).
+"""
+
+def score_labels(query, labels, method='ngram'):
+    if method == 'ngram':
+        return ngram_similarities(query, labels)
+    if method in ('sequence', 'compat'):
+        return np.array([sequence_ratio(query, label) for label in labels], dtype=float)
+    raise ValueError("Unknown similarity method: {}".format(method))
+
+
+"""
+The following function returns the k labels with the highest score, as a list of pairs (index of the label, score) sorted by decreasing
+score; labels with the same score keep their original order (like sorted(..., reverse=True) in tools_utils).
+With method='compat' (the default) scores and ranking are the same as with SequenceMatcher, but the exact ratio is computed only for
+the labels that can still enter the top-k. k=None returns all the labels.
+"""
+
+def top_k(query, labels, k=None, method='compat'):
+    number_of_labels = len(labels)
+    if k is None or k > number_of_labels:
+        k = number_of_labels
+    if k <= 0:
+        return []
+
+    if method == 'sequence' or (method == 'compat' and (number_of_labels < VECTORIZE_MIN_LABELS or k == number_of_labels)):
+        scores = [(i, sequence_ratio(query, label)) for i, label in enumerate(labels)]
+        return sorted(scores, key=lambda x: x[1], reverse=True)[:k]
+
+    if method == 'ngram':
+        scores = ngram_similarities(query, labels)
+        candidates = np.argpartition(-scores, k - 1)[:k] if k < number_of_labels else np.arange(number_of_labels)
+        #  ties at the boundary are resolved by index, like a stable sort
+        threshold = scores[candidates].min()
+        candidates = np.flatnonzero(scores >= threshold)
+        ranked = sorted(candidates.tolist(), key=lambda i: (-scores[i], i))[:k]
+        return [(i, float(scores[i])) for i in ranked]
+
+    if method != 'compat':
+        raise ValueError("Unknown similarity method: {}".format(method))
+
+    bounds = sequence_ratio_upper_bounds(query, labels)
+    order = np.lexsort((np.arange(number_of_labels), -bounds))
+    best = []  # heap of (score, -index): the worst of the current top-k is at the top
+    for i in order.tolist():
+        if len(best) == k and bounds[i] < best[0][0]:
+            break
+        score = sequence_ratio(query, labels[i])
+        entry = (score, -i)
+        if len(best) < k:
+            heapq.heappush(best, entry)
+        elif entry > best[0]:
+            heapq.heapreplace(best, entry)
+    return [(-negative_index, score) for score, negative_index in sorted(best, reverse=True)]
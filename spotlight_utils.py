@@ -0,0 +1,134 @@
+"""This file contains a batch annotator for DBPedia Spotlight, which maps the keywords of many articles with few requests.
+main_functions.useDBPediaSpotlight sends one request per article. The batch annotator instead packs the distinct keywords of many
+articles of the same language into a single text ("keyword, keyword, ..."), up to max_characters characters, and sends one request
+per text. The annotations are mapped back to the keywords through their character offsets ('@offset') and then copied to every
+article where the keyword appears. Texts of different languages go to different endpoints and are annotated concurrently.
+The responses are cached by tools_utils.queryAPIDBpediaSpotlight when the Spotlight cache is enabled (see tools_utils.enable_spotlight_cache).
+Like useDBPediaSpotlight without context, only the keywords are annotated; DBPedia URIs are converted to Wikidata URIs in bulk
+(tools_utils.resolve_dbpedia_uris: SPARQL for English, batched wbgetentities sitelink requests for the other languages).
+"""
+
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+import data_utils
+import metrics_utils
+import tools_utils
+
+
+KEYWORD_SEPARATOR = ", "
+MAX_CHARACTERS = 5000
+
+
+"""
+The following function packs keywords into texts. keywords is a list of distinct keywords (of the same language).
+It returns a list of batches, each a pair (text, spans), where spans is the list of (start, end, keyword) of each keyword in the text.
+A keyword longer than max_characters gets a text of its own.
+"""
+
+def pack_keywords(keywords, max_characters=MAX_CHARACTERS):
+    batches = []
+    parts = []
+    spans = []
+    length = 0
+    for keyword in keywords:
+        added = len(keyword) + (len(KEYWORD_SEPARATOR) if parts else 0)
+        if parts and length + added > max_characters:
+            batches.append(("".join(parts), spans))
+            parts, spans, length = [], [], 0
+            added = len(keyword)
+        if parts:
+            parts.append(KEYWORD_SEPARATOR)
+        start = length + (added - len(keyword))
+        parts.append(keyword)
+        spans.append((start, start + len(keyword), keyword))
+        length += added
+    if parts:
+        batches.append(("".join(parts), spans))
+    return batches
+
+
+"""
+The following function annotates one packed text and returns a dictionary keyword -> list of (surface form, DBPedia URI),
+using the offsets of the annotations to find the keyword they belong to (annotations that cross the boundary of a keyword are dropped).
+"""
+
+def annotate_batch(text, spans, language, confidence=0.5):
+    with metrics_utils.span('spotlight_annotation', mode='batch'):
+        response = tools_utils.queryAPIDBpediaSpotlight(text, language, confidence)
+    if response is None:
+        raise RuntimeError("DBPedia Spotlight request failed for a batch of {} keywords ({})".format(len(spans), language))
+
+    starts = [start for start, _, _ in spans]
+    annotations = {keyword: [] for _, _, keyword in spans}
+    for entity in response.get('Resources', []):
+        offset = int(entity['@offset'])
+        i = bisect_right(starts, offset) - 1
+        if i < 0:
+            continue
+        start, end, keyword = spans[i]
+        if offset + len(entity['@surfaceForm']) <= end:
+            annotations[keyword].append((entity['@surfaceForm'], entity['@URI']))
+    return annotations
+
+
+"""
+The following function annotates the keywords of all the records (items from data_utils.get_sample / get_item_by_id, or records
+from eval_utils.parse_excel_file). Parameters are:
+- confidence: confidence threshold of DBPedia Spotlight
+- max_characters: maximum length of a packed text
+- max_workers: number of requests sent concurrently
+- wikidata: True to convert the DBPedia URIs to Wikidata URIs
+It returns a list aligned with records: for each record, the list of annotations of its keywords, each a dictionary with the keys of
+useDBPediaSpotlight ('Form', 'DBPediaURI', 'WikidataURI') and 'Keyword' (the keyword the annotation belongs to).
+If the request of a batch fails, the error is printed and the keywords of that batch get no annotation.
+"""
+
+def annotate_records(records, confidence=0.5, max_characters=MAX_CHARACTERS, max_workers=4, wikidata=True):
+    #  only the language and the keywords of each record are kept (the records are normalized one at a time, and the abstracts
+    #  of CompactItems are never loaded)
+    records = [(record['Language'], record['Keywords']) for record in map(data_utils.normalize_record, records)]
+
+    #  distinct keywords of each language, in order of first appearance
+    keywords_by_language = {}
+    for language, record_keywords in records:
+        keywords = keywords_by_language.setdefault(language, {})
+        for keyword in record_keywords:
+            keywords.setdefault(keyword, None)
+
+    batches = [(language, text, spans) for language, keywords in keywords_by_language.items() for text, spans in pack_keywords(list(keywords), max_characters)]
+
+    def run(batch):
+        language, text, spans = batch
+        try:
+            return language, annotate_batch(text, spans, language, confidence)
+        except Exception as e:
+            print("Spotlight batch failed: {}".format(e))
+            return language, {}
+
+    annotations = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for language, batch_annotations in executor.map(run, batches):
+            for keyword, values in batch_annotations.items():
+                annotations[(language, keyword)] = values
+
+    wikidata_uris = {}
+    if wikidata:
+        dbpedia_uris = set(uri for values in annotations.values() for _, uri in values)
+        if dbpedia_uris:
+            with metrics_utils.span('dbpedia_to_wikidata', mode='batch'):
+                wikidata_uris = tools_utils.resolve_dbpedia_uris(dbpedia_uris, max_workers=max_workers)
+
+    results = []
+    for language, record_keywords in records:
+        record_results = []
+        for keyword in record_keywords:
+            for form, uri in annotations.get((language, keyword), []):
+                record_results.append({
+                    'Form': form,
+                    'DBPediaURI': uri,
+                    'WikidataURI': wikidata_uris.get(uri, []) if wikidata else None,
+                    'Keyword': keyword
+                })
+        results.append(record_results)
+    return results
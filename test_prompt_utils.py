@@ -0,0 +1,38 @@
+"""Tests of the parsing of the answers of the article-level entity selection prompt (prompt_utils.MultiKeywordEntitySelectionPrompt):
+the entry of a keyword must only contain URIs of its candidate entities, and be None otherwise, so that main_functions falls back
+to the per-keyword path (and batch_api_utils repairs the answer). They run offline:
+python -m unittest test_prompt_utils
+"""
+
+import json
+import unittest
+
+import prompt_utils
+
+
+def candidates(*qids):
+    return "".join("Entity: label; Description: description; URI: http://www.wikidata.org/entity/{}\n".format(qid) for qid in qids)
+
+
+class MultiKeywordEntitySelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.prompt = prompt_utils.MultiKeywordEntitySelectionPrompt(
+            1, 'fr', "Title", "Abstract", ['sociologie', 'genre'], [candidates('Q21201'), candidates('Q48277', 'Q1097630')]
+        )
+
+    def test_candidate_uris_are_kept(self):
+        answer = json.dumps({'1': ['http://www.wikidata.org/entity/Q21201'], '2': ['Q48277']})
+        self.assertEqual(self.prompt.checking_schema_function(answer),
+                         [['http://www.wikidata.org/entity/Q21201'], ['http://www.wikidata.org/entity/Q48277']])
+
+    def test_uri_that_is_not_a_candidate(self):
+        answer = json.dumps({'1': ['http://www.wikidata.org/entity/Q5'], '2': ['http://www.wikidata.org/entity/Q5', 'Q1097630']})
+        self.assertEqual(self.prompt.checking_schema_function(answer), [None, ['http://www.wikidata.org/entity/Q1097630']])
+
+    def test_answer_without_uri(self):
+        answer = json.dumps({'1': ['sociology'], '2': []})
+        self.assertEqual(self.prompt.checking_schema_function(answer), [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
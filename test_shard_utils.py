@@ -0,0 +1,91 @@
+"""Regression tests of the sharded run mode (shard_utils.py and keywords_translation.py): an interrupted shard resumed with --resume
+must end complete, with every record, and its merge must be identical to the merge of a single-node run.
+The mapping itself is replaced by a fake map_record, so the tests run offline:
+python -m unittest test_shard_utils
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import keywords_translation
+import shard_utils
+
+
+IDS = ['W{}'.format(i) for i in range(12)]
+
+
+def fake_map_record(index, record):
+    return {'index': index, 'Id': record['id'], 'Language': 'en', 'Keywords': ['keyword'], 'backend': 'spotlight',
+            'result': ['http://www.wikidata.org/entity/Q{}'.format(index)], 'error': None, 'seconds': 0.01}
+
+
+class ShardResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.object(keywords_translation, 'map_record', fake_map_record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def run_shard(self, output, shard=0, num_shards=1, resume=False):
+        argv = ['map', '--ids'] + IDS + ['--backend', 'spotlight', '--workers', '0', '--output', self.path(output),
+                                         '--num-shards', str(num_shards), '--shard', str(shard)]
+        keywords_translation.main(argv + (['--resume'] if resume else []))
+
+    def merge(self, pattern, output):
+        shard_utils.merge_shards([self.path(pattern)], self.path(output))
+        with open(self.path(output), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def test_torn_write_then_resume(self):
+        self.run_shard('single.jsonl')
+        reference = self.merge('single.jsonl.manifest.json', 'reference.jsonl')
+
+        for shard in range(3):
+            self.run_shard('part{shard}.jsonl', shard, 3)
+        #  crash of shard 0 in the middle of a line: the last line is torn and the records after it were not written
+        output = self.path('part0.jsonl')
+        with open(output, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        self.assertGreater(len(lines), 2)
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(lines[0] + lines[1][:len(lines[1]) // 2])
+
+        self.run_shard('part{shard}.jsonl', 0, 3, resume=True)
+        manifest = shard_utils.read_manifest(shard_utils.manifest_path(output))
+        self.assertEqual(manifest['status'], 'complete')
+        self.assertEqual(manifest['records'], len(lines))
+        self.assertEqual(manifest['assigned_records'], len(lines))
+        self.assertEqual(manifest['input_records'], len(IDS))
+        self.assertEqual(self.merge('part*.jsonl.manifest.json', 'merged.jsonl'), reference)
+
+    def test_lost_record_is_detected(self):
+        for shard in range(2):
+            self.run_shard('part{shard}.jsonl', shard, 2)
+        output = self.path('part1.jsonl')
+        with open(output, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        lost = json.loads(lines[0])['index']
+        with open(output, 'w', encoding='utf-8') as f:
+            f.writelines(lines[1:])
+
+        #  the manifest still says complete: merge must check the coverage of the input itself
+        with self.assertRaises(ValueError):
+            shard_utils.merge_shards([self.path('part*.jsonl.manifest.json')], self.path('merged.jsonl'))
+
+        manifest = shard_utils.read_manifest(shard_utils.manifest_path(output))
+        assigned = set(json.loads(line)['index'] for line in lines)
+        manifest = shard_utils.finish_manifest(output, manifest, {'input_records': len(IDS)}, assigned)
+        self.assertEqual(manifest['status'], 'incomplete')
+        self.assertEqual(manifest['missing_indexes'], [lost])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
-from difflib import SequenceMatcher
+import hashlib
+from urllib.parse import unquote, urlsplit
+import http_utils
 from openai import OpenAI
 from groq import Groq
+from concurrent.futures import ThreadPoolExecutor
+import cache_utils
+import similarity_utils
+import metrics_utils
 
 
 
@@ -10,32 +14,75 @@ from groq import Groq
 It takes as parameters the text of the query (the text to annotate), the language of the input text
 and the confidence score (default=0.5)
 It returns None (and prints error) if the query has no success, otherwise it returns the response in JSON format (the response
-contains links to the DBPedia version correspondent to the language) """
+contains links to the DBPedia version correspondent to the language).
+Long texts (more than SPOTLIGHT_MAX_GET_CHARACTERS characters) are sent with POST, so that the URL stays within the server limits.
+If the Spotlight cache is enabled (see enable_spotlight_cache), responses are looked up in the cache first. """
 
 
 def queryAPIDBpediaSpotlight(text, lang, confidence=0.5):
-    url = 'https://api.dbpedia-spotlight.org/{}/annotate'.format(lang)
+    cache = SPOTLIGHT_CACHE
+    if cache is not None:
+        key = spotlight_cache_key(text, lang, confidence)
+        cached = cache.get(key)
+        metrics_utils.cache_lookup('spotlight', cached is not None)
+        if cached is not None:
+            return cached
+
+    url = SPOTLIGHT_API_URL.format(lang)
     headers = {'Accept': 'application/json'}
     params = {
         'text': text,
-        'confidence': 0.5  
+        'confidence': confidence
     }
-    response = requests.get(url, headers=headers, params=params)
+    if len(text) > SPOTLIGHT_MAX_GET_CHARACTERS:
+        response = http_utils.post(url, headers=headers, data=params)
+    else:
+        response = http_utils.get(url, headers=headers, params=params)
     if response.status_code == 200:
-        return response.json()
+        data = response.json()
+        if cache is not None:
+            cache.set(key, data)
+        return data
     else:
         print(f'Errore: {response.status_code}')
         return None
 
+SPOTLIGHT_API_URL = 'https://api.dbpedia-spotlight.org/{}/annotate'
+SPOTLIGHT_MAX_GET_CHARACTERS = 2000
+
+#  cache of Spotlight responses, keyed by (hash of the text, language, confidence), None if disabled (see enable_spotlight_cache)
+SPOTLIGHT_CACHE = None
+
+
+def spotlight_cache_key(text, lang, confidence):
+    return "{}|{}|{}".format(lang, confidence, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+
+"""The following function enables the cache of DBPedia Spotlight responses (in memory and, if path is given, in a SQLite file),
+with the same parameters as enable_wikidata_cache. It returns the cache object."""
+
+def enable_spotlight_cache(path="spotlight_cache.sqlite", ttl=30*24*3600, max_entries=200000, memory_max_entries=20000):
+    global SPOTLIGHT_CACHE
+    if SPOTLIGHT_CACHE is not None:
+        SPOTLIGHT_CACHE.close()
+    SPOTLIGHT_CACHE = cache_utils.TieredCache(path, ttl=ttl, max_entries=max_entries, memory_max_entries=memory_max_entries)
+    return SPOTLIGHT_CACHE
+
+
+def disable_spotlight_cache():
+    global SPOTLIGHT_CACHE
+    if SPOTLIGHT_CACHE is not None:
+        SPOTLIGHT_CACHE.close()
+    SPOTLIGHT_CACHE = None
+
     
 
 """The following function is used to map DBPedia URIs to Wikidata ones.
 It takes as input the DBPedia URI and returns the Wikidata one (more precisely, it returns a list
 with all the correspondent candidates). 
-It uses a Python SPARQL wrapper to execute a SPARQL query in Python, using the property owl:sameAs  """
+It executes a SPARQL query on the DBPedia endpoint (through the shared HTTP session of http_utils), using the property owl:sameAs  """
 
 def get_wikidata_uri(dbpedia_uri):
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
     query = f"""
     PREFIX owl: <http://www.w3.org/2002/07/owl#>
 
@@ -45,13 +92,178 @@ def get_wikidata_uri(dbpedia_uri):
       FILTER (STRSTARTS(STR(?wikidataURI), "http://www.wikidata.org/entity/"))
     }}
     """
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
+    response = http_utils.post(DBPEDIA_SPARQL_ENDPOINT, data={'query': query, 'format': 'application/sparql-results+json'}, headers={'Accept': 'application/sparql-results+json'})
+    response.raise_for_status()
+    results = response.json()
     
     wikidata_uris = [result["wikidataURI"]["value"] for result in results["results"]["bindings"]]
     return wikidata_uris
 
+DBPEDIA_SPARQL_ENDPOINT = "http://dbpedia.org/sparql"
+
+#  DBPedia URI -> list of Wikidata URIs, filled by get_wikidata_uris
+DBPEDIA_TO_WIKIDATA_CACHE = cache_utils.MemoryCache(max_entries=200000)
+
+#  characters that cannot appear in an IRI written between <> in a SPARQL query
+_INVALID_IRI_CHARACTERS = set('<>"{}|^`\\ \t\n\r')
+
+
+def _query_wikidata_uris_chunk(dbpedia_uris):
+    values = " ".join("<{}>".format(uri) for uri in dbpedia_uris)
+    query = f"""
+    PREFIX owl: <http://www.w3.org/2002/07/owl#>
+
+    SELECT ?dbpediaURI ?wikidataURI
+    WHERE {{
+      VALUES ?dbpediaURI {{ {values} }}
+      ?dbpediaURI owl:sameAs ?wikidataURI .
+      FILTER (STRSTARTS(STR(?wikidataURI), "http://www.wikidata.org/entity/"))
+    }}
+    """
+    response = http_utils.post(DBPEDIA_SPARQL_ENDPOINT, data={'query': query, 'format': 'application/sparql-results+json'}, headers={'Accept': 'application/sparql-results+json'})
+    response.raise_for_status()
+
+    wikidata_uris = {uri: [] for uri in dbpedia_uris}
+    for result in response.json()["results"]["bindings"]:
+        wikidata_uris.setdefault(result["dbpediaURI"]["value"], []).append(result["wikidataURI"]["value"])
+    return wikidata_uris
+
+
+"""The following function is the bulk version of get_wikidata_uri: it maps many DBPedia URIs to Wikidata URIs at once.
+URIs are split in chunks of chunk_size, and each chunk is resolved with a single SPARQL query (using VALUES); up to max_workers chunks
+are sent concurrently, through the shared connection pool of http_utils.
+Results are cached for each DBPedia URI (DBPEDIA_TO_WIKIDATA_CACHE), so a URI is resolved only once per process.
+It returns a dictionary that maps each DBPedia URI to the list of correspondent Wikidata URIs (the same list get_wikidata_uri returns)."""
+
+def get_wikidata_uris(dbpedia_uris, chunk_size=50, max_workers=4):
+    wikidata_uris = {}
+    to_resolve = []
+    for uri in dict.fromkeys(dbpedia_uris):
+        cached = DBPEDIA_TO_WIKIDATA_CACHE.get(uri)
+        metrics_utils.cache_lookup('dbpedia_to_wikidata', cached is not None)
+        if cached is not None:
+            wikidata_uris[uri] = cached
+        elif set(uri) & _INVALID_IRI_CHARACTERS:
+            wikidata_uris[uri] = []
+        else:
+            to_resolve.append(uri)
+
+    chunks = [to_resolve[i:i + chunk_size] for i in range(0, len(to_resolve), chunk_size)]
+    if len(chunks) == 1:
+        resolved_chunks = [_query_wikidata_uris_chunk(chunks[0])]
+    elif len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            resolved_chunks = list(executor.map(_query_wikidata_uris_chunk, chunks))
+    else:
+        resolved_chunks = []
+
+    for resolved in resolved_chunks:
+        for uri, uris in resolved.items():
+            DBPEDIA_TO_WIKIDATA_CACHE.set(uri, uris)
+            wikidata_uris[uri] = uris
+    return wikidata_uris
+
+"""The following functions map the DBPedia URIs of the language editions of DBPedia (e.g. http://fr.dbpedia.org/resource/Sociologie)
+to Wikidata URIs, for which there is no SPARQL path. The name of a DBPedia resource is the title of the Wikipedia page
+of the same language, and Wikidata stores the titles of the Wikipedia pages of each entity (sitelinks): titles are resolved with
+wbgetentities requests (sites=<lang>wiki&titles=..., WIKIDATA_BATCH_SIZE titles per request), sent concurrently by up to max_workers threads
+through the shared connection pool of http_utils. Results are cached for each title (SITELINK_TO_WIKIDATA_CACHE).
+Titles that redirect to another page are resolved by Wikidata to the entity of the target page, but cannot be matched with the
+requested title, so they get no Wikidata URI."""
+
+WIKIDATA_ENTITY_URI_PREFIX = "http://www.wikidata.org/entity/"
+WIKIDATA_BATCH_SIZE = 50  # maximum number of titles or ids in a wbgetentities request
+
+#  '<site>|<title>' -> list of Wikidata URIs, filled by get_wikidata_uris_from_sitelinks
+SITELINK_TO_WIKIDATA_CACHE = cache_utils.MemoryCache(max_entries=200000)
+
+
+#  Wikipedia site and page title of a DBPedia URI ('frwiki', 'Sociologie'); the language is taken from the host (dbpedia.org is English)
+def dbpedia_uri_to_sitelink(dbpedia_uri, language=None):
+    parts = urlsplit(dbpedia_uri)
+    if not parts.path.startswith('/resource/'):
+        return None
+    host = parts.netloc.split('.')
+    site_language = host[0] if len(host) == 3 and host[1] == 'dbpedia' else ('en' if parts.netloc == 'dbpedia.org' else language)
+    title = unquote(parts.path[len('/resource/'):]).replace('_', ' ').strip()
+    if not site_language or not title:
+        return None
+    return site_language + 'wiki', title[0].upper() + title[1:]
+
+
+def _wbgetentities(params):
+    params = dict(params, action='wbgetentities', format='json')
+    response = http_utils.get(WIKIDATA_API_URL, params=params)
+    response.raise_for_status()
+    data = response.json()
+    if 'error' in data:
+        raise RuntimeError("wbgetentities error: {}".format(data['error'].get('info', data['error'])))
+    return data.get('entities', {})
+
+
+def _query_sitelinks_chunk(site, titles):
+    with metrics_utils.span('wikidata_sitelinks', site=site):
+        entities = _wbgetentities({'sites': site, 'titles': "|".join(titles), 'props': 'sitelinks', 'sitefilter': site})
+    wikidata_uris = {title: [] for title in titles}
+    for qid, entity in entities.items():
+        sitelink = entity.get('sitelinks', {}).get(site)
+        if 'missing' in entity or sitelink is None:
+            continue
+        if sitelink['title'] in wikidata_uris:
+            wikidata_uris[sitelink['title']].append(WIKIDATA_ENTITY_URI_PREFIX + qid)
+    return site, wikidata_uris
+
+
+"""The following function is the equivalent of get_wikidata_uris for the DBPedia URIs of any language edition. language is used for URIs
+whose host does not give the language. It returns a dictionary that maps each DBPedia URI to the list of correspondent Wikidata URIs
+(empty if the page has no Wikidata entity)."""
+
+def get_wikidata_uris_from_sitelinks(dbpedia_uris, language=None, chunk_size=WIKIDATA_BATCH_SIZE, max_workers=4):
+    wikidata_uris = {}
+    sitelinks = {}
+    to_resolve = {}
+    for uri in dict.fromkeys(dbpedia_uris):
+        sitelink = dbpedia_uri_to_sitelink(uri, language)
+        if sitelink is None:
+            wikidata_uris[uri] = []
+            continue
+        sitelinks[uri] = sitelink
+        cached = SITELINK_TO_WIKIDATA_CACHE.get("|".join(sitelink))
+        metrics_utils.cache_lookup('sitelink_to_wikidata', cached is not None)
+        if cached is not None:
+            wikidata_uris[uri] = cached
+        else:
+            to_resolve.setdefault(sitelink[0], {})[sitelink[1]] = None
+
+    chunks = [(site, titles[i:i + chunk_size]) for site, titles in ((site, list(titles)) for site, titles in to_resolve.items()) for i in range(0, len(titles), chunk_size)]
+    resolved_sitelinks = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        for site, resolved in executor.map(lambda chunk: _query_sitelinks_chunk(*chunk), chunks):
+            for title, uris in resolved.items():
+                SITELINK_TO_WIKIDATA_CACHE.set(site + "|" + title, uris)
+                resolved_sitelinks[(site, title)] = uris
+
+    for uri, sitelink in sitelinks.items():
+        if uri not in wikidata_uris:
+            wikidata_uris[uri] = resolved_sitelinks.get(sitelink, [])
+    return wikidata_uris
+
+
+"""The following function maps DBPedia URIs to Wikidata URIs whatever the language: English URIs with the bulk SPARQL query (get_wikidata_uris),
+URIs of the other language editions with the sitelinks (get_wikidata_uris_from_sitelinks)."""
+
+def resolve_dbpedia_uris(dbpedia_uris, language=None, max_workers=4):
+    dbpedia_uris = list(dict.fromkeys(dbpedia_uris))
+    english_uris = [uri for uri in dbpedia_uris if urlsplit(uri).netloc == 'dbpedia.org']
+    other_uris = [uri for uri in dbpedia_uris if urlsplit(uri).netloc != 'dbpedia.org']
+    wikidata_uris = {}
+    if english_uris:
+        wikidata_uris.update(get_wikidata_uris(english_uris, max_workers=max_workers))
+    if other_uris:
+        wikidata_uris.update(get_wikidata_uris_from_sitelinks(other_uris, language, max_workers=max_workers))
+    return wikidata_uris
+
+
 """
 The following function load a LLM from the HuggingFace Hub using the Python wrapper for Llama.cpp.
 The function takes as input repo_id (the name of the HuggingFace repository of the model) 
@@ -59,10 +271,12 @@ and the name of the model file (typically for each repository there are differen
 where each version corresponds to a quantization using a different number of bits to encode weights). 
 Different models can be tried by looking for quantized models in gguf format in Huggingface. 
 By default, the function uses a 4-bit version of a Mistral-7B-Instruct quantization.
-The function returns the model object
+The function returns the model object (llama-cpp-python is an optional dependency: pip install llama-cpp-python).
+To keep a local model loaded once per process and use it also as a client of useLLM_back_and_forth, see llama_engine.py
 """
 
 def loadLLM(repo_id="TheBloke/Mistral-7B-Instruct-v0.2-GGUF", filename='mistral-7b-instruct-v0.2.Q4_K_M.gguf'):
+    from llama_cpp import Llama
     llm = Llama.from_pretrained(
     repo_id,
     filename,
@@ -70,33 +284,119 @@ def loadLLM(repo_id="TheBloke/Mistral-7B-Instruct-v0.2-GGUF", filename='mistral-
     )
     return llm
 
-"""The following function makes a query on Wikidata using the Wikidata API.
-It takes as input the term to be queried
-and returns (EXPLAIN HERE THE RETURNED VALUE IN DETAIL)"""
-def query_wikidata(query_term):
-    WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+WIKIDATA_SEARCH_LIMIT = 7  # default number of results returned by wbsearchentities
+
+#  cache for wbsearchentities responses, disabled until enable_wikidata_cache is called
+WIKIDATA_SEARCH_CACHE = None
+
+#  object used instead of the Wikidata API for entity searches (e.g. a wikidata_index.WikidataIndex), None to use the API
+WIKIDATA_SEARCH_BACKEND = None
+
+#  method used to score candidates against the query term (see similarity_utils.top_k): 'compat' gives the same ranking as SequenceMatcher
+SIMILARITY_METHOD = 'compat'
+
+
+"""The following function enables the cache for Wikidata entity searches (used by query_wikidata and query_best_matches_wikidata).
+Responses are kept in memory and, if path is given, in a SQLite file, so that they survive between runs 
+(e.g., when the evaluation notebook is executed again). ttl is the time to live of an entry in seconds (by default, 30 days),
+max_entries bounds the number of entries on disk (least recently used entries are evicted first) and memory_max_entries 
+the number of entries kept in memory.
+It returns the cache object (call its method stats() to get the hit and miss counters)"""
+
+def enable_wikidata_cache(path="wikidata_search_cache.sqlite", ttl=30*24*3600, max_entries=200000, memory_max_entries=20000):
+    global WIKIDATA_SEARCH_CACHE
+    if WIKIDATA_SEARCH_CACHE is not None:
+        WIKIDATA_SEARCH_CACHE.close()
+    WIKIDATA_SEARCH_CACHE = cache_utils.TieredCache(path, ttl=ttl, max_entries=max_entries, memory_max_entries=memory_max_entries)
+    return WIKIDATA_SEARCH_CACHE
+
+
+def disable_wikidata_cache():
+    global WIKIDATA_SEARCH_CACHE
+    if WIKIDATA_SEARCH_CACHE is not None:
+        WIKIDATA_SEARCH_CACHE.close()
+    WIKIDATA_SEARCH_CACHE = None
+
+
+"""The following function sets the backend used for Wikidata entity searches instead of the API. 
+The backend must have a method search(query_term, language, limit) returning a list of dictionaries with the same keys 
+as the results of wbsearchentities (see wikidata_index.WikidataIndex). Use None to go back to the API."""
+
+def set_wikidata_search_backend(backend):
+    global WIKIDATA_SEARCH_BACKEND
+    WIKIDATA_SEARCH_BACKEND = backend
+    return backend
+
+
+"""The following function switches Wikidata entity searches to a local index built with wikidata_index.build_wikidata_index
+(no network requests are made while the backend is active). It returns the opened index."""
+
+def use_local_wikidata_index(index_dir):
+    import wikidata_index
+    if WIKIDATA_SEARCH_BACKEND is not None and hasattr(WIKIDATA_SEARCH_BACKEND, 'close'):
+        WIKIDATA_SEARCH_BACKEND.close()
+    return set_wikidata_search_backend(wikidata_index.WikidataIndex(index_dir))
+
+
+def wikidata_cache_key(query_term, language, limit):
+    #  wbsearchentities is case insensitive and ignores repeated whitespace, so the term is normalized
+    normalized_term = " ".join(query_term.lower().split())
+    return "{}|{}|{}".format(language, limit, normalized_term)
+
+
+"""The following function sends a wbsearchentities request to the Wikidata API and returns the list of matching
+entities (the 'search' field of the response, a list of dictionaries with keys such as 'id', 'label', 'concepturi', 'description').
+If the cache is enabled (see enable_wikidata_cache), the response is looked up in the cache first.
+If a search backend is set (see set_wikidata_search_backend), the backend is used instead of the API (and of the cache)."""
+
+def search_wikidata_entities(query_term, language="en", limit=WIKIDATA_SEARCH_LIMIT):
+    if WIKIDATA_SEARCH_BACKEND is not None:
+        with metrics_utils.span('wikidata_backend_search'):
+            return WIKIDATA_SEARCH_BACKEND.search(query_term, language, limit)
+
+    cache = WIKIDATA_SEARCH_CACHE
+    if cache is not None:
+        key = wikidata_cache_key(query_term, language, limit)
+        cached = cache.get(key)
+        metrics_utils.cache_lookup('wikidata_search', cached is not None)
+        if cached is not None:
+            return cached
+
     params = {
         'action': 'wbsearchentities',
         'search': query_term,
-        'language': 'en',
+        'language': language,
+        'limit': limit,
         'format': 'json'
     }
-    response = requests.get(WIKIDATA_API_URL, params=params)
+    response = http_utils.get(WIKIDATA_API_URL, params=params)
     
-    response = response.json().get('search', [])
+    data = response.json()
+    entities = data.get('search', [])
+
+    #  error responses are not cached, so that the search is repeated in the next run
+    if cache is not None and response.status_code == 200 and 'error' not in data:
+        cache.set(key, entities)
+    return entities
+
+
+"""The following function makes a query on Wikidata using the Wikidata API.
+It takes as input the term to be queried
+and returns the best matching entity, i.e. the search result (a dictionary with the fields returned by wbsearchentities, 
+such as 'id', 'label', 'concepturi' and 'description') whose label has the highest sequence matching score with the term. 
+It returns None if the search has no results"""
+def query_wikidata(query_term):
+    response = search_wikidata_entities(query_term, 'en')
 
-    best_match = None
-    highest_score = 0
-    for result in response:
-        score = SequenceMatcher(None, query_term, result['label']).ratio()
-        if score > highest_score:
-            highest_score = score
-            best_match = result
-    return best_match
+    best_match = similarity_utils.top_k(query_term, [result['label'] for result in response], 1, method=SIMILARITY_METHOD)
+    if len(best_match) == 0 or best_match[0][1] <= 0:
+        return None
+    return response[best_match[0][0]]
 
 
 """The following function makes a query on Wikidata using the API, 
-sort the results by a sequence matching score and returns the best matches
+sort the results by a sequence matching score (computed with similarity_utils, see SIMILARITY_METHOD) and returns the best matches
 Results are in the form of a list of dictionaries, where each dictionary contains the following keys:
 - label: the label of the entity
 - uri: the URI of the entity
@@ -105,22 +405,11 @@ Results are in the form of a list of dictionaries, where each dictionary contain
 
 """
 def query_best_matches_wikidata(query_term, language = "en", number_of_results=3):
-    WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
-    params = {
-        'action': 'wbsearchentities',
-        'search': query_term,
-        'language': language,
-        'format': 'json'
-    }
-    response = requests.get(WIKIDATA_API_URL, params=params)
-    
-    response = response.json().get('search', [])
-
+    response = search_wikidata_entities(query_term, language)
 
-    best_match = None
-    highest_score = 0
     results_with_scores = []
-    for entity in response:
+    for index, score in similarity_utils.top_k(query_term, [entity['label'] for entity in response], number_of_results, method=SIMILARITY_METHOD):
+        entity = response[index]
         result = {}
         result['label'] = entity['label']
         result['uri'] = entity['concepturi']
@@ -128,9 +417,9 @@ def query_best_matches_wikidata(query_term, language = "en", number_of_results=3
             result['description'] = entity['description']
         else:
             result['description'] = ""
-        result['score'] = SequenceMatcher(None, query_term, entity['label']).ratio()
+        result['score'] = score
         results_with_scores.append(result)
-    return sorted(results_with_scores, key=lambda x: x['score'], reverse=True)[:number_of_results]
+    return results_with_scores
 
 
 """The following function is a wrapper for authentication in the OpenAI API
@@ -0,0 +1,299 @@
+"""This file contains an offline index of Wikidata labels, aliases and descriptions, built from a Wikidata JSON dump
+(https://www.wikidata.org/wiki/Wikidata:Database_download), which can replace the wbsearchentities API in
+tools_utils.query_wikidata and tools_utils.query_best_matches_wikidata (see tools_utils.use_local_wikidata_index).
+
+The builder streams the dump one entity at a time (the dump can be compressed with bz2 or gzip, and can also be a filtered subset
+with one entity per line) and writes three files in the index directory:
+- entities.bin: one compact JSON line per entity, with its labels and descriptions in the indexed languages;
+- keys.bin: one line per (language, label or alias), sorted by language, normalized text and rank, pointing to the entity line
+(the rank puts the entities with the most Wikipedia sitelinks first, and labels before aliases, so the best exact matches come first);
+- keys.idx: the offsets of the lines of keys.bin, as an array of unsigned 64-bit integers (native byte order).
+The files are memory-mapped when the index is opened, so a lookup is a binary search over keys.idx and takes microseconds.
+Keys are sorted with an external merge sort, so the builder uses a bounded amount of memory also with the full dump.
+
+Usage from the command line:
+python wikidata_index.py build latest-all.json.bz2 wikidata_index --languages en fr es
+python wikidata_index.py search wikidata_index "gender" --language en
+"""
+
+import argparse
+import bz2
+import gzip
+import heapq
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+
+
+INDEX_LANGUAGES = ['es', 'en', 'pt', 'fr', 'de', 'ru', 'ca', 'it', 'nl', 'el', 'hr']
+WIKIDATA_ENTITY_URI = "http://www.wikidata.org/entity/{}"
+
+LANGUAGE_SEPARATOR = "\x1f"
+FIELD_SEPARATOR = "\x1e"  # lower than any printable character, so an exact match sorts before the longer keys it prefixes
+KEYS_PER_RUN = 1000000  # number of keys sorted in memory before they are written to a temporary run file
+OFFSETS_PER_WRITE = 65536  # number of offsets of keys.bin buffered before they are written to keys.idx
+KEY_FORMAT = 2  # 1: keys without rank (indexes built before the rank was added)
+MAX_SITELINKS = 999999
+
+
+#  rank field of a key: entities with more sitelinks (a proxy of popularity) sort first, then labels before aliases
+def key_rank(sitelinks, match_type):
+    return "{:06d}{}".format(MAX_SITELINKS - min(sitelinks, MAX_SITELINKS), 0 if match_type == 'label' else 1)
+
+
+#  lower case and single spaces, without the characters used as separators in keys.bin
+def normalize_text(text):
+    text = text.replace(LANGUAGE_SEPARATOR, " ").replace(FIELD_SEPARATOR, " ")
+    return " ".join(text.lower().split())
+
+
+def _open_dump(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+"""
+The following function reads a Wikidata JSON dump and yields one entity (a dictionary) at a time.
+The official dumps are a JSON array with one entity per line; filtered subsets with one entity per line (JSONL) are also accepted.
+"""
+
+def iter_dump_entities(path):
+    with _open_dump(path) as dump:
+        for line in dump:
+            line = line.strip()
+            if line in ('', '[', ']'):
+                continue
+            if line.endswith(','):
+                line = line[:-1]
+            yield json.loads(line)
+
+
+#  a key is a line of UTF-8 bytes (bytes sort like the code points, so keys.bin is in the order of the binary search); the matched text
+#  is kept on one line: every line break (also '\r' and '\u2028') is replaced by a space
+def _key(lang, text, rank, match_type, offset):
+    fields = (normalize_text(text), rank, match_type, str(offset), " ".join(text.splitlines()))
+    return (lang + LANGUAGE_SEPARATOR + FIELD_SEPARATOR.join(fields) + "\n").encode('utf-8')
+
+
+def _write_run(keys, directory, runs):
+    keys.sort()
+    path = os.path.join(directory, "run_{}.bin".format(len(runs)))
+    with open(path, 'wb') as f:
+        f.writelines(keys)
+    runs.append(path)
+    keys.clear()
+
+
+"""
+The following function builds the index. Parameters are:
+- dump_path: path of the dump (.json, .json.bz2, .json.gz, or a JSONL subset)
+- output_dir: directory where the index files are written
+- languages: languages whose labels, aliases and descriptions are indexed (by default, the languages supported by the tool)
+- max_entities: stops after this number of entities (useful to build a small index for testing)
+Entities without labels or aliases in the indexed languages are skipped. Only items (Q...) are indexed by default, like
+the default type of wbsearchentities.
+It returns the number of indexed entities.
+"""
+
+def build_wikidata_index(dump_path, output_dir, languages=INDEX_LANGUAGES, max_entities=None, entity_types=('item',)):
+    languages = set(languages)
+    os.makedirs(output_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=output_dir)
+    runs = []
+    keys = []
+    number_of_entities = 0
+
+    try:
+        with open(os.path.join(output_dir, 'entities.bin'), 'wb') as entities_file:
+            for entity in iter_dump_entities(dump_path):
+                if entity.get('type', 'item') not in entity_types:
+                    continue
+                labels = {lang: value['value'] for lang, value in entity.get('labels', {}).items() if lang in languages}
+                aliases = {lang: [alias['value'] for alias in values] for lang, values in entity.get('aliases', {}).items() if lang in languages}
+                if not labels and not aliases:
+                    continue
+                descriptions = {lang: value['value'] for lang, value in entity.get('descriptions', {}).items() if lang in languages}
+                sitelinks = len(entity.get('sitelinks', {}))  # 0 for filtered subsets without sitelinks
+
+                offset = entities_file.tell()
+                record = {'id': entity['id'], 'labels': labels, 'descriptions': descriptions}
+                entities_file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n")
+
+                #  one key for each label and alias (the matched text is kept to report the match type)
+                for lang, label in labels.items():
+                    keys.append(_key(lang, label, key_rank(sitelinks, 'label'), 'label', offset))
+                for lang, values in aliases.items():
+                    for alias in values:
+                        keys.append(_key(lang, alias, key_rank(sitelinks, 'alias'), 'alias', offset))
+                if len(keys) >= KEYS_PER_RUN:
+                    _write_run(keys, temp_dir, runs)
+
+                number_of_entities += 1
+                if max_entities is not None and number_of_entities >= max_entities:
+                    break
+        if keys:
+            _write_run(keys, temp_dir, runs)
+
+        #  merge the sorted runs into keys.bin and write the offsets of its lines into keys.idx at the same time,
+        #  OFFSETS_PER_WRITE at a time (run files are binary, so a line ends only at b"\n")
+        run_files = [open(path, 'rb') for path in runs]
+        try:
+            number_of_keys = 0
+            offsets = array('Q')
+            with open(os.path.join(output_dir, 'keys.bin'), 'wb') as keys_file, open(os.path.join(output_dir, 'keys.idx'), 'wb') as index_file:
+                previous = None
+                position = 0
+                for line in heapq.merge(*run_files):
+                    if line == previous:
+                        continue
+                    previous = line
+                    offsets.append(position)
+                    keys_file.write(line)
+                    position += len(line)
+                    if len(offsets) >= OFFSETS_PER_WRITE:
+                        offsets.tofile(index_file)
+                        number_of_keys += len(offsets)
+                        offsets = array('Q')
+                offsets.tofile(index_file)
+                number_of_keys += len(offsets)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+        with open(os.path.join(output_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
+            json.dump({'dump': os.path.basename(dump_path), 'languages': sorted(languages), 'entities': number_of_entities, 'keys': number_of_keys, 'key_format': KEY_FORMAT}, f, indent=2)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return number_of_entities
+
+
+"""
+The following class opens an index built with build_wikidata_index. Its method search has the same behaviour as a wbsearchentities
+request: it returns the entities whose label or alias in the given language starts with the query term (exact matches first,
+and among matches of the same text the entities with the most sitelinks first), as a list of dictionaries with the keys returned by the API ('id', 'label', 'concepturi', 'description', 'match').
+An instance can be given to tools_utils.set_wikidata_search_backend (or use tools_utils.use_local_wikidata_index).
+The index is read-only, so an instance can be shared by different threads.
+"""
+
+class WikidataIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._files = []
+        self.keys = self._map('keys.bin')
+        self.entities = self._map('entities.bin')
+        self._index_map = self._map('keys.idx')
+        self.offsets = memoryview(self._index_map).cast('Q') if len(self._index_map) else []
+        try:
+            with open(os.path.join(index_dir, 'metadata.json'), 'r', encoding='utf-8') as f:
+                self.key_format = json.load(f).get('key_format', 1)
+        except FileNotFoundError:
+            self.key_format = 1
+
+    def _map(self, name):
+        f = open(os.path.join(self.index_dir, name), 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        for mapped in (self.keys, self.entities, self._index_map):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for f in self._files:
+            f.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _key_line(self, i):
+        start = self.offsets[i]
+        end = self.keys.find(b"\n", start)
+        return self.keys[start:end]
+
+    #  first position whose key is >= prefix (binary search over keys.idx)
+    def _lower_bound(self, prefix):
+        low, high = 0, len(self.offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_line(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _entity(self, offset):
+        end = self.entities.find(b"\n", offset)
+        return json.loads(self.entities[offset:end])
+
+    def search(self, query_term, language="en", limit=7):
+        normalized = normalize_text(query_term)
+        if not normalized:
+            return []
+        prefix = "{}{}{}".format(language, LANGUAGE_SEPARATOR, normalized).encode('utf-8')
+
+        results = []
+        seen = set()
+        i = self._lower_bound(prefix)
+        while i < len(self.offsets) and len(results) < limit:
+            line = self._key_line(i)
+            if not line.startswith(prefix):
+                break
+            i += 1
+            fields = line.decode('utf-8').split(FIELD_SEPARATOR, 4 if self.key_format >= 2 else 3)
+            match_type, offset, matched_text = fields[-3:]
+            offset = int(offset)
+            if offset in seen:
+                continue
+            seen.add(offset)
+
+            entity = self._entity(offset)
+            result = {
+                'id': entity['id'],
+                'concepturi': WIKIDATA_ENTITY_URI.format(entity['id']),
+                'label': entity['labels'].get(language, matched_text),
+                'match': {'type': match_type, 'language': language, 'text': matched_text}
+            }
+            if language in entity['descriptions']:
+                result['description'] = entity['descriptions'][language]
+            results.append(result)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline index of Wikidata labels and aliases")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help="build an index from a Wikidata JSON dump")
+    build.add_argument('dump')
+    build.add_argument('output_dir')
+    build.add_argument('--languages', nargs='+', default=INDEX_LANGUAGES)
+    build.add_argument('--max-entities', type=int, default=None)
+
+    search = subparsers.add_parser('search', help="search a term in an index")
+    search.add_argument('index_dir')
+    search.add_argument('term')
+    search.add_argument('--language', default='en')
+    search.add_argument('--limit', type=int, default=7)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        number_of_entities = build_wikidata_index(args.dump, args.output_dir, args.languages, args.max_entities)
+        print("Indexed {} entities in {}".format(number_of_entities, args.output_dir))
+    else:
+        index = WikidataIndex(args.index_dir)
+        print(json.dumps(index.search(args.term, args.language, args.limit), ensure_ascii=False, indent=2))
+        index.close()
+
+
+if __name__ == '__main__':
+    main()